@@ -4,5 +4,7 @@ __version__ = "0.0.0"
 __author__ = "Semyeong Oh <smohspace@outlook.com>"
 
 from .pipes import *
+from .pipeline import *
+from .chunked import *
 from .gaia import *
 from .accessors import *
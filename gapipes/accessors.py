@@ -64,21 +64,54 @@ class GaiaData(object):
 
     @property
     def galactic(self):
-        return self.icrs.transform_to(coord.Galactic)
+        """Galactic coordinates of sources
 
-    def make_cov(self, columns=["parallax", "pmra", "pmdec"]):
+        Use ``transform_to(coord.Galactic(), max_workers=n)`` to transform
+        large tables in parallel.
+        """
+        return self.icrs.transform_to(coord.Galactic())
+
+    def transform_to(self, frame, max_workers=None):
+        """Coordinates of sources in `frame`
+
+        Parameters
+        ----------
+        frame : astropy coordinate frame
+            frame to transform to
+        max_workers : int, optional
+            number of processes to transform in (see `gapipes.parallel`);
+            by default, transform in this process
+
+        Returns
+        -------
+        astropy coordinate frame
+        """
+        if max_workers is not None:
+            from . import parallel
+
+            return parallel.transform(self._df, frame, max_workers=max_workers)
+        return self.icrs.transform_to(frame)
+
+    def make_cov(
+        self, columns=["parallax", "pmra", "pmdec"], packed=False, dtype=float
+    ):
         """Generate covariance matrix from Gaia data
 
         columns : list
             list of columns to calculate covariance.
-            Must be a subset of 'ra', 'dec' 'parallax', 'pmra', 'pmdec'.
+            Must be a subset of 'ra', 'dec' 'parallax', 'pmra', 'pmdec',
+            'radial_velocity'.
+        packed : bool, optional
+            True to return `gapipes.covariance.PackedCov`
+        dtype : numpy dtype, optional
+            dtype of the packed matrices
 
         Returns
         -------
-        numpy.array
+        numpy.array or PackedCov
             (N, number of columns) array of covariance matrices
         """
-        return pp.make_cov(self._df, columns=columns)
+        return pp.make_cov(self._df, columns=columns, packed=packed, dtype=dtype)
 
     @property
     def distmod(self):
@@ -0,0 +1,350 @@
+"""
+Fast transformation of Gaia data to Galactic and Galactocentric cartesian
+coordinates
+
+Transformations from ICRS to frames such as Galactic or a Galactocentric
+frame with fixed parameters are affine: positions and velocities are rotated
+by a constant matrix and shifted by constant offsets. `AffineFrame` finds the
+matrix and offsets once by transforming a few points with astropy, and then
+transforms whole tables with plain numpy.
+
+>>> from gapipes import affine
+>>> df = affine.add_xv(df, coord.Galactocentric(), errors=True)
+>>> cov = affine.xv_cov(df, coord.Galactocentric())  # (N, 6, 6)
+"""
+import numpy as np
+import pandas as pd
+import astropy.coordinates as coord
+import astropy.units as u
+
+from . import covariance
+from .pipes import _tokms, make_cov
+
+__all__ = ["AffineFrame", "add_x", "add_xv", "xv_cov"]
+
+_mas = (1 * u.mas).to(u.rad).value
+_x_names = ["x", "y", "z"]
+_v_names = ["vx", "vy", "vz"]
+
+
+def _column(df, name, default=None):
+    if name not in set(df.keys()):
+        if default is None:
+            raise AttributeError("Must have '{:s}'.".format(name))
+        return np.full(len(df["ra"]), default, dtype=float)
+    return np.asarray(df[name], dtype=float)
+
+
+def _without_rv(df):
+    """Rows with NaN radial_velocity or radial_velocity_error
+
+    Velocities of these sources are unknown; their positions are not.
+    """
+    bad = np.zeros(len(df["ra"]), dtype=bool)
+    for c in ("radial_velocity", "radial_velocity_error"):
+        if c in set(df.keys()):
+            bad |= np.isnan(np.asarray(df[c], dtype=float))
+    return bad
+
+
+def _basis(ra, dec):
+    """Unit vectors r, p (increasing ra) and q (increasing dec), (3, N) each"""
+    ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+    cra, sra, cdec, sdec = np.cos(ra), np.sin(ra), np.cos(dec), np.sin(dec)
+    r, p, q = np.empty((3, 3, len(ra)))
+    r[0], r[1], r[2] = cdec * cra, cdec * sra, sdec
+    p[0], p[1], p[2] = -sra, cra, 0.0
+    q[0], q[1], q[2] = -sdec * cra, -sdec * sra, cdec
+    return r, p, q
+
+
+class AffineFrame(object):
+    """Transformation from ICRS to `frame` as a rotation and a shift
+
+    Parameters
+    ----------
+    frame : astropy coordinate frame
+        frame to transform to, e.g., ``coord.Galactic()`` or
+        ``coord.Galactocentric()``
+    rtol : float, optional
+        relative tolerance of the check that the transformation is affine
+
+    Raises
+    ------
+    ValueError
+        if the transformation to `frame` is not affine, e.g., because it
+        depends on the position of the observer
+
+    Attributes
+    ----------
+    R : numpy.array
+        (3, 3) rotation matrix
+    offset : numpy.array
+        position [pc] of the ICRS origin (the solar system barycentre)
+    velocity_offset : numpy.array
+        velocity [km/s] of the ICRS origin
+    """
+
+    # probes are far from the origin so that R is not limited by the offset
+    _scale = 1e6
+
+    def __init__(self, frame, rtol=1e-10):
+        if isinstance(frame, type):
+            frame = frame()
+        self.frame = frame
+        s = self._scale
+        x = np.array([[0, s, 0, 0], [0, 0, s, 0], [0, 0, 0, s]], dtype=float)
+        xt, vt = self._astropy(x, np.zeros_like(x))
+        self.offset = xt[:, 0]
+        self.velocity_offset = vt[:, 0]
+        self.R = (xt[:, 1:] - self.offset[:, None]) / s
+        # check on random positions and velocities
+        rng = np.random.RandomState(42)
+        x, v = rng.normal(0, 1e4, (3, 10)), rng.normal(0, 100, (3, 10))
+        xt, vt = self._astropy(x, v)
+        if not (
+            np.allclose(self.R @ x + self.offset[:, None], xt, rtol=rtol, atol=1e-6)
+            and np.allclose(
+                self.R @ v + self.velocity_offset[:, None], vt, rtol=rtol, atol=1e-9
+            )
+        ):
+            raise ValueError("Transformation to {} is not affine".format(frame))
+
+    def _astropy(self, x, v):
+        """Transform (3, N) positions [pc] and velocities [km/s] with astropy"""
+        c = coord.ICRS(
+            coord.CartesianRepresentation(
+                x,
+                unit=u.pc,
+                differentials=coord.CartesianDifferential(v, unit=u.km / u.s),
+            )
+        ).transform_to(self.frame)
+        return c.cartesian.xyz.to(u.pc).value, c.velocity.d_xyz.to(u.km / u.s).value
+
+    def icrs_xv(self, df):
+        """ICRS positions [pc] and velocities [km/s] of Gaia data, (3, N) each
+
+        A missing radial_velocity column is taken to be zero.
+        """
+        r, p, q = _basis(_column(df, "ra"), _column(df, "dec"))
+        parallax = _column(df, "parallax")
+        x = r * (1e3 / parallax)
+        if not {"pmra", "pmdec"} <= set(df.keys()):
+            return x, None
+        k = _tokms / parallax
+        v = r * _column(df, "radial_velocity", 0.0)
+        v += p * (k * _column(df, "pmra"))
+        v += q * (k * _column(df, "pmdec"))
+        return x, v
+
+    def xyz(self, df, unit=u.pc):
+        """(3, N) positions in `unit`"""
+        x, _ = self.icrs_xv(df)
+        return (self.R @ x + self.offset[:, None]) * u.pc.to(unit)
+
+    def xv(self, df, unit=u.pc):
+        """(3, N) positions in `unit` and (3, N) velocities [km/s]"""
+        x, v = self.icrs_xv(df)
+        if v is None:
+            raise AttributeError("Must have 'pmra', 'pmdec'.")
+        return (
+            (self.R @ x + self.offset[:, None]) * u.pc.to(unit),
+            self.R @ v + self.velocity_offset[:, None],
+        )
+
+    def icrs_jacobian(self, df):
+        """Derivatives of ICRS positions and velocities w.r.t. Gaia parameters
+
+        Parameters are ra*cos(dec) [mas], dec [mas], parallax [mas],
+        pmra [mas/yr], pmdec [mas/yr] and radial_velocity [km/s], as in
+        `gapipes.pipes.make_cov`; offsets in ra and dec are small angles.
+        NaN radial velocities are taken to be zero.
+
+        Returns
+        -------
+        numpy.array
+            (N, 6, 6) d(x, y, z [pc], vx, vy, vz [km/s]) / d(parameters)
+        """
+        ra, dec = _column(df, "ra"), _column(df, "dec")
+        r, p, q = (a.T for a in _basis(ra, dec))
+        parallax = _column(df, "parallax")[:, None]
+        pmra, pmdec = _column(df, "pmra")[:, None], _column(df, "pmdec")[:, None]
+        # NaN radial velocities would spread to every element through
+        # the ra and dec derivatives; see `_without_rv`
+        rv = np.nan_to_num(_column(df, "radial_velocity", 0.0))[:, None]
+        d = 1e3 / parallax
+        k = _tokms / parallax
+        tan_dec = np.tan(np.deg2rad(dec))[:, None]
+        J = np.zeros((len(ra), 6, 6))
+        J[:, :3, 0] = d * p * _mas
+        J[:, :3, 1] = d * q * _mas
+        J[:, :3, 2] = -d / parallax * r
+        J[:, 3:, 0] = (
+            rv * p - k * (pmra * (r - tan_dec * q) + pmdec * tan_dec * p)
+        ) * _mas
+        J[:, 3:, 1] = (rv * q - k * pmdec * r) * _mas
+        J[:, 3:, 2] = -k / parallax * (pmra * p + pmdec * q)
+        J[:, 3:, 3] = k * p
+        J[:, 3:, 4] = k * q
+        J[:, 3:, 5] = r
+        return J
+
+    def jacobian(self, df):
+        """(N, 6, 6) derivatives of positions [pc] and velocities [km/s] in
+        the frame w.r.t. Gaia parameters (see `icrs_jacobian`)"""
+        J = self.icrs_jacobian(df)
+        out = np.empty_like(J)
+        out[:, :3] = self.R @ J[:, :3]
+        out[:, 3:] = self.R @ J[:, 3:]
+        return out
+
+    def xv_errors(self, df):
+        """Uncertainties [pc, km/s] of x, y, z, vx, vy, vz, (N, 6)
+
+        Errors are propagated linearly from the `_error` columns of ra, dec,
+        parallax, pmra, pmdec and radial_velocity, ignoring correlations.
+        A missing radial_velocity_error column is taken to be zero. Sources
+        with NaN radial_velocity or radial_velocity_error have NaN velocity
+        errors but valid position errors.
+        """
+        names = ["ra", "dec", "parallax", "pmra", "pmdec"]
+        sigma = np.stack(
+            [_column(df, c + "_error") for c in names]
+            + [np.nan_to_num(_column(df, "radial_velocity_error", 0.0))],
+            axis=-1,
+        )
+        J = self.jacobian(df)
+        e = np.sqrt(np.einsum("nij,nj->ni", J**2, sigma**2))
+        e[_without_rv(df), 3:] = np.nan
+        return e
+
+    def xv_cov(self, df, packed=False, dtype=float, chunk_size=100000):
+        """Covariances of x, y, z [pc], vx, vy, vz [km/s]
+
+        The covariance of ra, dec, parallax, pmra, pmdec and radial_velocity
+        (`gapipes.pipes.make_cov`, including correlations) is propagated
+        linearly with the Jacobian, J C J^T. Without a radial_velocity_error
+        column, radial_velocity is taken to be exact. For sources with NaN
+        radial_velocity or radial_velocity_error, the rows and columns of
+        vx, vy, vz are NaN and the position block is valid.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            Gaia data with values, `_error` and `_corr` columns
+        packed : bool, optional
+            True to return `gapipes.covariance.PackedCov`
+        dtype : numpy dtype, optional
+            dtype of the packed matrices
+        chunk_size : int, optional
+            number of rows processed at a time
+
+        Returns
+        -------
+        numpy.array or PackedCov
+            (N, 6, 6) covariance matrices
+        """
+        names = ["ra", "dec", "parallax", "pmra", "pmdec"]
+        if "radial_velocity_error" in set(df.keys()):
+            names.append("radial_velocity")
+        N, n = len(df), len(names)
+        iu = np.triu_indices(6)
+        out = np.empty((N, len(iu[0])), dtype) if packed else np.empty((N, 6, 6))
+        C = np.zeros((min(chunk_size, N), 6, 6))
+        for start in range(0, N, chunk_size):
+            chunk = df.iloc[start : start + chunk_size]
+            m = len(chunk)
+            C[:m, :n, :n] = make_cov(chunk, names, packed=True).dense()
+            bad = _without_rv(chunk)
+            C[:m][bad, 5, 5] = 0.0
+            J = self.jacobian(chunk)
+            S = J @ C[:m] @ J.transpose(0, 2, 1)
+            S[bad, 3:, :] = np.nan
+            S[bad, :, 3:] = np.nan
+            out[start : start + m] = S[:, iu[0], iu[1]] if packed else S
+        if packed:
+            return covariance.PackedCov(out, 6)
+        return out
+
+    def __repr__(self):
+        return "AffineFrame({})".format(self.frame)
+
+
+_cache = []
+
+
+def _affine_frame(frame):
+    """AffineFrame for `frame`, reusing one made for an equivalent frame"""
+    if isinstance(frame, AffineFrame):
+        return frame
+    if isinstance(frame, type):
+        frame = frame()
+    for f in _cache:
+        if f.frame.is_equivalent_frame(frame):
+            return f
+    f = AffineFrame(frame)
+    _cache.append(f)
+    return f
+
+
+def add_x(df, frame, unit=u.pc):
+    """Add cartesian coordinates `x`, `y`, `z` of a given `frame`
+
+    The same as `gapipes.pipes.add_x` for frames with affine
+    transformations from ICRS, computed with numpy.
+    """
+    xyz = _affine_frame(frame).xyz(df, unit=unit)
+    df = df.copy()
+    for i, c in enumerate(_x_names):
+        df[c] = xyz[i]
+    return df
+
+
+def add_xv(df, frame, unit=u.pc, errors=False):
+    """Add cartesian coordinates x, y, z, vx, vy, vz for a given `frame`
+
+    The same as `gapipes.pipes.add_xv` for frames with affine
+    transformations from ICRS, computed with numpy. A missing
+    radial_velocity column is taken to be zero.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Gaia DR2 data
+    frame : astropy coordinate frame or AffineFrame
+        frame to calculate coordinates in
+    unit : astropy.units.Unit, optional
+        unit of positions; velocities are in km/s
+    errors : bool, optional
+        also add x_error, ..., vz_error (see `AffineFrame.xv_errors`)
+
+    Returns
+    -------
+    pd.DataFrame
+        df with x, y, z, vx, vy, vz columns added
+    """
+    if not isinstance(df, pd.DataFrame):
+        raise ValueError("df should be a pandas.DataFrame")
+    f = _affine_frame(frame)
+    x, v = f.xv(df, unit=unit)
+    df = df.copy()
+    for i, c in enumerate(_x_names):
+        df[c] = x[i]
+    for i, c in enumerate(_v_names):
+        df[c] = v[i]
+    if errors:
+        e = f.xv_errors(df)
+        e[:, :3] *= u.pc.to(unit)
+        for i, c in enumerate(_x_names + _v_names):
+            df[c + "_error"] = e[:, i]
+    return df
+
+
+def xv_cov(df, frame, packed=False, dtype=float, chunk_size=100000):
+    """Covariances of x, y, z [pc], vx, vy, vz [km/s] in `frame`
+
+    See `AffineFrame.xv_cov`.
+    """
+    return _affine_frame(frame).xv_cov(
+        df, packed=packed, dtype=dtype, chunk_size=chunk_size
+    )
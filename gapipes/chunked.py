@@ -0,0 +1,168 @@
+"""
+Apply pipes to catalogues on disk in chunks of rows
+
+Catalogues larger than memory are read in batches of rows, every batch is
+passed through a chain of pipes, and the result is written to its own part
+file, so that memory use is bounded by the chunk size.
+
+>>> from functools import partial
+>>> files = run_chunked(
+...     "gaia.fits", [pp.add_ruwe, partial(pp.add_xv, frame=coord.Galactic())],
+...     "out/", chunk_size=500000)
+"""
+import os
+import logging
+import pandas as pd
+from astropy.table import Table
+
+from . import tableio
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["iter_chunks", "count_rows", "run_chunked"]
+
+
+def _input_format(path, format=None):
+    if format is not None:
+        return format
+    name = path.lower()
+    if name.endswith(".gz"):
+        name = name[:-3]
+    for ext, fmt in [
+        (".fits", "fits"),
+        (".fit", "fits"),
+        (".parquet", "parquet"),
+        (".csv", "csv"),
+    ]:
+        if name.endswith(ext):
+            return fmt
+    raise ValueError("Cannot guess the format of {:s}".format(path))
+
+
+def count_rows(path, format=None):
+    """Number of rows of a catalogue, or None if it is unknown without reading it"""
+    format = _input_format(path, format)
+    if format == "fits":
+        from astropy.io import fits
+
+        with fits.open(path, memmap=True) as hdul:
+            return hdul[1].header["NAXIS2"]
+    if format == "parquet":
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(path).metadata.num_rows
+    return None
+
+
+def iter_chunks(path, chunk_size=100000, columns=None, format=None):
+    """Read a catalogue in chunks of rows
+
+    Parameters
+    ----------
+    path : str
+        catalogue file; the first table extension is read from FITS files
+    chunk_size : int, optional
+        number of rows per chunk
+    columns : list of str, optional
+        columns to read; all columns by default
+    format : str, optional
+        'fits', 'parquet' (requires pyarrow) or 'csv'; guessed from the
+        extension of `path` by default
+
+    Yields
+    ------
+    pandas.DataFrame
+        chunks of rows; the index continues across chunks
+    """
+    format = _input_format(path, format)
+    if format == "csv":
+        for df in pd.read_csv(path, chunksize=chunk_size, usecols=columns):
+            yield df
+    elif format == "fits":
+        # Table.read masks TNULL values of integer columns, so that they are
+        # missing in the chunks instead of sentinel values
+        table = Table.read(path, format="fits", memmap=True)
+        if columns is not None:
+            table = table[list(columns)]
+        for start in range(0, len(table), chunk_size):
+            df = table[start : start + chunk_size].to_pandas()
+            df.index += start
+            yield df
+            del df
+    elif format == "parquet":
+        import pyarrow.parquet as pq
+
+        start = 0
+        f = pq.ParquetFile(path)
+        for batch in f.iter_batches(batch_size=chunk_size, columns=columns):
+            df = batch.to_pandas()
+            df.index += start
+            start += len(df)
+            yield df
+    else:
+        raise ValueError("`format` must be one of 'fits', 'parquet', 'csv'")
+
+
+def run_chunked(
+    path,
+    pipes,
+    output_dir,
+    chunk_size=100000,
+    columns=None,
+    format="fits",
+    input_format=None,
+    progress=None,
+):
+    """Apply pipes to a catalogue chunk by chunk and write the results
+
+    Parameters
+    ----------
+    path : str
+        input catalogue (see `iter_chunks`)
+    pipes : list of callable
+        functions taking and returning a DataFrame, applied in order, e.g.,
+        `gapipes.pipes.add_ruwe`, ``partial(add_xv, frame=coord.Galactic())``
+        or a `gapipes.pipeline.Pipeline`
+    output_dir : str
+        directory to write part files to
+    chunk_size : int, optional
+        number of rows per chunk
+    columns : list of str, optional
+        input columns to read; all columns by default
+    format : str, optional
+        format of part files, one of 'fits', 'csv', 'parquet' (requires
+        pyarrow or fastparquet); see `gapipes.tableio`
+    input_format : str, optional
+        format of the input; guessed from the extension by default
+    progress : callable, optional
+        called with (input rows done, total rows or None) after each chunk
+
+    Returns
+    -------
+    list of str
+        paths to the part files in row order
+    """
+    tableio.check_format(format)
+    os.makedirs(output_dir, exist_ok=True)
+    total = count_rows(path, input_format)
+    files, done = [], 0
+    chunks = iter_chunks(path, chunk_size, columns=columns, format=input_format)
+    for i, df in enumerate(chunks):
+        done += len(df)
+        for pipe in pipes:
+            df = pipe(df)
+        out = os.path.join(
+            output_dir, "part-{:05d}.{:s}".format(i, tableio.extensions[format])
+        )
+        # never leave a half-written part under its final name
+        tableio.write_table(df, out + ".part", format)
+        os.replace(out + ".part", out)
+        files.append(out)
+        logger.info(
+            "{:d} rows{:s} written".format(
+                done, "" if total is None else " of {:d}".format(total)
+            )
+        )
+        if progress is not None:
+            progress(done, total)
+    return files
@@ -0,0 +1,348 @@
+"""
+Quality cuts that can be applied locally or pushed into ADQL queries
+
+A cut is written once with column expressions, e.g.,
+
+>>> cut = (col("parallax") / col("parallax_error") > 10) & good_phot
+
+and can be used as a boolean mask on local data,
+
+>>> df[cut.mask(df)]
+
+or as a server-side filter in a query,
+
+>>> q = adql.add_where("SELECT * FROM gaiadr2.gaia_source", cut)
+"""
+import numbers
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    "col",
+    "Expr",
+    "Predicate",
+    "good_phot",
+    "parallax_over_error_above",
+    "uwe_below",
+    "ruwe_below",
+]
+
+
+def _as_expr(value):
+    return value if isinstance(value, Expr) else Const(value)
+
+
+class Expr(object):
+    """Expression on table columns
+
+    Expressions support arithmetic with other expressions and numbers.
+    Comparing them makes a `Predicate`.
+    """
+
+    def to_adql(self, alias=None):
+        """ADQL for this expression; columns are qualified with `alias` if given"""
+        raise NotImplementedError
+
+    def evaluate(self, df):
+        """Evaluate expression on dict-like table `df`"""
+        raise NotImplementedError
+
+    def __str__(self):
+        return self.to_adql()
+
+    def __repr__(self):
+        return "{:s}({!r})".format(self.__class__.__name__, self.to_adql())
+
+    def __add__(self, other):
+        return BinOp("+", self, other)
+
+    def __radd__(self, other):
+        return BinOp("+", other, self)
+
+    def __sub__(self, other):
+        return BinOp("-", self, other)
+
+    def __rsub__(self, other):
+        return BinOp("-", other, self)
+
+    def __mul__(self, other):
+        return BinOp("*", self, other)
+
+    def __rmul__(self, other):
+        return BinOp("*", other, self)
+
+    def __truediv__(self, other):
+        return BinOp("/", self, other)
+
+    def __rtruediv__(self, other):
+        return BinOp("/", other, self)
+
+    def __pow__(self, other):
+        return BinOp("**", self, other)
+
+    def __neg__(self):
+        return BinOp("-", 0, self)
+
+    def __lt__(self, other):
+        return Compare("<", self, other)
+
+    def __le__(self, other):
+        return Compare("<=", self, other)
+
+    def __gt__(self, other):
+        return Compare(">", self, other)
+
+    def __ge__(self, other):
+        return Compare(">=", self, other)
+
+    def __eq__(self, other):
+        return Compare("=", self, other)
+
+    def __ne__(self, other):
+        return Compare("<>", self, other)
+
+    # == makes a Predicate, so expressions are hashed by identity
+    __hash__ = object.__hash__
+
+    def sqrt(self):
+        return Func("SQRT", self)
+
+    def abs(self):
+        return Func("ABS", self)
+
+    def log10(self):
+        return Func("LOG10", self)
+
+
+class Col(Expr):
+    """Table column"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def to_adql(self, alias=None):
+        return self.name if alias is None else "{:s}.{:s}".format(alias, self.name)
+
+    def evaluate(self, df):
+        return df[self.name]
+
+
+def col(name):
+    """Make an expression for column `name`"""
+    return Col(name)
+
+
+class Const(Expr):
+    """Number or string constant"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def to_adql(self, alias=None):
+        # plain Python numbers: numpy >= 2 gives repr np.float64(5.0)
+        if isinstance(self.value, numbers.Integral):
+            return str(int(self.value))
+        if isinstance(self.value, numbers.Real):
+            return repr(float(self.value))
+        if isinstance(self.value, str):
+            return "'" + self.value.replace("'", "''") + "'"
+        raise TypeError(
+            "Cannot write {!r} in ADQL; use a number or a string".format(self.value)
+        )
+
+    def evaluate(self, df):
+        return self.value
+
+
+class BinOp(Expr):
+    """Arithmetic operation on two expressions"""
+
+    _ops = {
+        "+": np.add,
+        "-": np.subtract,
+        "*": np.multiply,
+        "/": np.true_divide,
+        "**": np.power,
+    }
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = _as_expr(left)
+        self.right = _as_expr(right)
+
+    def to_adql(self, alias=None):
+        left, right = self.left.to_adql(alias), self.right.to_adql(alias)
+        if self.op == "**":
+            return "POWER({:s}, {:s})".format(left, right)
+        return "({:s} {:s} {:s})".format(left, self.op, right)
+
+    def evaluate(self, df):
+        return self._ops[self.op](self.left.evaluate(df), self.right.evaluate(df))
+
+
+class Func(Expr):
+    """Mathematical function of an expression"""
+
+    _funcs = {"SQRT": np.sqrt, "ABS": np.abs, "LOG10": np.log10}
+
+    def __init__(self, name, arg):
+        self.name = name
+        self.arg = _as_expr(arg)
+
+    def to_adql(self, alias=None):
+        return "{:s}({:s})".format(self.name, self.arg.to_adql(alias))
+
+    def evaluate(self, df):
+        return self._funcs[self.name](self.arg.evaluate(df))
+
+
+class Predicate(object):
+    """Boolean condition on table rows
+
+    Predicates are combined with ``&``, ``|`` and ``~``. As in ADQL,
+    comparisons with missing values are unknown rather than false, so that
+    neither a comparison nor its negation selects such rows.
+
+    Subclasses implement either `mask`, for conditions that are never
+    unknown, or `truth`.
+    """
+
+    def to_adql(self, alias=None):
+        """ADQL condition; columns are qualified with `alias` if given"""
+        raise NotImplementedError
+
+    def truth(self, df):
+        """Three-valued truth of the condition on rows of dict-like table `df`
+
+        Returns
+        -------
+        (true, false) : tuple of numpy.array
+            boolean masks of rows where the condition is known to be true
+            and known to be false; rows in neither are unknown
+        """
+        if type(self).mask is Predicate.mask:
+            raise NotImplementedError
+        m = np.asarray(self.mask(df), dtype=bool)
+        return m, ~m
+
+    def mask(self, df):
+        """Boolean mask of rows of dict-like table `df` satisfying the condition
+
+        Rows where the condition is unknown because of missing values are
+        not selected, as in ADQL.
+        """
+        return self.truth(df)[0]
+
+    def filter(self, df):
+        """Rows of DataFrame `df` satisfying the condition"""
+        return df[np.asarray(self.mask(df))]
+
+    def __and__(self, other):
+        return Logical("AND", self, other)
+
+    def __or__(self, other):
+        return Logical("OR", self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __bool__(self):
+        raise TypeError(
+            "Predicate has no truth value; use & and | instead of 'and' and 'or'"
+        )
+
+    def __str__(self):
+        return self.to_adql()
+
+    def __repr__(self):
+        return "{:s}({!r})".format(self.__class__.__name__, self.to_adql())
+
+
+class Compare(Predicate):
+    """Comparison of two expressions"""
+
+    _ops = {
+        "<": np.less,
+        "<=": np.less_equal,
+        ">": np.greater,
+        ">=": np.greater_equal,
+        "=": np.equal,
+        "<>": np.not_equal,
+    }
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = _as_expr(left)
+        self.right = _as_expr(right)
+
+    def to_adql(self, alias=None):
+        return "{:s} {:s} {:s}".format(
+            self.left.to_adql(alias), self.op, self.right.to_adql(alias)
+        )
+
+    def truth(self, df):
+        left, right = self.left.evaluate(df), self.right.evaluate(df)
+        known = ~(pd.isnull(np.asarray(left)) | pd.isnull(np.asarray(right)))
+        result = np.asarray(self._ops[self.op](left, right), dtype=bool)
+        return result & known, ~result & known
+
+
+class Logical(Predicate):
+    """AND or OR of two predicates"""
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def to_adql(self, alias=None):
+        return "({:s}) {:s} ({:s})".format(
+            self.left.to_adql(alias), self.op, self.right.to_adql(alias)
+        )
+
+    def truth(self, df):
+        (lt, lf), (rt, rf) = self.left.truth(df), self.right.truth(df)
+        if self.op == "AND":
+            return lt & rt, lf | rf
+        return lt | rt, lf & rf
+
+
+class Not(Predicate):
+    """Negation of a predicate; the negation of unknown is unknown"""
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def to_adql(self, alias=None):
+        return "NOT ({:s})".format(self.predicate.to_adql(alias))
+
+    def truth(self, df):
+        true, false = self.predicate.truth(df)
+        return false, true
+
+
+# Photometric quality cut on BP/RP flux excess factor
+# (Evans et al. 2018; Gaia Collaboration, Babusiaux et al. 2018, eq. C.2)
+good_phot = (col("phot_bp_rp_excess_factor") > 1 + 0.015 * col("bp_rp") ** 2) & (
+    col("phot_bp_rp_excess_factor") < 1.3 + 0.06 * col("bp_rp") ** 2
+)
+
+
+def parallax_over_error_above(threshold):
+    """Cut on parallax signal-to-noise ratio"""
+    return col("parallax") / col("parallax_error") > threshold
+
+
+def uwe_below(threshold):
+    """Cut on unit weight error computed from astrometric chi2"""
+    uwe = (col("astrometric_chi2_al") / (col("astrometric_n_good_obs_al") - 5)).sqrt()
+    return uwe < threshold
+
+
+def ruwe_below(threshold=1.4):
+    """Cut on renormalized unit weight error column 'ruwe'
+
+    For Gaia DR2, 'ruwe' is in the separate table gaiadr2.ruwe on the server
+    and is added to local data by `gapipes.pipes.add_ruwe`.
+    """
+    return col("ruwe") < threshold
@@ -1,4 +1,5 @@
 from .core import Tap, GaiaTapPlus
+from .mirror import MirroredTap
 
 gaia = GaiaTapPlus.from_url(
     "https://gea.esac.esa.int/tap-server/tap",
@@ -6,4 +7,4 @@ gaia = GaiaTapPlus.from_url(
     upload_context="Upload",
 )
 
-__all__ = ["Tap", "GaiaTapPlus", "gaia"]
+__all__ = ["Tap", "GaiaTapPlus", "MirroredTap", "gaia"]
@@ -0,0 +1,290 @@
+"""
+Helpers for inspecting and rewriting ADQL query strings
+
+These work on the plain text of simple queries of the form
+``SELECT [TOP n] ... FROM ... [WHERE ...] [ORDER BY ...]`` and do not try to
+understand nested queries.
+"""
+import re
+import numbers
+
+__all__ = [
+    "get_top",
+    "strip_order_by",
+    "count_query",
+    "add_where",
+    "healpix_source_id_range",
+    "partition_query",
+    "set_top",
+    "sample_query",
+    "stratified_sample_queries",
+    "crossmatch_query",
+]
+
+_top_re = re.compile(r"^\s*select\s+(?:distinct\s+)?top\s+(\d+)\b", re.IGNORECASE)
+_select_re = re.compile(r"^\s*select(?:\s+distinct)?\b", re.IGNORECASE)
+_order_by_re = re.compile(r"\border\s+by\b", re.IGNORECASE)
+_where_re = re.compile(r"\bwhere\b", re.IGNORECASE)
+_tail_re = re.compile(r"\b(?:group\s+by|having|order\s+by)\b", re.IGNORECASE)
+
+# fractional samples keep rows with MOD(random_index, modulus) < k
+_sample_modulus = 10**6
+
+# Gaia source_id = HEALPix level 12 (nested) index * 2^35 + running number
+_source_id_per_healpix12 = 2 ** 35
+
+
+def _strip_semicolon(query):
+    return query.strip().rstrip(";").strip()
+
+
+def get_top(query):
+    """Return the row limit of `SELECT TOP n` or None if there is none"""
+    m = _top_re.match(query)
+    return int(m.group(1)) if m else None
+
+
+def strip_order_by(query):
+    """Remove trailing ORDER BY clause from query"""
+    query = _strip_semicolon(query)
+    matches = list(_order_by_re.finditer(query))
+    if not matches:
+        return query
+    return query[: matches[-1].start()].rstrip()
+
+
+def count_query(query):
+    """Make a query that counts the number of rows `query` would return
+
+    Parameters
+    ----------
+    query : str
+        ADQL query
+
+    Returns
+    -------
+    str
+        ``SELECT COUNT(*) AS n FROM (query) AS subquery``
+    """
+    return "SELECT COUNT(*) AS n FROM ({:s}) AS subquery".format(strip_order_by(query))
+
+
+def add_where(query, condition):
+    """Add a condition to the WHERE clause of query
+
+    Parameters
+    ----------
+    query : str
+        ADQL query
+    condition : str or gapipes.cuts.Predicate
+        ADQL condition that will be AND-ed with existing conditions, if any
+
+    Returns
+    -------
+    str
+        new query
+    """
+    if hasattr(condition, "to_adql"):
+        condition = condition.to_adql()
+    query = _strip_semicolon(query)
+    tail = _tail_re.search(query)
+    tail_start = tail.start() if tail else len(query)
+    head, tail = query[:tail_start].rstrip(), query[tail_start:]
+    where = _where_re.search(head)
+    if where is None:
+        head = "{:s} WHERE {:s}".format(head, condition)
+    else:
+        head = "{:s} WHERE ({:s}) AND ({:s})".format(
+            head[: where.start()].rstrip(), condition, head[where.end() :].strip()
+        )
+    return "{:s} {:s}".format(head, tail).strip()
+
+
+def healpix_source_id_range(pixel, level):
+    """Range of Gaia source_id in a HEALPix pixel
+
+    Parameters
+    ----------
+    pixel : int
+        HEALPix index in nested scheme
+    level : int
+        HEALPix level (nside = 2**level), 0 <= level <= 12
+
+    Returns
+    -------
+    (int, int)
+        first and last source_id (inclusive) of the pixel
+    """
+    if not 0 <= level <= 12:
+        raise ValueError("`level` must be between 0 and 12")
+    n = _source_id_per_healpix12 * 4 ** (12 - level)
+    return pixel * n, (pixel + 1) * n - 1
+
+
+def partition_query(query, level=0, column="source_id"):
+    """Split query into one query per HEALPix pixel using Gaia source_id
+
+    Parameters
+    ----------
+    query : str
+        ADQL query on a table with Gaia source_id
+    level : int, optional
+        HEALPix level of partitions; there are 12 * 4**level partitions
+    column : str, optional
+        name of source_id column, qualified if necessary (e.g., 'g.source_id')
+
+    Returns
+    -------
+    list of str
+        queries that together return the same rows as `query`
+    """
+    queries = []
+    for pixel in range(12 * 4 ** level):
+        lo, hi = healpix_source_id_range(pixel, level)
+        queries.append(
+            add_where(query, "{:s} BETWEEN {:d} AND {:d}".format(column, lo, hi))
+        )
+    return queries
+
+
+def set_top(query, n):
+    """Limit query to at most `n` rows with `SELECT TOP n`
+
+    An existing smaller limit is kept.
+    """
+    query = _strip_semicolon(query)
+    top = get_top(query)
+    if top is not None:
+        if top <= n:
+            return query
+        m = _top_re.match(query)
+        return "{:s}{:d}{:s}".format(query[: m.start(1)], n, query[m.end(1) :])
+    m = _select_re.match(query)
+    if m is None:
+        raise ValueError("`query` must start with SELECT")
+    return "{:s} TOP {:d}{:s}".format(query[: m.end()], n, query[m.end() :])
+
+
+def sample_query(query, sample, column="random_index"):
+    """Rewrite query to return a random sample of its rows
+
+    Gaia tables have a column `random_index` that is a random permutation of
+    row numbers. Filtering on it gives samples that are the same every time
+    the query is run.
+
+    Parameters
+    ----------
+    query : str
+        ADQL query on a table with `column`
+    sample : float or int
+        fraction of rows (0 < sample <= 1) to keep, or number of rows.
+        A fraction adds ``MOD(random_index, 1000000) < k`` to WHERE;
+        a number of rows replaces ORDER BY with
+        ``SELECT TOP n ... ORDER BY random_index``.
+    column : str, optional
+        name of random index column, qualified if necessary
+        (e.g., 'g.random_index')
+
+    Returns
+    -------
+    str
+        new query
+    """
+    if isinstance(sample, bool) or not isinstance(sample, numbers.Real):
+        raise TypeError("`sample` must be a fraction or a number of rows")
+    if isinstance(sample, numbers.Integral):
+        if sample < 1:
+            raise ValueError("number of rows to sample must be positive")
+        query = set_top(strip_order_by(query), int(sample))
+        return "{:s} ORDER BY {:s}".format(query, column)
+    if not 0 < sample <= 1:
+        raise ValueError("fraction to sample must be in (0, 1]")
+    if sample == 1:
+        return _strip_semicolon(query)
+    k = int(round(sample * _sample_modulus))
+    return add_where(
+        query, "MOD({:s}, {:d}) < {:d}".format(column, _sample_modulus, max(k, 1))
+    )
+
+
+def stratified_sample_queries(
+    query, sample, level=0, column="random_index", source_id_column="source_id"
+):
+    """Sample rows separately in each HEALPix pixel
+
+    Parameters
+    ----------
+    query : str
+        ADQL query on a Gaia table
+    sample : float or int
+        fraction or number of rows to sample per pixel (see `sample_query`)
+    level : int, optional
+        HEALPix level of strata; there are 12 * 4**level strata
+    column, source_id_column : str, optional
+        names of random index and source_id columns
+
+    Returns
+    -------
+    list of str
+        one query per pixel
+    """
+    return partition_query(
+        sample_query(query, sample, column=column),
+        level=level,
+        column=source_id_column,
+    )
+
+
+def _qualify(columns, alias):
+    """Qualify column list (or '*') with table alias"""
+    if isinstance(columns, str):
+        columns = [c.strip() for c in columns.split(",")]
+    return ", ".join(c if "." in c else "{:s}.{:s}".format(alias, c) for c in columns)
+
+
+def crossmatch_query(
+    upload_table,
+    table="gaiadr2.gaia_source",
+    columns="*",
+    radius=None,
+    ra_column="ra",
+    dec_column="dec",
+):
+    """Make a query that finds sources within a radius of each uploaded target
+
+    The uploaded table must have columns target_idx, ra, dec [deg] and,
+    if `radius` is None, radius [deg].
+
+    Parameters
+    ----------
+    upload_table : str
+        name of the uploaded table of targets
+    table : str, optional
+        table to search
+    columns : str or list, optional
+        columns of `table` to return
+    radius : float, optional
+        search radius [deg] for all targets; None to use the radius column
+    ra_column, dec_column : str, optional
+        coordinate columns of `table`
+
+    Returns
+    -------
+    str
+        query returning target_idx, separation [deg] and `columns` of matches
+    """
+    radius = "t.radius" if radius is None else repr(float(radius))
+    point = "POINT('ICRS', g.{:s}, g.{:s})".format(ra_column, dec_column)
+    return (
+        "SELECT t.target_idx, "
+        "DISTANCE({point:s}, POINT('ICRS', t.ra, t.dec)) AS separation, "
+        "{columns:s} "
+        "FROM TAP_UPLOAD.{upload:s} AS t JOIN {table:s} AS g "
+        "ON 1 = CONTAINS({point:s}, CIRCLE('ICRS', t.ra, t.dec, {radius:s}))"
+    ).format(
+        point=point,
+        columns=_qualify(columns, "g"),
+        upload=upload_table,
+        table=table,
+        radius=radius,
+    )
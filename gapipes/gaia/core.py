@@ -1,15 +1,28 @@
 import warnings
-import io
 import logging
+import functools
 from urllib.parse import urljoin, urlparse
 import getpass
+import threading
 import requests
 from requests.exceptions import HTTPError
+import numpy as np
 import pandas as pd
-from astropy.table import Table
+from astropy.table import Table, vstack
 
 from . import utils
-from .utils import Job, parse_html_error_response, parse_votable_error_response
+from . import adql
+from .lazy import LazyGaiaFrame
+from .upload import MultipartStream, votable_tempfile
+from .utils import (
+    Deadline,
+    Job,
+    QueryError,
+    QueryTimeout,
+    parse_html_error_response,
+    parse_votable_error_response,
+    prefetch_map,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -18,10 +31,6 @@ logger = logging.getLogger(__name__)
 __all__ = ["Tap", "GaiaTapPlus"]
 
 
-class QueryError(Exception):
-    pass
-
-
 class Tap(object):
     """
     Table Acess Protocol service client
@@ -36,20 +45,58 @@ class Tap(object):
         access protocol, usually 'http' or 'https'
     port : int
         HTTP port; Default: 80 for http and 443 for https
+    threadsafe : bool, optional
+        True to give each thread its own `requests.Session` so that one Tap
+        can be shared across a pool of worker threads.
+        All sessions share one cookie jar, so logging in applies to all threads.
     """
 
     _tables = None
     _columns = None
 
-    def __init__(self, host, path, protocol="http", port=80):
+    #: queries expected to return at most this many rows are run synchronously
+    #: in `query(..., async_="auto")`
+    auto_sync_max_rows = 100000
+
+    #: maximum seconds for the COUNT(*) with which `query(..., async_="auto")`
+    #: estimates the number of rows; queries that take longer to count are
+    #: run as async jobs
+    auto_count_timeout = 10
+
+    #: object with a parse(content, format) method used to decode results,
+    #: e.g., `gapipes.gaia.parsing.ProcessPoolParser`; None to parse in-process
+    parser = None
+
+    def __init__(self, host, path, protocol="http", port=80, threadsafe=False):
         self.protocol = protocol
         self.host = host
         self.path = path
         self.port = port
-        self.session = requests.session()
+        self.threadsafe = threadsafe
+        self._session = requests.session()
+        self._local = threading.local()
+        self._lock = threading.Lock()
 
         logger.debug("TAP: {:s}".format(self.tap_endpoint))
 
+    @property
+    def session(self):
+        """`requests.Session` used for the calling thread"""
+        if not self.threadsafe:
+            return self._session
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.session()
+            session.cookies = self._session.cookies
+            session.headers = self._session.headers
+            self._local.session = session
+        return session
+
+    @session.setter
+    def session(self, value):
+        self._session = value
+        self._local = threading.local()
+
     @property
     def tap_endpoint(self):
         return urljoin("{s.protocol:s}://{s.host:s}".format(s=self), self.path)
@@ -81,48 +128,43 @@ class Tap(object):
         format : str
             the table format, e.g., 'csv'
         """
-        if format not in ["votable", "csv", "fits"]:
-            raise ValueError("format is not recognized")
-        if format == "csv":
-            return pd.read_csv(io.StringIO(response.text))
-        elif format == "votable":
-            # suppress warnings by default
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                return Table.read(io.BytesIO(response.content), format="votable")
-        elif format == "fits":
-            # TODO: this is broken but I don't know why.
-            return Table.read(io.BytesIO(response.content), format="fits")
+        return utils.parse_result_table(response.content, format)
+
+    def _parse_result(self, response, format):
+        """Parse result table with `parser` if set"""
+        if self.parser is None:
+            return Tap.parse_result_table(response, format)
+        return self.parser.parse(response.content, format)
+
+    def _load_tableset(self):
+        """Fetch and cache table metadata once, even when called from many threads"""
+        if self._tables is None:
+            with self._lock:
+                # check again: another thread may have fetched while we waited
+                if self._tables is None:
+                    response = self.session.get(
+                        "{s.tap_endpoint}/tables".format(s=self)
+                    )
+                    response.raise_for_status()
+                    tables, columns = Tap.parse_tableset(response.text)
+                    self._columns = columns
+                    self._tables = tables
 
     @property
     def tables(self):
         """
         List of available tables
         """
-        if self._tables is None:
-            response = self.session.get("{s.tap_endpoint}/tables".format(s=self))
-            if not response.raise_for_status():
-                tables, columns = Tap.parse_tableset(response.text)
-                self._tables = tables
-                self._columns = columns
-                return tables
-        else:
-            return self._tables
+        self._load_tableset()
+        return self._tables
 
     @property
     def columns(self):
         """
         List of columns for all tables
         """
-        if self._tables is None:
-            response = self.session.get("{s.tap_endpoint}/tables".format(s=self))
-            if not response.raise_for_status():
-                tables, columns = Tap.parse_tableset(response.text)
-                self._tables = tables
-                self._columns = columns
-                return columns
-        else:
-            return self._columns
+        self._load_tableset()
+        return self._columns
 
     def _post_query(
         self,
@@ -133,9 +175,14 @@ class Tap(object):
         output_format="csv",
         autorun=True,
         async_=False,
+        compress_upload=False,
+        timeout=None,
     ):
         """POST synchronous or asynchronos query to Tap server
 
+        Uploads are streamed from disk; tables are first written to a
+        temporary VOTable file. `timeout` [s] is passed to `requests`.
+
         Returns unchecked requests.Response
         """
         if "select" not in query.lower():
@@ -157,7 +204,7 @@ class Tap(object):
         logger.debug(args)
 
         if upload_resource is None:
-            response = self.session.post(url, data=args)
+            response = self.session.post(url, data=args, timeout=timeout)
         else:
             if upload_table_name is None:
                 raise ValueError(
@@ -165,24 +212,55 @@ class Tap(object):
                 )
             # UPLOAD should be '[table_name],param:form_key'
             args["UPLOAD"] = "{0:s},param:{0:s}".format(upload_table_name)
-            if isinstance(upload_resource, pd.DataFrame):
-                with io.BytesIO() as f:
-                    Table.from_pandas(upload_resource).write(f, format="votable")
-                    f.seek(0)
-                    chunk = f.read()
-            elif isinstance(upload_resource, Table):
-                with io.BytesIO() as f:
-                    upload_resource.write(f, format="votable")
-                    f.seek(0)
-                    chunk = f.read()
-            else:
-                with open(upload_resource, "r") as f:
-                    chunk = f.read()
-            files = {upload_table_name: chunk}
-            response = self.session.post(url, data=args, files=files)
+            response = self._post_multipart(
+                url,
+                args,
+                upload_table_name,
+                upload_resource,
+                compress=compress_upload,
+                timeout=timeout,
+            )
 
         return response
 
+    def _post_multipart(
+        self, url, args, key, upload_resource, compress=False, timeout=None
+    ):
+        """POST form `args` with `upload_resource` streamed as file part `key`
+
+        Parameters
+        ----------
+        url : str
+            url to POST to
+        args : dict
+            form fields
+        key : str
+            form key of the file part
+        upload_resource : object
+            content of the file part: pandas.DataFrame, astropy.table.Table,
+            path, bytes, binary file object or iterable of bytes
+        compress : bool, optional
+            True to gzip the file part
+        timeout : float, optional
+            HTTP timeout [s]
+
+        Returns unchecked requests.Response
+        """
+        if isinstance(upload_resource, (pd.DataFrame, Table)):
+            with votable_tempfile(upload_resource) as f:
+                return self._post_multipart(
+                    url, args, key, f, compress=compress, timeout=timeout
+                )
+        body = MultipartStream(
+            fields=args, files={key: upload_resource}, compress=compress
+        )
+        return self.session.post(
+            url,
+            data=body,
+            headers={"Content-Type": body.content_type},
+            timeout=timeout,
+        )
+
     def query(
         self,
         query,
@@ -191,6 +269,10 @@ class Tap(object):
         upload_table_name=None,
         output_format="csv",
         async_=False,
+        compress_upload=False,
+        sample=None,
+        stratify=None,
+        timeout=None,
     ):
         """Send query to TAP server
 
@@ -201,19 +283,49 @@ class Tap(object):
         name : str, optional
             job name
         upload_resource: path to votable file or pandas.DataFrame or astropy.table.Table
-            table to upload
+            table to upload; files are read in binary mode and streamed
         upload_table_name: str
             upload table name
         output_format : str
             one of 'votable', 'votable_plain', 'csv', 'json' or 'fits'
-        async_ : bool
-            True to launch an asynchronous job
+        compress_upload : bool, optional
+            True to gzip the uploaded table while sending it
+            (the server must accept compressed uploads)
+        async_ : bool or 'auto'
+            True to launch an asynchronous job.
+            'auto' to choose between synchronous and asynchronous execution
+            from the expected number of rows (see `estimate_rows`) and to
+            resubmit as an asynchronous job if the synchronous query times out.
+            Rows are counted only for queries without TOP and upload, and for
+            at most `auto_count_timeout` seconds; queries with an upload and
+            without TOP run as asynchronous jobs.
+        sample : float or int, optional
+            fraction (0 < sample <= 1) or number of rows to return as a random
+            sample, selected on the server with the `random_index` column
+            (see `gapipes.gaia.adql.sample_query`).
+            Samples are the same every time the query is run.
+        stratify : int, optional
+            HEALPix level at which to sample each pixel separately, e.g.,
+            `sample=100, stratify=2` returns up to 100 rows per level-2 pixel.
+            Pixels are queried one by one with `async_='auto'` and the
+            concatenated table is returned.
+        timeout : float, optional
+            maximum number of seconds for the query. For synchronous and 'auto'
+            queries, this covers everything up to the parsed result; a job
+            still running when it expires is aborted on the server.
+            For asynchronous queries, it applies to submitting the job only;
+            pass `timeout` to `Job.get_result` as well.
+
+        Raises
+        ------
+        QueryTimeout
+            if the query did not finish within `timeout`
 
         Returns
         -------
         The return type depends on whether you launch a synchronous or asynchronous query.
 
-        For synchronous queries:
+        For synchronous and 'auto' queries:
         table : pd.DataFrame or astropy.table.Table
             Query result
         
@@ -221,19 +333,27 @@ class Tap(object):
         job : Job instance
             use `job.get_result()` to retrieve query result
         """
-        r = self._post_query(
-            query,
+        kwargs = dict(
             name=name,
             upload_resource=upload_resource,
             upload_table_name=upload_table_name,
             output_format=output_format,
-            async_=async_,
+            compress_upload=compress_upload,
+            timeout=timeout,
         )
+        if sample is not None:
+            return self._query_sample(query, sample, stratify, async_, **kwargs)
+        if async_ == "auto":
+            return self._query_auto(query, **kwargs)
+        try:
+            r = self._post_query(query, async_=async_, **kwargs)
+        except requests.exceptions.Timeout as e:
+            raise QueryTimeout("No response within {} s".format(timeout)) from e
         try:
             r.raise_for_status()
             if not async_:
                 if r.text:
-                    return Tap.parse_result_table(r, output_format)
+                    return self._parse_result(r, output_format)
                 else:
                     # NOTE: GaiaArchive has an upstream bug that nothing is returned
                     #       when synchronous queries time out (30 seconds).
@@ -243,11 +363,130 @@ class Tap(object):
             else:
                 # NOTE: The first response is 303 redirect to Job location
                 # Job location is in the header of redirect response
-                return Job.from_response(r, session=self.session)
+                return Job.from_response(r, session=self.session, parser=self.parser)
         except HTTPError as e:
             message = parse_votable_error_response(r)
             raise HTTPError(message) from e
 
+    def iter_query(self, queries, max_workers=2, read_ahead=2, **kwargs):
+        """Iterate over results of many queries while prefetching the next ones
+
+        Results are downloaded and parsed in background threads while the
+        caller processes the current one. This is meant for partitioned or
+        paginated pulls (see `gapipes.gaia.adql.partition_query`).
+
+        Parameters
+        ----------
+        queries : iterable of str
+            queries to run
+        max_workers : int, optional
+            number of queries to run at the same time
+        read_ahead : int, optional
+            maximum number of results fetched ahead of the one being consumed;
+            this bounds memory use to `read_ahead` + 1 results
+        **kwargs
+            passed to `query` for each query; `async_` defaults to 'auto'
+            so that each result is a table
+
+        Yields
+        ------
+        table : pd.DataFrame or astropy.table.Table
+            result of each query in the order of `queries`
+        """
+        if max_workers > 1 and not self.threadsafe:
+            warnings.warn(
+                "Running queries from several threads on a shared session; "
+                "consider creating Tap with threadsafe=True."
+            )
+        kwargs.setdefault("async_", "auto")
+        return prefetch_map(
+            functools.partial(self.query, **kwargs),
+            queries,
+            max_workers=max_workers,
+            read_ahead=read_ahead,
+        )
+
+    def estimate_rows(
+        self, query, upload_resource=None, upload_table_name=None, timeout=None
+    ):
+        """Estimate the number of rows a query will return
+
+        The row limit of `SELECT TOP n` is used if present. Otherwise,
+        a synchronous ``COUNT(*)`` of the query is sent to the server.
+
+        Parameters
+        ----------
+        query : str
+            ADQL query
+        upload_resource, upload_table_name : optional
+            table to upload, as in `query`
+        timeout : float, optional
+            maximum number of seconds for counting
+
+        Returns
+        -------
+        int or None
+            number of rows, None if the count itself failed or timed out
+        """
+        top = adql.get_top(query)
+        if top is not None:
+            return top
+        try:
+            r = self.query(
+                adql.count_query(query),
+                upload_resource=upload_resource,
+                upload_table_name=upload_table_name,
+                timeout=timeout,
+            )
+        except (QueryError, HTTPError) as e:
+            logger.debug("Counting rows failed: {}".format(e))
+            return None
+        return int(r.iloc[0, 0])
+
+    def _query_auto(self, query, **kwargs):
+        """Run query synchronously if it is small, otherwise as an async job"""
+        if "select" not in query.lower():
+            with open(query, "r") as f:
+                query = f.read()
+        deadline = Deadline(kwargs.pop("timeout", None))
+        nrows = adql.get_top(query)
+        # counting with an upload would send the table twice
+        if nrows is None and kwargs["upload_resource"] is None:
+            timeout, left = self.auto_count_timeout, deadline.remaining()
+            if left is not None:
+                timeout = min(timeout, left)
+            nrows = self.estimate_rows(query, timeout=timeout)
+        logger.debug("Expected number of rows: {}".format(nrows))
+        if nrows is not None and nrows <= self.auto_sync_max_rows:
+            try:
+                return self.query(
+                    query, async_=False, timeout=deadline.remaining(), **kwargs
+                )
+            except QueryError:
+                logger.info("Synchronous query timed out; resubmitting as async job")
+        job = self.query(query, async_=True, timeout=deadline.remaining(), **kwargs)
+        return job.get_result(timeout=deadline.left)
+
+    def _query_sample(self, query, sample, stratify, async_, **kwargs):
+        """Run query on a random sample of rows"""
+        if "select" not in query.lower():
+            with open(query, "r") as f:
+                query = f.read()
+        if stratify is None:
+            return self.query(adql.sample_query(query, sample), async_=async_, **kwargs)
+        queries = adql.stratified_sample_queries(query, sample, level=stratify)
+        deadline = Deadline(kwargs.pop("timeout", None))
+
+        def query_pixel(q):
+            return self.query(q, async_="auto", timeout=deadline.remaining(), **kwargs)
+
+        results = list(
+            prefetch_map(query_pixel, queries, max_workers=4 if self.threadsafe else 1)
+        )
+        if isinstance(results[0], pd.DataFrame):
+            return pd.concat(results, ignore_index=True)
+        return vstack(results)
+
     @classmethod
     def from_url(cls, url, **kwargs):
         """
@@ -283,6 +522,8 @@ class GaiaTapPlus(Tap):
         server context
     upload_context : str, optional, default None
         upload context
+    threadsafe : bool, optional
+        True to use one session per thread (see `Tap`)
     """
 
     def __init__(
@@ -293,9 +534,12 @@ class GaiaTapPlus(Tap):
         port=80,
         server_context=None,
         upload_context=None,
+        threadsafe=False,
     ):
 
-        super(GaiaTapPlus, self).__init__(host, path, protocol=protocol, port=port)
+        super(GaiaTapPlus, self).__init__(
+            host, path, protocol=protocol, port=port, threadsafe=threadsafe
+        )
 
         if not all([v is not None for v in [server_context, upload_context]]):
             raise ValueError(
@@ -412,10 +656,14 @@ class GaiaTapPlus(Tap):
             raise HTTPError(message) from e
 
     # TODO: doument all options of upload_resource better.
-    # TODO: make it flexible to handle pandas.DataFrame seamlessly.
     # TODO: test all options of upload_resource works.
     def upload_table(
-        self, upload_resource, table_name, table_description="", format="votable"
+        self,
+        upload_resource,
+        table_name,
+        table_description="",
+        format="votable",
+        compress=False,
     ):
         """
         Upload a table to the user private space
@@ -423,7 +671,8 @@ class GaiaTapPlus(Tap):
         Parameters
         ----------
         upload_resource : object
-            table to be uploaded: pyTable, file or URL.
+            table to be uploaded: pyTable, pandas.DataFrame, file or URL.
+            Files are read in binary mode and streamed from disk.
         table_name: str
             table name associated to the uploaded resource
         table_description: str, optional
@@ -431,6 +680,8 @@ class GaiaTapPlus(Tap):
         format : str, optional
             resource format
             Available formats: 'VOTable', 'CSV' and 'ASCII'
+        compress : bool, optional
+            True to gzip the file while sending it
         """
         url = "{s.baseurl:s}/{s._upload_context}".format(s=self)
         # url = "https://gea.esac.esa.int/tap-server/Upload"
@@ -440,21 +691,14 @@ class GaiaTapPlus(Tap):
             "TABLE_DESC": table_description,
             "FORMAT": format,
         }
-        if isinstance(upload_resource, Table):
-            with io.BytesIO() as f:
-                upload_resource.write(f, format="votable")
-                f.seek(0)
-                chunk = f.read()
-                args["FORMAT"] = "votable"
-                files = dict(FILE=chunk)
-        elif upload_resource.startswith("http"):
-            files = None
+        if isinstance(upload_resource, (pd.DataFrame, Table)):
+            args["FORMAT"] = "votable"
+            r = self._post_multipart(url, args, "FILE", upload_resource, compress)
+        elif isinstance(upload_resource, str) and upload_resource.startswith("http"):
             args["URL"] = upload_resource
+            r = self.session.post(url, data=args)
         else:
-            with open(upload_resource, "r") as f:
-                chunk = f.read()
-            files = dict(FILE=chunk)
-        r = self.session.post(url, data=args, files=files)
+            r = self._post_multipart(url, args, "FILE", upload_resource, compress)
         try:
             r.raise_for_status()
             return r.text.strip()
@@ -531,7 +775,9 @@ class GaiaTapPlus(Tap):
             message = parse_html_error_response(r.text)
             raise HTTPError(message) from e
 
-    def query_sourceid(self, table, source_id_column="source_id", columns="*"):
+    def query_sourceid(
+        self, table, source_id_column="source_id", columns="*", lazy=False
+    ):
         """Query Gaia DR2 gaia_source table for a given list of "source_id"s.
 
         Parameters
@@ -543,7 +789,12 @@ class GaiaTapPlus(Tap):
         columns : list, optional
             List of columns to retrieve
             (the default is '*', which will get all columns)
+        lazy : bool, optional
+            True to return a `LazyGaiaFrame` that fetches columns when they
+            are first accessed; `columns` is ignored.
         """
+        if lazy:
+            return LazyGaiaFrame(self, table[source_id_column])
 
         q = """SELECT {columns} FROM TAP_UPLOAD.table as t JOIN gaiadr2.gaia_source
         ON gaiadr2.gaia_source.source_id = t.{source_id_column}""".format(
@@ -551,3 +802,78 @@ class GaiaTapPlus(Tap):
         )
         r = self.query(str(q), upload_resource=table, upload_table_name="table")
         return r
+
+    def cone_search(
+        self,
+        ra,
+        dec,
+        radius,
+        table="gaiadr2.gaia_source",
+        columns="*",
+        batch_size=50000,
+        timeout=None,
+    ):
+        """Search for sources around many positions at once
+
+        Target positions (and radii) are uploaded and matched with a single
+        ``CONTAINS(POINT, CIRCLE)`` join per batch of `batch_size` targets,
+        run as asynchronous jobs.
+
+        Parameters
+        ----------
+        ra, dec : array-like
+            coordinates of targets [deg]
+        radius : float or array-like
+            search radius [deg], one for all or one per target
+        table : str, optional
+            table to search
+        columns : str or list, optional
+            columns of `table` to return
+            (the default is '*', which will get all columns)
+        batch_size : int, optional
+            maximum number of targets uploaded per query
+        timeout : float, optional
+            maximum number of seconds for all batches
+
+        Returns
+        -------
+        pandas.DataFrame
+            matched sources with 'target_idx', the index of the target in the
+            input arrays, and 'separation' [deg] from the target
+        """
+        ra, dec = np.atleast_1d(ra).astype(float), np.atleast_1d(dec).astype(float)
+        if ra.shape != dec.shape:
+            raise ValueError("`ra` and `dec` must have the same shape")
+        targets = pd.DataFrame(
+            {"target_idx": np.arange(len(ra), dtype=np.int64), "ra": ra, "dec": dec}
+        )
+        if np.ndim(radius) == 0:
+            q = adql.crossmatch_query("targets", table, columns, radius=radius)
+        else:
+            targets["radius"] = np.broadcast_to(np.asarray(radius, float), ra.shape)
+            q = adql.crossmatch_query("targets", table, columns)
+
+        deadline = Deadline(timeout)
+        results = []
+        for start in range(0, len(targets), batch_size):
+            batch = targets.iloc[start : start + batch_size]
+            job = self.query(
+                q,
+                upload_resource=batch,
+                upload_table_name="targets",
+                async_=True,
+                timeout=deadline.remaining(),
+            )
+            results.append(job.get_result(timeout=deadline.left))
+            logger.debug(
+                "cone search batch {:d}: {:d} matches".format(start, len(results[-1]))
+            )
+        if not results:
+            # no targets
+            return pd.DataFrame(
+                {
+                    "target_idx": np.array([], dtype=np.int64),
+                    "separation": np.array([], dtype=float),
+                }
+            )
+        return pd.concat(results, ignore_index=True)
@@ -0,0 +1,217 @@
+"""
+Bulk retrieval of DataLink products (epoch photometry, spectra, ...)
+"""
+import os
+import re
+import hashlib
+import logging
+import zipfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from .utils import parse_result_table
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["DataLinkRetriever", "DataLinkProducts"]
+
+GAIA_DATALINK_URL = "https://gea.esac.esa.int/data-server/data"
+
+_extensions = {"votable": "xml", "csv": "csv", "fits": "fits"}
+
+
+def _is_zip(response):
+    content_type = response.headers.get("Content-Type", "")
+    disposition = response.headers.get("Content-Disposition", "")
+    return "zip" in content_type or ".zip" in disposition
+
+
+class DataLinkRetriever(object):
+    """Download DataLink products for many sources
+
+    Source ids are sent in batches of `batch_size` per request and batches are
+    downloaded concurrently. Responses are streamed to files in `output_dir`,
+    one file per batch; batches whose file exists are not downloaded again.
+
+    Parameters
+    ----------
+    tap : Tap
+        client whose session (and login) is used;
+        use ``threadsafe=True`` when `max_workers` > 1
+    output_dir : str
+        directory to save products to
+    retrieval_type : str, optional
+        type of product, e.g., 'EPOCH_PHOTOMETRY'
+    release : str, optional
+        prefix of source ids in requests, e.g., 'Gaia DR2'
+    format : str, optional
+        format of products, one of 'votable', 'csv', 'fits'
+    url : str, optional
+        DataLink data service
+    batch_size : int, optional
+        maximum number of source ids per request
+    max_workers : int, optional
+        number of concurrent downloads
+    timeout : float, optional
+        HTTP timeout [s] of each request
+
+    Examples
+    --------
+    >>> from gapipes.gaia import gaia
+    >>> products = DataLinkRetriever(gaia, "epoch/").retrieve(df["source_id"])
+    >>> products[df["source_id"][0]]  # read from disk when accessed
+    """
+
+    def __init__(
+        self,
+        tap,
+        output_dir,
+        retrieval_type="EPOCH_PHOTOMETRY",
+        release="Gaia DR2",
+        format="votable",
+        url=GAIA_DATALINK_URL,
+        batch_size=100,
+        max_workers=4,
+        timeout=None,
+    ):
+        if format not in _extensions:
+            raise ValueError("`format` must be one of {}".format(list(_extensions)))
+        if max_workers > 1 and not tap.threadsafe:
+            warnings.warn(
+                "Downloading from several threads on a shared session; "
+                "consider creating Tap with threadsafe=True."
+            )
+        self.tap = tap
+        self.output_dir = output_dir
+        self.retrieval_type = retrieval_type
+        self.release = release
+        self.format = format
+        self.url = url
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+    def _batch_paths(self, ids):
+        """Possible paths of the file of a batch (zip or single file)
+
+        Files are named after a hash of the release and the sorted source ids,
+        so that a file is reused only for the same request.
+        """
+        key = "{:s}:{:s}".format(self.release, ",".join(map(str, sorted(ids))))
+        name = "{:s}_{:s}_{:s}".format(
+            self.retrieval_type,
+            self.format,
+            hashlib.sha1(key.encode()).hexdigest()[:16],
+        )
+        stem = os.path.join(self.output_dir, name)
+        return stem + ".zip", stem + "." + _extensions[self.format]
+
+    def _download(self, ids):
+        """Download products of a batch of source ids and return the path"""
+        for path in self._batch_paths(ids):
+            if os.path.exists(path):
+                return path
+        args = {
+            "ID": ",".join("{:s} {:d}".format(self.release, i) for i in ids),
+            "RETRIEVAL_TYPE": self.retrieval_type,
+            "FORMAT": self.format,
+            "VALID_DATA": "true",
+        }
+        with self.tap.session.post(
+            self.url, data=args, stream=True, timeout=self.timeout
+        ) as r:
+            r.raise_for_status()
+            zip_path, single_path = self._batch_paths(ids)
+            path = zip_path if _is_zip(r) else single_path
+            # write to a temporary file and rename so that interrupted
+            # downloads are not mistaken for finished ones
+            tmp = path + ".part"
+            with open(tmp, "wb") as f:
+                for chunk in r.iter_content(chunk_size=2**16):
+                    f.write(chunk)
+        os.replace(tmp, path)
+        logger.debug("{:d} sources: {:s}".format(len(ids), path))
+        return path
+
+    def retrieve(self, source_ids):
+        """Download products of all sources
+
+        Parameters
+        ----------
+        source_ids : array-like
+            Gaia source ids
+
+        Returns
+        -------
+        DataLinkProducts
+            products of each source, read from disk when accessed
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        ids = [int(i) for i in dict.fromkeys(np.asarray(source_ids, dtype=np.int64))]
+        batches = [
+            ids[start : start + self.batch_size]
+            for start in range(0, len(ids), self.batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            paths = list(pool.map(self._download, batches))
+        return DataLinkProducts(list(zip(batches, paths)), self.format)
+
+
+class DataLinkProducts(object):
+    """Downloaded DataLink products, parsed when accessed by source id
+
+    Parameters
+    ----------
+    batches : list of (list of int, str)
+        source ids and path to the file with their products
+    format : str
+        format of products, one of 'votable', 'csv', 'fits'
+    """
+
+    def __init__(self, batches, format):
+        self.format = format
+        self.paths = [path for _, path in batches]
+        self._path_of = {i: path for ids, path in batches for i in ids}
+        self._cache = (None, None)
+
+    def keys(self):
+        return list(self._path_of)
+
+    def __len__(self):
+        return len(self._path_of)
+
+    def __contains__(self, source_id):
+        return source_id in self._path_of
+
+    def __iter__(self):
+        return iter(self._path_of)
+
+    def items(self):
+        """Iterate over (source_id, product) pairs"""
+        for source_id in self._path_of:
+            yield source_id, self[source_id]
+
+    def __getitem__(self, source_id):
+        """Product of a source, or None if the service returned nothing for it"""
+        path = self._path_of[source_id]
+        if os.path.getsize(path) == 0:
+            return None
+        if zipfile.is_zipfile(path):
+            pattern = re.compile(r"(?<!\d){:d}(?!\d)".format(source_id))
+            with zipfile.ZipFile(path) as z:
+                for name in z.namelist():
+                    if pattern.search(os.path.basename(name)):
+                        return parse_result_table(z.read(name), self.format)
+            return None
+        # products of all sources of a batch in one table
+        if self._cache[0] != path:
+            with open(path, "rb") as f:
+                self._cache = (path, parse_result_table(f.read(), self.format))
+        table = self._cache[1]
+        return table[np.asarray(table["source_id"]) == source_id]
+
+    def __repr__(self):
+        return "<{:s} of {:d} sources in {:d} files>".format(
+            self.__class__.__name__, len(self), len(self.paths)
+        )
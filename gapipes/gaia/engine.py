@@ -0,0 +1,814 @@
+"""
+Run a subset of ADQL on local tables
+
+Supported are queries of the form::
+
+    SELECT [DISTINCT] [TOP n] items
+    FROM table [AS] alias [[INNER | LEFT] JOIN table [AS] alias ON a.col = b.col]
+    [WHERE condition]
+    [ORDER BY expr [ASC | DESC], ...]
+
+with arithmetic, comparisons, BETWEEN, IS [NOT] NULL, AND/OR/NOT, common
+mathematical functions, ``CONTAINS(POINT(...), CIRCLE(...))`` and
+``DISTANCE(POINT(...), POINT(...))``. Expressions are built from the classes of
+`gapipes.cuts`, so conditions are evaluated vectorised with numpy.
+Aggregates, GROUP BY and subqueries are not supported.
+"""
+import re
+import logging
+import numpy as np
+import pandas as pd
+
+from .. import cuts
+from . import healpix
+from .store import LocalStore
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["LocalEngine", "parse", "UnsupportedQuery"]
+
+
+class UnsupportedQuery(Exception):
+    """Query that cannot run locally, e.g., because of unsupported ADQL"""
+
+
+_token_re = re.compile(
+    r"\s*(?:"
+    r"(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)"
+    r"|(?P<string>'(?:[^']|'')*')"
+    r"|(?P<name>[A-Za-z_][A-Za-z0-9_]*|\"[^\"]+\")"
+    r"|(?P<op><=|>=|<>|!=|[=<>+\-*/(),.;])"
+    r")"
+)
+
+_keywords = {
+    "select",
+    "distinct",
+    "top",
+    "from",
+    "as",
+    "join",
+    "inner",
+    "left",
+    "outer",
+    "on",
+    "where",
+    "and",
+    "or",
+    "not",
+    "between",
+    "is",
+    "null",
+    "order",
+    "by",
+    "asc",
+    "desc",
+}
+
+
+def _tokenize(query):
+    tokens = []
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        m = _token_re.match(query, pos)
+        if m is None or m.end() == pos:
+            raise ValueError("Cannot parse query at: {!r}".format(query[pos:][:20]))
+        pos = m.end()
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "name" and value.startswith('"'):
+            value = value[1:-1]
+        elif kind == "name" and value.lower() in _keywords:
+            kind, value = "keyword", value.lower()
+        tokens.append((kind, value))
+    return tokens
+
+
+class Ref(cuts.Col):
+    """Column reference, possibly qualified with a table alias
+
+    The reference is resolved against the columns of the joined table,
+    which are named 'alias.column'.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+        super(Ref, self).__init__(".".join(parts))
+
+    @property
+    def column(self):
+        return self.parts[-1]
+
+    @property
+    def alias(self):
+        return ".".join(self.parts[:-1]) if len(self.parts) > 1 else None
+
+    def evaluate(self, df):
+        if self.alias is not None:
+            return df["{:s}.{:s}".format(self.alias, self.column)]
+        matches = [c for c in df.columns if c.split(".")[-1] == self.column]
+        if len(matches) != 1:
+            raise KeyError(
+                "Column {!r} is {:s}".format(
+                    self.column, "ambiguous" if matches else "not found"
+                )
+            )
+        return df[matches[0]]
+
+
+class _Func(cuts.Func):
+    """Mathematical function of one argument"""
+
+    _funcs = dict(
+        cuts.Func._funcs,
+        EXP=np.exp,
+        LOG=np.log,
+        SIN=np.sin,
+        COS=np.cos,
+        TAN=np.tan,
+        ASIN=np.arcsin,
+        ACOS=np.arccos,
+        ATAN=np.arctan,
+        RADIANS=np.deg2rad,
+        DEGREES=np.rad2deg,
+        FLOOR=np.floor,
+        CEILING=np.ceil,
+    )
+
+
+class _Func2(cuts.Expr):
+    """Mathematical function of two arguments"""
+
+    _funcs = {"ATAN2": np.arctan2, "MOD": np.mod, "POWER": np.power}
+
+    def __init__(self, name, left, right):
+        self.name = name
+        self.left = cuts._as_expr(left)
+        self.right = cuts._as_expr(right)
+
+    def to_adql(self, alias=None):
+        return "{:s}({:s}, {:s})".format(
+            self.name, self.left.to_adql(alias), self.right.to_adql(alias)
+        )
+
+    def evaluate(self, df):
+        return self._funcs[self.name](self.left.evaluate(df), self.right.evaluate(df))
+
+
+class IsNull(cuts.Predicate):
+    """True where expression is missing"""
+
+    def __init__(self, expr):
+        self.expr = expr
+
+    def to_adql(self, alias=None):
+        return "{:s} IS NULL".format(self.expr.to_adql(alias))
+
+    def mask(self, df):
+        return pd.isnull(np.asarray(self.expr.evaluate(df)))
+
+
+class Point(object):
+    """POINT('ICRS', ra, dec)"""
+
+    def __init__(self, ra, dec):
+        self.ra, self.dec = ra, dec
+
+    def to_adql(self, alias=None):
+        return "POINT('ICRS', {:s}, {:s})".format(
+            self.ra.to_adql(alias), self.dec.to_adql(alias)
+        )
+
+
+class Circle(object):
+    """CIRCLE('ICRS', ra, dec, radius)"""
+
+    def __init__(self, ra, dec, radius):
+        self.ra, self.dec, self.radius = ra, dec, radius
+
+    def to_adql(self, alias=None):
+        return "CIRCLE('ICRS', {:s}, {:s}, {:s})".format(
+            self.ra.to_adql(alias), self.dec.to_adql(alias), self.radius.to_adql(alias)
+        )
+
+
+class Distance(cuts.Expr):
+    """DISTANCE(point, point) [deg]"""
+
+    def __init__(self, p1, p2):
+        self.p1, self.p2 = p1, p2
+
+    def to_adql(self, alias=None):
+        return "DISTANCE({:s}, {:s})".format(
+            self.p1.to_adql(alias), self.p2.to_adql(alias)
+        )
+
+    def evaluate(self, df):
+        return healpix.separation(
+            self.p1.ra.evaluate(df),
+            self.p1.dec.evaluate(df),
+            self.p2.ra.evaluate(df),
+            self.p2.dec.evaluate(df),
+        )
+
+
+class Contains(cuts.Predicate):
+    """1 = CONTAINS(point, circle)"""
+
+    def __init__(self, point, circle):
+        self.point, self.circle = point, circle
+
+    def to_adql(self, alias=None):
+        return "1 = CONTAINS({:s}, {:s})".format(
+            self.point.to_adql(alias), self.circle.to_adql(alias)
+        )
+
+    def truth(self, df):
+        d = Distance(self.point, Point(self.circle.ra, self.circle.dec)).evaluate(df)
+        result = np.asarray(d <= self.circle.radius.evaluate(df))
+        # unknown for missing positions
+        known = ~pd.isnull(np.asarray(d))
+        return result & known, ~result & known
+
+
+class _ContainsValue(cuts.Expr):
+    """CONTAINS(point, circle) before it is compared with 1 or 0"""
+
+    def __init__(self, contains):
+        self.contains = contains
+
+    def to_adql(self, alias=None):
+        return self.contains.to_adql(alias)[len("1 = ") :]
+
+    def evaluate(self, df):
+        return self.contains.mask(df).astype(int)
+
+
+class Query(object):
+    """Parsed query
+
+    Attributes
+    ----------
+    items : list of (expr, name)
+        selected expressions and output names; expr is None for '*' and
+        a str alias for 'alias.*'
+    tables : list of (table name, alias)
+    join : tuple or None
+        (how, left Ref, right Ref) of the join condition
+    where : cuts.Predicate or None
+    order_by : list of (expr, ascending)
+    top : int or None
+    distinct : bool
+    refs : list of Ref
+        column references in SELECT, JOIN and WHERE
+    order_refs : list of Ref
+        column references in ORDER BY, which may also be output names
+    """
+
+    def __init__(self):
+        self.items = []
+        self.tables = []
+        self.join = None
+        self.where = None
+        self.order_by = []
+        self.top = None
+        self.distinct = False
+        self.refs = []
+        self.order_refs = []
+
+
+class _Parser(object):
+    def __init__(self, query):
+        self.tokens = _tokenize(query)
+        self.pos = 0
+        self.query = Query()
+        self.refs = self.query.refs
+
+    def peek(self, offset=0):
+        i = self.pos + offset
+        return self.tokens[i] if i < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def accept(self, value, kind=None):
+        token_kind, token_value = self.peek()
+        if token_value == value and (kind is None or token_kind == kind):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, value):
+        if not self.accept(value):
+            raise ValueError(
+                "Expected {!r} but found {!r}".format(value, self.peek()[1])
+            )
+
+    def parse(self):
+        q = self.query
+        self.expect("select")
+        q.distinct = self.accept("distinct", "keyword")
+        if self.accept("top", "keyword"):
+            kind, value = self.next()
+            q.top = int(value)
+        q.items = self.select_items()
+        self.expect("from")
+        q.tables.append(self.table())
+        how = None
+        if self.accept("inner", "keyword"):
+            how = "inner"
+        elif self.accept("left", "keyword"):
+            self.accept("outer", "keyword")
+            how = "left"
+        if self.accept("join", "keyword"):
+            q.tables.append(self.table())
+            self.expect("on")
+            left = self.ref()
+            self.expect("=")
+            right = self.ref()
+            if left.alias is None or right.alias is None:
+                raise ValueError("Columns in JOIN ... ON must be qualified")
+            q.join = (how or "inner", left, right)
+        elif how is not None:
+            raise ValueError("Expected JOIN")
+        if self.accept("where", "keyword"):
+            q.where = self.condition()
+        if self.accept("order", "keyword"):
+            self.expect("by")
+            self.refs = q.order_refs
+            while True:
+                expr = self.arith()
+                ascending = not self.accept("desc", "keyword")
+                self.accept("asc", "keyword")
+                q.order_by.append((expr, ascending))
+                if not self.accept(","):
+                    break
+        self.accept(";")
+        if self.peek()[0] is not None:
+            raise UnsupportedQuery("Unsupported ADQL at {!r}".format(self.peek()[1]))
+        return q
+
+    def select_items(self):
+        items = []
+        while True:
+            if self.accept("*"):
+                items.append((None, None))
+            elif self.peek(1)[1] == "." and self.peek(2)[1] == "*":
+                alias = self.next()[1]
+                self.pos += 2
+                items.append((alias, None))
+            else:
+                expr = self.arith()
+                name = None
+                if self.accept("as", "keyword"):
+                    name = self.next()[1]
+                elif self.peek()[0] == "name":
+                    name = self.next()[1]
+                items.append((expr, name))
+            if not self.accept(","):
+                return items
+
+    def qualified_name(self):
+        kind, value = self.next()
+        if kind != "name":
+            raise ValueError("Expected a name but found {!r}".format(value))
+        parts = [value]
+        while self.peek()[1] == "." and self.peek(1)[0] == "name":
+            self.pos += 1
+            parts.append(self.next()[1])
+        return parts
+
+    def table(self):
+        name = ".".join(self.qualified_name())
+        alias = name
+        if self.accept("as", "keyword") or self.peek()[0] == "name":
+            alias = self.next()[1]
+        return name, alias
+
+    def ref(self):
+        ref = Ref(self.qualified_name())
+        self.refs.append(ref)
+        return ref
+
+    def condition(self):
+        left = self.conjunction()
+        while self.accept("or", "keyword"):
+            left = cuts.Logical("OR", left, self.conjunction())
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.accept("and", "keyword"):
+            left = cuts.Logical("AND", left, self.negation())
+        return left
+
+    def negation(self):
+        if self.accept("not", "keyword"):
+            return cuts.Not(self.negation())
+        return self.predicate()
+
+    def predicate(self):
+        left = self.arith()
+        if isinstance(left, cuts.Predicate):
+            return left
+        kind, op = self.peek()
+        if op in ("=", "<>", "!=", "<", "<=", ">", ">="):
+            self.pos += 1
+            right = self.arith()
+            op = "<>" if op == "!=" else op
+            contains = _contains_comparison(op, left, right)
+            if contains is not None:
+                return contains
+            return cuts.Compare(op, left, right)
+        negate = self.accept("not", "keyword")
+        if self.accept("between", "keyword"):
+            lo = self.arith()
+            self.expect("and")
+            hi = self.arith()
+            p = cuts.Logical(
+                "AND", cuts.Compare(">=", left, lo), cuts.Compare("<=", left, hi)
+            )
+            return cuts.Not(p) if negate else p
+        if negate:
+            raise ValueError("Expected BETWEEN after NOT")
+        if self.accept("is", "keyword"):
+            negate = self.accept("not", "keyword")
+            self.expect("null")
+            return cuts.Not(IsNull(left)) if negate else IsNull(left)
+        raise ValueError("Expected a condition at {!r}".format(op))
+
+    def arith(self):
+        left = self.term()
+        while self.peek()[1] in ("+", "-"):
+            op = self.next()[1]
+            left = cuts.BinOp(op, left, self.term())
+        return left
+
+    def term(self):
+        left = self.factor()
+        while self.peek()[1] in ("*", "/"):
+            op = self.next()[1]
+            left = cuts.BinOp(op, left, self.factor())
+        return left
+
+    def factor(self):
+        if self.accept("-"):
+            return -self.factor()
+        self.accept("+")
+        return self.primary()
+
+    def primary(self):
+        kind, value = self.peek()
+        if kind == "number":
+            self.pos += 1
+            return cuts.Const(
+                float(value) if re.search(r"[.eE]", value) else int(value)
+            )
+        if kind == "string":
+            self.pos += 1
+            return cuts.Const(value[1:-1].replace("''", "'"))
+        if value == "(":
+            self.pos += 1
+            inner = self.condition()
+            self.expect(")")
+            return inner
+        if kind == "name" and self.peek(1)[1] == "(":
+            return self.function()
+        if kind == "name":
+            return self.ref()
+        raise ValueError("Unexpected {!r}".format(value))
+
+    def function(self):
+        name = self.next()[1].upper()
+        if name in ("COUNT", "SUM", "AVG", "MIN", "MAX"):
+            raise UnsupportedQuery("Aggregate functions are not supported")
+        self.expect("(")
+        if name in ("POINT", "CIRCLE"):
+            kind, frame = self.next()
+            if kind != "string":
+                raise ValueError("Expected coordinate system in {:s}".format(name))
+            self.expect(",")
+        args = [self.arith()]
+        while self.accept(","):
+            args.append(self.arith())
+        self.expect(")")
+        nargs = {"POINT": 2, "CIRCLE": 3, "CONTAINS": 2, "DISTANCE": 2}
+        if name in nargs and len(args) != nargs[name]:
+            raise ValueError("{:s} takes {:d} arguments".format(name, nargs[name]))
+        if name == "POINT":
+            return Point(*args)
+        if name == "CIRCLE":
+            return Circle(*args)
+        if name == "CONTAINS":
+            return _ContainsValue(Contains(*args))
+        if name == "DISTANCE":
+            return Distance(*args)
+        if name in _Func._funcs and len(args) == 1:
+            return _Func(name, args[0])
+        if name in _Func2._funcs and len(args) == 2:
+            return _Func2(name, *args)
+        raise UnsupportedQuery("Function {:s} is not supported".format(name))
+
+
+def _contains_comparison(op, left, right):
+    """Predicate for `1 = CONTAINS(...)` and `CONTAINS(...) = 0`, or None"""
+    if op != "=":
+        return None
+    if isinstance(right, _ContainsValue):
+        left, right = right, left
+    if not (isinstance(left, _ContainsValue) and isinstance(right, cuts.Const)):
+        return None
+    if right.value == 1:
+        return left.contains
+    if right.value == 0:
+        return cuts.Not(left.contains)
+    return None
+
+
+def parse(query):
+    """Parse a query in the supported subset of ADQL
+
+    Raises
+    ------
+    ValueError
+        if the query is not valid
+    UnsupportedQuery
+        if the query uses ADQL that is not supported
+
+    Returns
+    -------
+    Query
+    """
+    return _Parser(query).parse()
+
+
+def _conjuncts(predicate):
+    """Conditions AND-ed at the top level of a predicate"""
+    if isinstance(predicate, cuts.Logical) and predicate.op == "AND":
+        return _conjuncts(predicate.left) + _conjuncts(predicate.right)
+    return [predicate] if predicate is not None else []
+
+
+def _constant(expr):
+    if isinstance(expr, cuts.Const):
+        return expr.value
+    if isinstance(expr, cuts.BinOp) and isinstance(expr.left, cuts.Const):
+        if expr.op == "-" and expr.left.value == 0:
+            # negative number
+            value = _constant(expr.right)
+            return None if value is None else -value
+    return None
+
+
+class LocalEngine(object):
+    """Execute a subset of ADQL on local tables
+
+    Tables are pandas DataFrames or `gapipes.gaia.store.LocalStore`s, referred
+    to by name in the query. Only the partitions of a store that can contain
+    matching rows are read; partitions are pruned with a constant
+    ``CONTAINS(POINT, CIRCLE)``, constant bounds on ``source_id``, or the
+    source_ids of a DataFrame joined on ``source_id``.
+
+    Parameters
+    ----------
+    tables : dict, optional
+        table name -> pandas.DataFrame or LocalStore
+    tap : Tap, optional
+        client to run queries that are not supported locally or refer to
+        tables that are not registered
+
+    Examples
+    --------
+    >>> engine = LocalEngine({"gaiadr2.gaia_source": store, "targets": df}, tap=gaia)
+    >>> engine.query(
+    ...     "SELECT TOP 10 g.source_id, g.parallax FROM gaiadr2.gaia_source AS g "
+    ...     "WHERE 1 = CONTAINS(POINT('ICRS', g.ra, g.dec), "
+    ...     "CIRCLE('ICRS', 56.75, 24.12, 1)) ORDER BY g.parallax DESC")
+    """
+
+    def __init__(self, tables=None, tap=None):
+        self.tables = dict(tables or {})
+        self.tap = tap
+
+    def register(self, name, table):
+        """Make table available to queries as `name`"""
+        self.tables[name] = table
+
+    def query(self, query, **kwargs):
+        """Run query locally, or with `tap` if it cannot run locally
+
+        Parameters
+        ----------
+        query : str
+            ADQL query
+        **kwargs
+            passed to `Tap.query` when the query runs remotely
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        try:
+            parsed = parse(query)
+            self._check(parsed)
+        except UnsupportedQuery as e:
+            if self.tap is None:
+                raise
+            logger.info("Running query remotely: {}".format(e))
+            kwargs.setdefault("async_", "auto")
+            return self.tap.query(query, **kwargs)
+        return self.execute(parsed)
+
+    def _check(self, q):
+        """Raise UnsupportedQuery if parsed query `q` cannot run locally"""
+        missing = [name for name, _ in q.tables if name not in self.tables]
+        if missing:
+            raise UnsupportedQuery("Tables {} are not local".format(missing))
+        for name, alias in q.tables:
+            if isinstance(self.tables[name], LocalStore) and any(
+                expr is None or (isinstance(expr, str) and expr == alias)
+                for expr, _ in q.items
+            ):
+                raise UnsupportedQuery(
+                    "SELECT * from a LocalStore; list columns explicitly"
+                )
+
+    def _columns_by_alias(self, q):
+        """Columns of each table referenced in the query"""
+        known = {
+            alias: list(self.tables[name].columns)
+            for name, alias in q.tables
+            if isinstance(self.tables[name], pd.DataFrame)
+        }
+        needed = {alias: [] for _, alias in q.tables}
+        # ORDER BY may refer to names of output columns
+        names = [name for _, name in q.items if name is not None]
+        order_refs = [
+            ref
+            for ref in q.order_refs
+            if not (ref.alias is None and ref.column in names)
+        ]
+        for ref in q.refs + order_refs:
+            if ref.alias is not None:
+                if ref.alias not in needed:
+                    raise KeyError("Unknown table alias {!r}".format(ref.alias))
+                alias = ref.alias
+            else:
+                owners = [a for a, cols in known.items() if ref.column in cols]
+                stores = [a for a in needed if a not in known]
+                candidates = owners or stores
+                if len(candidates) != 1:
+                    raise KeyError(
+                        "Cannot tell which table column {!r} is from".format(ref.column)
+                    )
+                alias = candidates[0]
+            if ref.column not in needed[alias]:
+                needed[alias].append(ref.column)
+        return needed
+
+    def _pixels(self, q, alias, store, frames):
+        """Partitions of a store that can contain rows matching the query"""
+        pixels = None
+
+        def restrict(p):
+            return p if pixels is None else np.intersect1d(pixels, p)
+
+        for p in _conjuncts(q.where):
+            if isinstance(p, Contains):
+                point, circle = p.point, p.circle
+                values = [_constant(e) for e in (circle.ra, circle.dec, circle.radius)]
+                refs = (point.ra, point.dec)
+                if None not in values and all(
+                    isinstance(r, Ref) and r.alias in (None, alias) for r in refs
+                ):
+                    pixels = restrict(healpix.cone_pixels(*values, store.level))
+            elif isinstance(p, cuts.Compare) and isinstance(p.left, Ref):
+                value = _constant(p.right)
+                if (
+                    p.left.column == "source_id"
+                    and p.left.alias in (None, alias)
+                    and value is not None
+                ):
+                    pixel = int(healpix.source_id_to_pixel(value, store.level))
+                    npix = 12 * 4**store.level
+                    if p.op in (">", ">="):
+                        pixels = restrict(np.arange(pixel, npix))
+                    elif p.op in ("<", "<="):
+                        pixels = restrict(np.arange(0, pixel + 1))
+                    elif p.op == "=":
+                        pixels = restrict(np.array([pixel]))
+        if q.join is not None and q.join[0] == "inner":
+            _, left, right = q.join
+            for mine, other in ((left, right), (right, left)):
+                if (
+                    mine.alias == alias
+                    and mine.column == "source_id"
+                    and other.alias in frames
+                ):
+                    frame = frames[other.alias]
+                    source_id = frame[other.alias + "." + other.column].values
+                    pixels = restrict(
+                        np.unique(healpix.source_id_to_pixel(source_id, store.level))
+                    )
+        if pixels is None:
+            logger.warning("Reading all partitions of the store")
+            pixels = np.arange(12 * 4**store.level)
+        return pixels
+
+    def execute(self, q):
+        """Execute a parsed query (see `parse`)
+
+        Raises
+        ------
+        UnsupportedQuery
+            if the query cannot run on the local tables
+        """
+        self._check(q)
+        needed = self._columns_by_alias(q)
+        frames = {}
+        # DataFrames first, so that joins can prune partitions of stores
+        order = sorted(
+            q.tables, key=lambda t: isinstance(self.tables[t[0]], LocalStore)
+        )
+        for name, alias in order:
+            table = self.tables[name]
+            if isinstance(table, LocalStore):
+                pixels = self._pixels(q, alias, table, frames)
+                df = table.load(pixels, needed[alias])
+            else:
+                df = table
+            frames[alias] = df.add_prefix(alias + ".")
+
+        aliases = [alias for _, alias in q.tables]
+        df = frames[aliases[0]]
+        if q.join is not None:
+            how, first, second = q.join
+            if first.alias != aliases[0]:
+                first, second = second, first
+            df = df.merge(
+                frames[aliases[1]],
+                how=how,
+                left_on="{:s}.{:s}".format(first.alias, first.column),
+                right_on="{:s}.{:s}".format(second.alias, second.column),
+            )
+        if q.where is not None:
+            df = df.loc[np.asarray(q.where.mask(df), dtype=bool)]
+
+        if q.order_by:
+            # NULLs sort as larger than any value, as in PostgreSQL: last
+            # in ascending and first in descending order
+            # sort positions; the index of df need not be unique
+            keys = pd.DataFrame(index=np.arange(len(df)))
+            ascending = []
+            for i, (expr, a) in enumerate(q.order_by):
+                values = np.broadcast_to(
+                    np.asarray(self._order_key(q, expr, df)), len(df)
+                )
+                keys["null{:d}".format(i)] = pd.isnull(values)
+                keys["value{:d}".format(i)] = values
+                ascending += [a, a]
+            keys = keys.sort_values(
+                list(keys.columns), ascending=ascending, kind="mergesort"
+            )
+            df = df.iloc[keys.index]
+
+        out = self._project(q, df)
+        if q.distinct:
+            out = out.drop_duplicates()
+        if q.top is not None:
+            out = out.iloc[: q.top]
+        return out.reset_index(drop=True)
+
+    def _order_key(self, q, expr, df):
+        # ORDER BY may refer to output names
+        if isinstance(expr, Ref) and expr.alias is None:
+            for item, name in q.items:
+                if name == expr.column and item is not None:
+                    return item.evaluate(df)
+        return expr.evaluate(df)
+
+    def _project(self, q, df):
+        out = {}
+
+        def add(name, values):
+            # duplicate names get a suffix, e.g., source_id and source_id_2
+            unique, n = name, 1
+            while unique in out:
+                n += 1
+                unique = "{:s}_{:d}".format(name, n)
+            out[unique] = values
+
+        for i, (expr, name) in enumerate(q.items):
+            if expr is None or isinstance(expr, str):
+                prefix = "" if expr is None else expr + "."
+                for c in df.columns:
+                    if c.startswith(prefix):
+                        add(c.rsplit(".", 1)[1], df[c].values)
+                continue
+            if name is None:
+                name = expr.column if isinstance(expr, Ref) else "col{:d}".format(i)
+            add(name, np.broadcast_to(np.asarray(expr.evaluate(df)), len(df)))
+        return pd.DataFrame(out, index=df.index)
@@ -0,0 +1,193 @@
+"""
+Export whole tables page by page with resumable checkpoints
+"""
+import os
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import tableio
+from . import adql
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["TableExporter"]
+
+
+class TableExporter(object):
+    """Export a table with source_id in pages, resuming after interruption
+
+    The table is split into blocks of source_id corresponding to HEALPix
+    pixels. Blocks are downloaded concurrently and each block is paginated
+    with ``WHERE source_id > last ORDER BY source_id``. Every page is written
+    to its own file in `output_dir` and progress is recorded in
+    `output_dir`/checkpoint.json so that `run` continues where it stopped.
+
+    Parameters
+    ----------
+    tap : Tap
+        TAP client; use ``threadsafe=True`` when `max_workers` > 1
+    table : str
+        qualified table name, e.g., 'gaiadr2.gaia_source'
+    output_dir : str
+        directory to write pages and checkpoint to
+    columns : str or list, optional
+        columns to export, as a list or a comma-separated string, or '*';
+        source_id is always included
+    where : str, optional
+        additional ADQL condition on rows
+    level : int, optional
+        HEALPix level of blocks; there are 12 * 4**level blocks
+    pixels : list of int, optional
+        export only these HEALPix pixels (at `level`), e.g., a footprint
+    page_size : int, optional
+        maximum number of rows per page
+    max_workers : int, optional
+        number of pages downloaded at the same time
+    format : str, optional
+        format of page files, one of 'fits', 'csv', 'parquet' (requires
+        pyarrow or fastparquet)
+
+    Examples
+    --------
+    >>> tap = Tap.from_url("https://gea.esac.esa.int/tap-server/tap", threadsafe=True)
+    >>> exporter = TableExporter(
+    ...     tap, "gaiadr2.gaia_source", "export/", columns=["source_id", "ra", "dec"],
+    ...     where="parallax > 10")
+    >>> files = exporter.run()
+    """
+
+    def __init__(
+        self,
+        tap,
+        table,
+        output_dir,
+        columns="*",
+        where=None,
+        level=3,
+        pixels=None,
+        page_size=100000,
+        max_workers=4,
+        format="fits",
+    ):
+        tableio.check_format(format)
+        if isinstance(columns, str):
+            columns = columns.strip()
+            if columns != "*":
+                columns = [c.strip() for c in columns.split(",")]
+        if not isinstance(columns, str):
+            columns = list(columns)
+            if "source_id" not in columns:
+                columns = ["source_id"] + columns
+            columns = ", ".join(columns)
+        self.tap = tap
+        self.table = table
+        self.output_dir = output_dir
+        self.columns = columns
+        self.where = where
+        self.level = level
+        self.pixels = list(range(12 * 4**level)) if pixels is None else list(pixels)
+        self.page_size = page_size
+        self.max_workers = max_workers
+        self.format = format
+        self._lock = threading.Lock()
+        self._state = None
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self.output_dir, "checkpoint.json")
+
+    @property
+    def _params(self):
+        """Parameters that must not change when resuming"""
+        return dict(
+            table=self.table,
+            columns=self.columns,
+            where=self.where,
+            level=self.level,
+            page_size=self.page_size,
+            format=self.format,
+        )
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return dict(params=self._params, blocks={})
+        with open(self.checkpoint_path, "r") as f:
+            state = json.load(f)
+        if state["params"] != self._params:
+            raise ValueError(
+                "{} was written for a different export: {}".format(
+                    self.checkpoint_path, state["params"]
+                )
+            )
+        return state
+
+    def _save_checkpoint(self):
+        # write to a temporary file and rename so that the checkpoint is never
+        # left half-written
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._state, f, indent=1)
+        os.replace(tmp, self.checkpoint_path)
+
+    @property
+    def progress(self):
+        """Number of finished blocks and total number of blocks"""
+        if self._state is None:
+            self._state = self._load_checkpoint()
+        blocks = self._state["blocks"]
+        done = sum(blocks.get(str(p), {}).get("done", False) for p in self.pixels)
+        return done, len(self.pixels)
+
+    def page_query(self, last, hi):
+        """Query for the page following source_id `last` up to `hi`"""
+        q = "SELECT TOP {:d} {:s} FROM {:s}".format(
+            self.page_size, self.columns, self.table
+        )
+        q = adql.add_where(q, "source_id > {:d} AND source_id <= {:d}".format(last, hi))
+        if self.where:
+            q = adql.add_where(q, self.where)
+        return q + " ORDER BY source_id"
+
+    def _export_block(self, pixel):
+        lo, hi = adql.healpix_source_id_range(pixel, self.level)
+        with self._lock:
+            block = dict(self._state["blocks"].get(str(pixel), {}))
+        last = block.get("last", lo - 1)
+        page = block.get("pages", 0)
+        files = [self._page_path(pixel, i) for i in range(page)]
+        while not block.get("done", False):
+            df = self.tap.query(self.page_query(last, hi), async_="auto")
+            if len(df) > 0:
+                path = self._page_path(pixel, page)
+                tableio.write_table(df, path, self.format)
+                files.append(path)
+                last = int(df["source_id"].max())
+                page += 1
+            block = dict(last=last, pages=page, done=len(df) < self.page_size)
+            with self._lock:
+                self._state["blocks"][str(pixel)] = block
+                self._save_checkpoint()
+            logger.debug("pixel {:d} page {:d}: {:d} rows".format(pixel, page, len(df)))
+        return files
+
+    def _page_path(self, pixel, page):
+        return os.path.join(
+            self.output_dir,
+            "{:d}-{:05d}.{:s}".format(pixel, page, tableio.extensions[self.format]),
+        )
+
+    def run(self):
+        """Export all remaining pages
+
+        Returns
+        -------
+        list of str
+            paths to all page files, ordered by source_id
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._state = self._load_checkpoint()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            files = list(pool.map(self._export_block, self.pixels))
+        return [f for block_files in files for f in block_files]
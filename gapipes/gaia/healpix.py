@@ -0,0 +1,115 @@
+"""
+Minimal nested HEALPix geometry for partitioning Gaia data by source_id
+"""
+import numpy as np
+
+from .adql import _source_id_per_healpix12
+
+__all__ = [
+    "source_id_to_pixel",
+    "pix2ang",
+    "pixel_radius",
+    "separation",
+    "cone_pixels",
+]
+
+# face layout of the nested scheme (Gorski et al. 2005)
+_jrll = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+_jpll = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+
+
+def source_id_to_pixel(source_id, level):
+    """HEALPix pixel (nested) at `level` encoded in Gaia source_id"""
+    n = _source_id_per_healpix12 * 4 ** (12 - level)
+    return np.asarray(source_id, dtype=np.int64) // n
+
+
+def pix2ang(level, pixel):
+    """Centers of nested HEALPix pixels
+
+    Parameters
+    ----------
+    level : int
+        HEALPix level (nside = 2**level)
+    pixel : int or array-like
+        pixel indices
+
+    Returns
+    -------
+    ra, dec : np.array
+        coordinates of pixel centers [deg]
+    """
+    nside = 2**level
+    npface = nside * nside
+    pixel = np.asarray(pixel, dtype=np.int64)
+    face = pixel // npface
+    ipf = pixel % npface
+    # de-interleave bits of the index within the face
+    ix = np.zeros_like(ipf)
+    iy = np.zeros_like(ipf)
+    for bit in range(level):
+        ix |= ((ipf >> (2 * bit)) & 1) << bit
+        iy |= ((ipf >> (2 * bit + 1)) & 1) << bit
+
+    jr = _jrll[face] * nside - ix - iy - 1
+    nl4 = 4 * nside
+    north, south = jr < nside, jr > 3 * nside
+    nr = np.where(north, jr, np.where(south, nl4 - jr, nside))
+    z = np.where(
+        north,
+        1 - nr**2 / (3.0 * npface),
+        np.where(
+            south, nr**2 / (3.0 * npface) - 1, (2 * nside - jr) * 2.0 / (3 * nside)
+        ),
+    )
+    kshift = np.where(north | south, 0, (jr - nside) & 1)
+    jp = (_jpll[face] * nr + ix - iy + 1 + kshift) // 2
+    jp = np.where(jp > nl4, jp - nl4, jp)
+    jp = np.where(jp < 1, jp + nl4, jp)
+    phi = (jp - (kshift + 1) * 0.5) * (0.5 * np.pi / nr)
+    return np.rad2deg(phi), 90.0 - np.rad2deg(np.arccos(np.clip(z, -1, 1)))
+
+
+def pixel_radius(level):
+    """Upper bound on the distance [deg] from a pixel center to its boundary
+
+    Twice the square root of the pixel area; the true maximum is smaller
+    for all levels.
+    """
+    return np.rad2deg(2 * np.sqrt(4 * np.pi / (12 * 4**level)))
+
+
+def separation(ra1, dec1, ra2, dec2):
+    """Angular separation [deg] (haversine)"""
+    ra1, dec1, ra2, dec2 = map(np.deg2rad, (ra1, dec1, ra2, dec2))
+    s = (
+        np.sin((dec2 - dec1) / 2) ** 2
+        + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2
+    )
+    return np.rad2deg(2 * np.arcsin(np.sqrt(np.clip(s, 0, 1))))
+
+
+def cone_pixels(ra, dec, radius, level):
+    """Pixels that may overlap a cone
+
+    The result is conservative: it contains every pixel overlapping the cone
+    and possibly some more.
+
+    Parameters
+    ----------
+    ra, dec : float
+        center of cone [deg]
+    radius : float
+        radius of cone [deg]
+    level : int
+        HEALPix level
+
+    Returns
+    -------
+    np.array
+        nested pixel indices
+    """
+    pixels = np.arange(12 * 4**level)
+    pra, pdec = pix2ang(level, pixels)
+    d = separation(ra, dec, pra, pdec)
+    return pixels[d <= radius + pixel_radius(level)]
@@ -0,0 +1,152 @@
+"""
+Table of Gaia sources whose columns are fetched from the archive when used
+"""
+import logging
+import numpy as np
+import pandas as pd
+
+from .utils import QueryError
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["LazyGaiaFrame"]
+
+
+class LazyGaiaFrame(object):
+    """Gaia sources with columns fetched on first access
+
+    Only the source_ids are held initially. Accessing a column queries it
+    for all sources (in batches of uploaded source_ids) and caches it, so
+    transfer and memory scale with the columns actually used.
+
+    The frame is dict-like, so the `g` accessor works on it:
+
+    >>> lf = gaia.query_sourceid(df, lazy=True)
+    >>> lf.g.icrs  # fetches ra, dec, parallax, pmra, pmdec, radial_velocity
+
+    Fetch several columns in one query with `fetch` before using them.
+
+    Parameters
+    ----------
+    tap : Tap
+        TAP client used to fetch columns
+    source_id : array-like
+        source_ids of rows
+    table : str, optional
+        qualified name of table to fetch columns from
+    columns : list, optional
+        names of columns available in `table`; taken from `tap.columns` if None
+    batch_size : int, optional
+        maximum number of source_ids uploaded per query
+    sync_max_rows : int, optional
+        batches of up to this many source_ids are queried synchronously,
+        larger ones as asynchronous jobs; a batch returns at most one row
+        per source_id, so no count is needed to choose
+    """
+
+    def __init__(
+        self,
+        tap,
+        source_id,
+        table="gaiadr2.gaia_source",
+        columns=None,
+        batch_size=100000,
+        sync_max_rows=100000,
+    ):
+        self.tap = tap
+        self.table = table
+        self.batch_size = batch_size
+        self.sync_max_rows = sync_max_rows
+        self._available = None if columns is None else list(columns)
+        source_id = np.asarray(source_id, dtype=np.int64)
+        self._data = pd.DataFrame({"source_id": source_id})
+
+    def keys(self):
+        """Names of all columns that can be accessed"""
+        if self._available is None:
+            schema, table_name = self.table.split(".")
+            columns = self.tap.columns
+            columns = columns.loc[
+                (columns["schema"] == schema) & (columns["table_name"] == table_name)
+            ]
+            self._available = list(columns["column_name"])
+        return list(self._available)
+
+    @property
+    def cached_columns(self):
+        """Names of columns fetched so far"""
+        return list(self._data.columns)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            self.fetch([key])
+            return self._data[key]
+        self.fetch(key)
+        return self._data[list(key)]
+
+    def fetch(self, columns):
+        """Fetch columns not yet cached in one query per batch
+
+        Parameters
+        ----------
+        columns : list of str
+            column names
+        """
+        available = self.keys()
+        unknown = [c for c in columns if c not in available and c != "source_id"]
+        if unknown:
+            raise KeyError("{} not in {}".format(unknown, self.table))
+        missing = [c for c in dict.fromkeys(columns) if c not in self._data.columns]
+        if not missing:
+            return
+        logger.debug("Fetching {} from {}".format(missing, self.table))
+        q = (
+            "SELECT g.source_id, {columns:s} FROM TAP_UPLOAD.ids AS t "
+            "JOIN {table:s} AS g ON g.source_id = t.source_id"
+        ).format(
+            columns=", ".join("g." + c for c in missing),
+            table=self.table,
+        )
+        ids = pd.unique(self._data["source_id"])
+        results = []
+        for start in range(0, len(ids), self.batch_size):
+            upload = pd.DataFrame({"source_id": ids[start : start + self.batch_size]})
+            results.append(self._query_batch(q, upload))
+        fetched = pd.concat(results, ignore_index=True).set_index("source_id")
+        fetched = fetched.reindex(self._data["source_id"])
+        for c in missing:
+            self._data[c] = fetched[c].values
+
+    def _query_batch(self, query, upload):
+        """Run query joined with a batch of uploaded source_ids"""
+        kwargs = dict(upload_resource=upload, upload_table_name="ids")
+        if len(upload) <= self.sync_max_rows:
+            try:
+                return self.tap.query(query, async_=False, **kwargs)
+            except QueryError:
+                logger.info("Synchronous query timed out; resubmitting as async job")
+        return self.tap.query(query, async_=True, **kwargs).get_result()
+
+    def to_pandas(self, columns=None):
+        """DataFrame of cached columns, fetching `columns` first if given"""
+        if columns is not None:
+            self.fetch(columns)
+        return self._data.copy()
+
+    @property
+    def g(self):
+        """Gaia accessor (see `gapipes.accessors.GaiaData`)"""
+        from ..accessors import GaiaData
+
+        return GaiaData(self)
+
+    def __repr__(self):
+        return "<{:s} of {:d} sources from {:s}; cached columns: {}>".format(
+            self.__class__.__name__, len(self), self.table, self.cached_columns
+        )
@@ -0,0 +1,211 @@
+"""
+Route queries over several equivalent TAP endpoints
+"""
+import time
+import logging
+import threading
+import functools
+import pandas as pd
+from requests.exceptions import RequestException, Timeout
+
+from .core import Tap
+from .utils import QueryError, QueryTimeout, JobError, Deadline, prefetch_map
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["MirroredTap"]
+
+
+def _is_client_error(e):
+    """True if exception is an HTTP 4xx error, i.e., a problem with the query"""
+    for exc in (e, e.__cause__):
+        response = getattr(exc, "response", None)
+        if response is not None and 400 <= response.status_code < 500:
+            return True
+    return False
+
+
+def _is_final(e):
+    """True if exception should not be retried on another endpoint
+
+    These are problems with the query, i.e., HTTP 4xx errors and jobs that
+    ended in ERROR phase, and the expiry of the deadline shared by all
+    endpoints. A `QueryTimeout` caused by an HTTP timeout is a problem of
+    the endpoint and is retried while the deadline allows.
+    """
+    if isinstance(e, QueryTimeout):
+        return not isinstance(e.__cause__, Timeout)
+    return isinstance(e, JobError) or _is_client_error(e)
+
+
+class EndpointStats(object):
+    """Observed latency and failures of one endpoint"""
+
+    def __init__(self):
+        self.latency = None
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_failure = None
+
+    def success(self, elapsed, alpha):
+        self.requests += 1
+        self.consecutive_failures = 0
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency = alpha * elapsed + (1 - alpha) * self.latency
+
+    def failure(self):
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_failure = time.monotonic()
+
+
+class MirroredTap(object):
+    """TAP client that spreads queries over equivalent endpoints
+
+    Each query goes to the healthy endpoint with the lowest observed latency
+    (an exponentially weighted moving average of request times; endpoints not
+    tried yet go first, endpoints that just failed go last). When a request fails with a connection error,
+    an HTTP timeout, a server (5xx) error or an empty synchronous result, the
+    endpoint is marked as failed and the query is retried on the next one.
+    Errors in the query itself (4xx or a job that ended in ERROR phase) are
+    raised without failing over. The `timeout` of a query is shared by all
+    attempts; `QueryTimeout` is raised once it has run out.
+
+    An endpoint that failed `max_failures` times in a row is skipped for
+    `cooldown` seconds. When all endpoints are unhealthy, they are tried anyway.
+
+    Parameters
+    ----------
+    endpoints : list of Tap or str
+        TAP clients or urls passed to `Tap.from_url`
+    alpha : float, optional
+        weight of the latest request in the latency average
+    max_failures : int, optional
+        number of consecutive failures after which an endpoint is skipped
+    cooldown : float, optional
+        seconds before a skipped endpoint is tried again
+
+    Examples
+    --------
+    >>> tap = MirroredTap([
+    ...     "https://gea.esac.esa.int/tap-server/tap",
+    ...     "https://gaia.ari.uni-heidelberg.de/tap"])
+    >>> df = tap.query("select top 5 * from gaiadr2.gaia_source")
+    >>> tap.stats
+    """
+
+    def __init__(self, endpoints, alpha=0.3, max_failures=3, cooldown=60.0):
+        if not endpoints:
+            raise ValueError("`endpoints` must not be empty")
+        self.endpoints = [
+            Tap.from_url(e) if isinstance(e, str) else e for e in endpoints
+        ]
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._stats = [EndpointStats() for _ in self.endpoints]
+        self._lock = threading.Lock()
+
+    def _healthy(self, stats):
+        if stats.consecutive_failures < self.max_failures:
+            return True
+        return time.monotonic() - stats.last_failure > self.cooldown
+
+    def _ranked(self):
+        """Indices of endpoints in the order they should be tried"""
+        with self._lock:
+            # endpoints that failed recently go after others
+            key = [
+                (s.consecutive_failures, -1 if s.latency is None else s.latency)
+                for s in self._stats
+            ]
+            healthy = [self._healthy(s) for s in self._stats]
+        order = sorted(range(len(self.endpoints)), key=lambda i: key[i])
+        return [i for i in order if healthy[i]] + [i for i in order if not healthy[i]]
+
+    def _call(self, func):
+        """Call `func(tap)` on endpoints in order until one succeeds"""
+        error = None
+        for i in self._ranked():
+            tap = self.endpoints[i]
+            start = time.monotonic()
+            try:
+                result = func(tap)
+            except (RequestException, QueryError) as e:
+                if _is_final(e):
+                    raise
+                logger.warning("{:s} failed: {}".format(tap.tap_endpoint, e))
+                with self._lock:
+                    self._stats[i].failure()
+                error = e
+                continue
+            with self._lock:
+                self._stats[i].success(time.monotonic() - start, self.alpha)
+            return result
+        raise error
+
+    def query(self, query, **kwargs):
+        """Send query to the best endpoint (see `Tap.query` for parameters)
+
+        Asynchronous jobs are bound to the endpoint that accepted them.
+        """
+        deadline = Deadline(kwargs.pop("timeout", None))
+        return self._call(
+            lambda tap: tap.query(query, timeout=deadline.remaining(), **kwargs)
+        )
+
+    def iter_query(self, queries, max_workers=2, read_ahead=2, **kwargs):
+        """Iterate over results of many queries (see `Tap.iter_query`)
+
+        Each query is routed separately, so a pool of workers is spread over
+        the endpoints. Endpoints should be created with ``threadsafe=True``
+        when `max_workers` > 1.
+        """
+        kwargs.setdefault("async_", "auto")
+        return prefetch_map(
+            functools.partial(self.query, **kwargs),
+            queries,
+            max_workers=max_workers,
+            read_ahead=read_ahead,
+        )
+
+    def estimate_rows(self, query, **kwargs):
+        """Estimate the number of rows a query will return (see `Tap.estimate_rows`)"""
+        deadline = Deadline(kwargs.pop("timeout", None))
+        return self._call(
+            lambda tap: tap.estimate_rows(query, timeout=deadline.remaining(), **kwargs)
+        )
+
+    @property
+    def tables(self):
+        return self._call(lambda tap: tap.tables)
+
+    @property
+    def columns(self):
+        return self._call(lambda tap: tap.columns)
+
+    @property
+    def stats(self):
+        """pandas.DataFrame of per-endpoint latency [s], counts and health"""
+        with self._lock:
+            rows = [
+                dict(
+                    endpoint=tap.tap_endpoint,
+                    latency=s.latency,
+                    requests=s.requests,
+                    failures=s.failures,
+                    healthy=self._healthy(s),
+                )
+                for tap, s in zip(self.endpoints, self._stats)
+            ]
+        return pd.DataFrame(rows)
+
+    def __repr__(self):
+        return "{:s}([{:s}])".format(
+            self.__class__.__name__,
+            ", ".join('"{:s}"'.format(tap.tap_endpoint) for tap in self.endpoints),
+        )
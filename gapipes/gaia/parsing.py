@@ -0,0 +1,139 @@
+"""
+Decode result tables in a pool of worker processes
+
+Parsing VOTable and CSV results holds the GIL, so threads do not help when
+many results arrive together. `ProcessPoolParser` decodes them in separate
+processes and sends the decoded columns back through shared memory instead
+of pickling the tables.
+
+>>> tap = Tap.from_url("https://gea.esac.esa.int/tap-server/tap", threadsafe=True)
+>>> tap.parser = ProcessPoolParser(max_workers=4)
+>>> tables = list(tap.iter_query(queries, max_workers=4))
+"""
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from astropy.table import Table, Column, MaskedColumn
+
+from .. import sharedmem
+from .utils import parse_result_table
+
+__all__ = ["ProcessPoolParser"]
+
+
+def _parse_to_shared(content, format):
+    """Parse result in a worker and put the columns in shared memory
+
+    Returns a picklable description of the table; columns that cannot be
+    shared as raw bytes (e.g., python objects) are included as they are.
+    """
+    table = parse_result_table(content, format)
+    arrays, others = {}, {}
+    if isinstance(table, pd.DataFrame):
+        for name in table.columns:
+            series = table[name]
+            if isinstance(series.dtype, np.dtype) and sharedmem.is_shareable(
+                series.values
+            ):
+                arrays[name] = series.values
+            else:
+                others[name] = series
+        info, meta = None, None
+    else:
+        info = []
+        for name in table.colnames:
+            col = table[name]
+            masked = isinstance(col, MaskedColumn)
+            data = col.data.data if masked else col.data
+            if sharedmem.is_shareable(data):
+                arrays[name] = data
+            else:
+                others[name] = data
+            if masked:
+                arrays[name + ".mask"] = np.ma.getmaskarray(col.data)
+            info.append((name, masked, col.unit, col.description, dict(col.meta)))
+        meta = dict(table.meta)
+    shm_name, layout = sharedmem.pack_arrays(arrays)
+    columns = list(table.columns) if info is None else table.colnames
+    return shm_name, layout, others, columns, info, meta
+
+
+def _rebuild(shm_name, layout, others, columns, info, meta):
+    """Rebuild the table parsed in a worker"""
+    arrays = sharedmem.unpack_arrays(shm_name, layout)
+    arrays.update(others)
+    if info is None:
+        return pd.DataFrame({name: arrays[name] for name in columns}, columns=columns)
+    cols = []
+    for name, masked, unit, description, colmeta in info:
+        kwargs = dict(name=name, unit=unit, description=description, meta=colmeta)
+        if masked:
+            cols.append(
+                MaskedColumn(arrays[name], mask=arrays[name + ".mask"], **kwargs)
+            )
+        else:
+            cols.append(Column(arrays[name], **kwargs))
+    return Table(cols, meta=meta)
+
+
+class ProcessPoolParser(object):
+    """Parse result tables in a pool of worker processes
+
+    An instance can be set as `Tap.parser` (and is then passed on to async
+    `Job`s) so that results are decoded on separate cores. `parse` blocks
+    until the table is decoded and can be called from many threads at once.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        number of worker processes; the default is the number of CPUs
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        """The process pool, started on first use"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._pool
+
+    def parse(self, content, format):
+        """Parse result table in a worker process
+
+        Parameters
+        ----------
+        content : bytes
+            body of the response with the result table
+        format : str
+            the table format, one of 'votable', 'csv' or 'fits'
+
+        Returns
+        -------
+        table : pd.DataFrame or astropy.table.Table
+            pandas.DataFrame for 'csv', astropy.table.Table otherwise
+        """
+        if format not in ["votable", "csv", "fits"]:
+            raise ValueError("format is not recognized")
+        return _rebuild(*self.pool.submit(_parse_to_shared, content, format).result())
+
+    def shutdown(self):
+        """Stop the worker processes"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def __repr__(self):
+        return "ProcessPoolParser(max_workers={})".format(self.max_workers)
@@ -0,0 +1,251 @@
+"""
+Local column store of Gaia data partitioned by HEALPix pixel
+"""
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+from . import adql
+from . import healpix
+from .utils import prefetch_map
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["LocalStore"]
+
+
+def _as_storable(values):
+    """Array that can be saved with np.save and loaded memory-mapped
+
+    Strings are stored with missing values as empty strings, which is how
+    they arrive in csv results.
+    """
+    values = np.asarray(values)
+    if values.dtype == object:
+        values = np.where(pd.isnull(values), "", values).astype(str)
+    return values
+
+
+def _from_storable(values):
+    """Column as stored by `_as_storable` with missing strings as None"""
+    if values.dtype.kind != "U":
+        return values
+    out = values.astype(object)
+    out[values == ""] = None
+    return out
+
+
+class LocalStore(object):
+    """Local copy of whole HEALPix partitions of a table with Gaia source_id
+
+    Rows are partitioned by the HEALPix pixel encoded in source_id. Each
+    partition is a directory with one ``.npy`` file per column, which is
+    memory-mapped when read. ``manifest.json`` records which partitions and
+    columns are present. Requests are served from disk, and only missing
+    partitions, or missing columns of present partitions, are queried from
+    `tap`.
+
+    Parameters
+    ----------
+    path : str
+        directory of the store
+    tap : Tap, optional
+        client used to fetch missing data; None to work offline
+    table : str, optional
+        qualified name of the table
+    level : int, optional
+        HEALPix level of partitions; there are 12 * 4**level partitions
+    max_workers : int, optional
+        number of partitions fetched at the same time; `tap` should be
+        created with ``threadsafe=True`` when this is more than 1
+
+    Examples
+    --------
+    >>> store = LocalStore("gaia-store/", tap=gaia)
+    >>> df = store.cone(56.75, 24.12, 2.0, columns=["ra", "dec", "parallax"])
+    >>> # served from disk; only 'pmra' and 'pmdec' are fetched
+    >>> df = store.cone(56.75, 24.12, 1.0, columns=["parallax", "pmra", "pmdec"])
+    """
+
+    def __init__(
+        self, path, tap=None, table="gaiadr2.gaia_source", level=5, max_workers=2
+    ):
+        self.path = path
+        self.tap = tap
+        self.table = table
+        self.level = level
+        self.max_workers = max_workers
+        self._manifest = self._load_manifest()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.path, "manifest.json")
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return dict(table=self.table, level=self.level, partitions={})
+        with open(self.manifest_path, "r") as f:
+            manifest = json.load(f)
+        if (manifest["table"], manifest["level"]) != (self.table, self.level):
+            raise ValueError(
+                "{} is a store of {} at level {}".format(
+                    self.path, manifest["table"], manifest["level"]
+                )
+            )
+        return manifest
+
+    def _save_manifest(self):
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._manifest, f, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    @property
+    def partitions(self):
+        """dict of present partitions, pixel -> list of columns"""
+        return {
+            int(pixel): list(p["columns"])
+            for pixel, p in self._manifest["partitions"].items()
+        }
+
+    def _column_path(self, pixel, column):
+        return os.path.join(self.path, str(pixel), column + ".npy")
+
+    def missing(self, pixels, columns):
+        """Columns missing from each partition
+
+        Returns
+        -------
+        dict
+            pixel -> list of missing columns, for partitions with missing data
+        """
+        columns = ["source_id"] + [c for c in columns if c != "source_id"]
+        present = self.partitions
+        out = {}
+        for pixel in pixels:
+            have = present.get(int(pixel), [])
+            need = [c for c in columns if c not in have]
+            if need:
+                out[int(pixel)] = need
+        return out
+
+    def partition_query(self, pixel, columns):
+        """Query for columns of all rows in a partition ordered by source_id"""
+        lo, hi = adql.healpix_source_id_range(pixel, self.level)
+        q = "SELECT {:s} FROM {:s}".format(", ".join(columns), self.table)
+        q = adql.add_where(q, "source_id BETWEEN {:d} AND {:d}".format(lo, hi))
+        return q + " ORDER BY source_id"
+
+    def fetch(self, pixels, columns):
+        """Fetch missing partitions and columns from the archive
+
+        Parameters
+        ----------
+        pixels : list of int
+            partitions
+        columns : list of str
+            columns
+        """
+        missing = self.missing(pixels, columns)
+        if not missing:
+            return
+        if self.tap is None:
+            raise KeyError(
+                "{:d} partitions are not in the store and there is no tap to "
+                "fetch them".format(len(missing))
+            )
+        present = self.partitions
+        queries = []
+        for pixel, need in missing.items():
+            if pixel in present:
+                # source_id is stored; fetch it again to align the new columns
+                need = ["source_id"] + need
+            queries.append(self.partition_query(pixel, need))
+        logger.info("Fetching {:d} partitions".format(len(queries)))
+        # whole partitions are large, so skip the row count of async_='auto'
+        results = prefetch_map(
+            lambda q: self.tap.query(q, async_=True).get_result(),
+            queries,
+            max_workers=self.max_workers,
+        )
+        for pixel, df in zip(missing, results):
+            if not isinstance(df, pd.DataFrame):
+                df = df.to_pandas()
+            self._write(pixel, df)
+
+    def _write(self, pixel, df):
+        os.makedirs(os.path.join(self.path, str(pixel)), exist_ok=True)
+        partition = self._manifest["partitions"].get(str(pixel))
+        if partition is not None:
+            source_id = np.load(self._column_path(pixel, "source_id"))
+            df = df.set_index("source_id").reindex(source_id).reset_index()
+        for c in df.columns:
+            if partition is not None and c in partition["columns"]:
+                continue
+            np.save(self._column_path(pixel, c), _as_storable(df[c].values))
+        if partition is None:
+            partition = dict(nrows=len(df), columns=[])
+        partition["columns"] += [c for c in df.columns if c not in partition["columns"]]
+        self._manifest["partitions"][str(pixel)] = partition
+        self._save_manifest()
+
+    def column(self, pixel, column):
+        """Memory-mapped column of a partition"""
+        return np.load(self._column_path(pixel, column), mmap_mode="r")
+
+    def load(self, pixels, columns, fetch=True):
+        """Rows of partitions
+
+        Parameters
+        ----------
+        pixels : list of int
+            partitions
+        columns : list of str
+            columns; source_id is always included
+        fetch : bool, optional
+            False to raise KeyError instead of fetching missing data
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        columns = ["source_id"] + [c for c in columns if c != "source_id"]
+        if fetch:
+            self.fetch(pixels, columns)
+        elif self.missing(pixels, columns):
+            raise KeyError(
+                "Data missing for partitions {}".format(
+                    list(self.missing(pixels, columns))
+                )
+            )
+        frames = [
+            pd.DataFrame({c: _from_storable(self.column(pixel, c)) for c in columns})
+            for pixel in pixels
+            if self._manifest["partitions"][str(int(pixel))]["nrows"] > 0
+        ]
+        if not frames:
+            return pd.DataFrame({c: [] for c in columns})
+        return pd.concat(frames, ignore_index=True)
+
+    def cone(self, ra, dec, radius, columns, fetch=True):
+        """Rows within `radius` [deg] of (`ra`, `dec`) [deg]
+
+        Only partitions that may overlap the cone are read or fetched.
+        """
+        columns = list(columns)
+        pixels = healpix.cone_pixels(ra, dec, radius, self.level)
+        need = columns + [c for c in ("ra", "dec") if c not in columns]
+        df = self.load(pixels, need, fetch=fetch)
+        d = healpix.separation(ra, dec, df["ra"].values, df["dec"].values)
+        df = df.loc[d <= radius].reset_index(drop=True)
+        return df[["source_id"] + [c for c in columns if c != "source_id"]]
+
+    def __repr__(self):
+        return "<{:s} of {:s} at {:s}: {:d} partitions>".format(
+            self.__class__.__name__,
+            self.table,
+            self.path,
+            len(self._manifest["partitions"]),
+        )
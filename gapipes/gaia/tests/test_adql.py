@@ -0,0 +1,76 @@
+import pytest
+
+from gapipes.gaia import adql
+
+
+def test_get_top():
+    assert adql.get_top("select top 10 * from foo") == 10
+    assert adql.get_top("  SELECT DISTINCT TOP 3 a from foo") == 3
+    assert adql.get_top("select * from foo where topology > 1") is None
+
+
+def test_count_query():
+    q = adql.count_query("select a, b from foo where a > 1 ORDER BY b desc;")
+    assert (
+        q == "SELECT COUNT(*) AS n FROM (select a, b from foo where a > 1) AS subquery"
+    )
+
+
+def test_add_where():
+    assert adql.add_where("select * from foo;", "a > 1") == (
+        "select * from foo WHERE a > 1"
+    )
+    assert adql.add_where(
+        "select * from foo where b = 1 or c = 2 order by a", "a > 1"
+    ) == ("select * from foo WHERE (a > 1) AND (b = 1 or c = 2) order by a")
+
+
+def test_partition_query():
+    queries = adql.partition_query("select * from foo", level=1)
+    assert len(queries) == 48
+    lo, hi = adql.healpix_source_id_range(47, 1)
+    assert hi == 12 * 4**12 * 2**35 - 1
+    assert queries[-1] == "select * from foo WHERE source_id BETWEEN {} AND {}".format(
+        lo, hi
+    )
+
+
+def test_crossmatch_query():
+    q = adql.crossmatch_query("targets", columns="source_id, g.ra", radius=1)
+    assert q.startswith("SELECT t.target_idx, DISTANCE(")
+    assert "g.source_id, g.ra FROM TAP_UPLOAD.targets AS t" in q
+    assert q.endswith("CIRCLE('ICRS', t.ra, t.dec, 1.0))")
+
+
+def test_set_top():
+    assert adql.set_top("select a from foo;", 5) == "select TOP 5 a from foo"
+    assert adql.set_top("SELECT DISTINCT a from foo", 5) == (
+        "SELECT DISTINCT TOP 5 a from foo"
+    )
+    assert adql.set_top("select top 3 a from foo", 5) == "select top 3 a from foo"
+    assert adql.set_top("select top 30 a from foo", 5) == "select top 5 a from foo"
+
+
+def test_sample_query():
+    q = adql.sample_query("select * from foo where a > 1 order by b", 0.01)
+    assert q == (
+        "select * from foo WHERE (MOD(random_index, 1000000) < 10000) AND (a > 1) "
+        "order by b"
+    )
+    q = adql.sample_query("select a from foo order by b", 100, column="g.random_index")
+    assert q == "select TOP 100 a from foo ORDER BY g.random_index"
+    assert adql.sample_query("select a from foo", 1.0) == "select a from foo"
+    with pytest.raises(ValueError):
+        adql.sample_query("select a from foo", 1.5)
+    with pytest.raises(ValueError):
+        adql.sample_query("select a from foo", 0)
+    with pytest.raises(TypeError):
+        adql.sample_query("select a from foo", True)
+
+    queries = adql.stratified_sample_queries("select a from foo", 10, level=1)
+    assert len(queries) == 48
+    lo, hi = adql.healpix_source_id_range(3, 1)
+    assert queries[3] == (
+        "select TOP 10 a from foo WHERE source_id BETWEEN {:d} AND {:d} "
+        "ORDER BY random_index".format(lo, hi)
+    )
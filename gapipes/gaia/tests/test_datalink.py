@@ -0,0 +1,108 @@
+import io
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import numpy as np
+import pandas as pd
+import pytest
+from astropy.table import Table
+
+from gapipes.gaia import Tap
+from gapipes.gaia.datalink import DataLinkRetriever
+
+
+class DataLinkHandler(BaseHTTPRequestHandler):
+    """Stand-in data service: zipped VOTable per source, or one csv"""
+
+    requests = []
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        args = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        self.requests.append(args)
+        ids = [int(s.split()[-1]) for s in args["ID"].split(",")]
+        # sources with odd ids have no epoch photometry
+        ids = [i for i in ids if i % 2 == 0]
+        if args["FORMAT"] == "votable":
+            buf = io.BytesIO()
+            with zipfile.ZipFile(buf, "w") as z:
+                for i in ids:
+                    t = Table({"source_id": [i] * 3, "mag": [1.0, 2.0, 3.0]})
+                    f = io.BytesIO()
+                    t.write(f, format="votable")
+                    z.writestr(
+                        "EPOCH_PHOTOMETRY-Gaia DR2 {:d}.xml".format(i), f.getvalue()
+                    )
+            body, content_type = buf.getvalue(), "application/zip"
+        else:
+            df = pd.DataFrame({"source_id": np.repeat(ids, 2), "mag": 1.0})
+            body, content_type = df.to_csv(index=False).encode(), "text/csv"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), DataLinkHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    DataLinkHandler.requests = []
+    yield "http://127.0.0.1:{:d}/data".format(httpd.server_port)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_retrieve_zip(server, tmpdir):
+    tap = Tap("127.0.0.1", "/tap", threadsafe=True)
+    ids = np.arange(10, 30)
+    retriever = DataLinkRetriever(
+        tap, str(tmpdir), url=server, batch_size=6, max_workers=3
+    )
+    products = retriever.retrieve(ids)
+    assert len(DataLinkHandler.requests) == 4
+    # batches are downloaded concurrently, in any order
+    first = sorted(r["ID"] for r in DataLinkHandler.requests)[0]
+    assert first == ",".join("Gaia DR2 {:d}".format(i) for i in range(10, 16))
+    assert len(products) == 20
+    assert all(p.endswith(".zip") for p in products.paths)
+
+    t = products[12]
+    assert list(t["source_id"]) == [12] * 3
+    assert products[13] is None
+
+    # files on disk are reused
+    products = retriever.retrieve(ids)
+    assert len(DataLinkHandler.requests) == 4
+    assert len(products[28]) == 3
+
+
+def test_retrieve_single_file(server, tmpdir):
+    tap = Tap("127.0.0.1", "/tap")
+    retriever = DataLinkRetriever(
+        tap, str(tmpdir), url=server, format="csv", batch_size=4, max_workers=1
+    )
+    products = retriever.retrieve([4, 5, 6, 7, 8])
+    assert [p.endswith(".csv") for p in products.paths] == [True, True]
+    assert list(products[6]["source_id"]) == [6, 6]
+    assert len(products[7]) == 0
+    assert dict(products.items()).keys() == {4, 5, 6, 7, 8}
+
+
+def test_batch_paths(tmpdir):
+    tap = Tap("127.0.0.1", "/tap")
+
+    def paths(ids, **kwargs):
+        retriever = DataLinkRetriever(tap, str(tmpdir), max_workers=1, **kwargs)
+        return retriever._batch_paths(ids)
+
+    assert paths([10, 11, 12]) == paths([12, 10, 11])
+    assert paths([10, 11, 12]) != paths([10, 13, 14])
+    assert not set(paths([10, 11, 12])) & set(paths([10, 11, 12], format="csv"))
+    assert not set(paths([10, 11, 12])) & set(paths([10, 11, 12], release="Gaia DR3"))
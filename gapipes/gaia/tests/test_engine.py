@@ -0,0 +1,158 @@
+from unittest.mock import MagicMock
+import numpy as np
+import pandas as pd
+import pytest
+
+from gapipes.gaia import healpix
+from gapipes.gaia.engine import LocalEngine, UnsupportedQuery, parse
+from gapipes.gaia.store import LocalStore
+from gapipes.gaia.tests.test_store import FakeTap
+
+
+@pytest.fixture
+def archive():
+    rng = np.random.RandomState(0)
+    n = 2000
+    pixel12 = np.sort(rng.randint(0, 12 * 4**12, size=n))
+    ra, dec = healpix.pix2ang(12, pixel12)
+    parallax = rng.uniform(-1, 10, n)
+    parallax[::50] = np.nan
+    return pd.DataFrame(
+        {
+            "source_id": pixel12 * 2**35 + np.arange(n),
+            "ra": ra,
+            "dec": dec,
+            "parallax": parallax,
+            "pmra": rng.normal(0, 10, n),
+            "pmdec": rng.normal(0, 10, n),
+        }
+    )
+
+
+def test_parse():
+    q = parse(
+        "SELECT DISTINCT TOP 5 g.source_id, g.parallax AS plx, "
+        "SQRT(POWER(g.pmra, 2) + g.pmdec*g.pmdec) pm "
+        "FROM gaiadr2.gaia_source AS g JOIN TAP_UPLOAD.t AS t "
+        "ON g.source_id = t.source_id "
+        "WHERE 1 = CONTAINS(POINT('ICRS', g.ra, g.dec), "
+        "CIRCLE('ICRS', 56.75, -24.1, 1.5)) "
+        "AND g.parallax BETWEEN 5 AND 10 AND g.bp_rp IS NOT NULL "
+        "ORDER BY plx DESC, g.source_id;"
+    )
+    assert q.distinct and q.top == 5
+    assert [name for _, name in q.items] == [None, "plx", "pm"]
+    assert q.tables == [("gaiadr2.gaia_source", "g"), ("TAP_UPLOAD.t", "t")]
+    assert [ascending for _, ascending in q.order_by] == [False, True]
+    assert "CIRCLE('ICRS', 56.75, (0 - 24.1), 1.5)" in q.where.to_adql()
+    with pytest.raises(UnsupportedQuery):
+        parse("SELECT a FROM foo GROUP BY a")
+    with pytest.raises(ValueError):
+        parse("SELECT a FROM foo WHERE")
+
+
+def test_dataframe_query(archive):
+    engine = LocalEngine({"gaia": archive})
+    df = engine.query(
+        "select top 10 source_id, parallax * 2 as p2, 'x' AS flag from gaia "
+        "where parallax > 5 and not (pmra < 0) order by parallax desc"
+    )
+    expected = archive.query("parallax > 5 and pmra >= 0").sort_values(
+        "parallax", ascending=False
+    )[:10]
+    assert list(df.columns) == ["source_id", "p2", "flag"]
+    assert list(df["source_id"]) == list(expected["source_id"])
+    assert np.allclose(df["p2"], 2 * expected["parallax"])
+    assert (df["flag"] == "x").all()
+
+    df = engine.query("SELECT * FROM gaia WHERE parallax IS NULL")
+    assert len(df) == archive["parallax"].isnull().sum()
+    assert list(df.columns) == list(archive.columns)
+
+
+def test_store_query(archive, tmpdir):
+    tap = FakeTap(archive)
+    store = LocalStore(str(tmpdir), tap=tap, level=2)
+    targets = archive.iloc[::100][["source_id"]].assign(target=np.arange(20))
+    engine = LocalEngine({"gaiadr2.gaia_source": store, "targets": targets})
+
+    df = engine.query(
+        "SELECT g.source_id, DISTANCE(POINT('ICRS', g.ra, g.dec), "
+        "POINT('ICRS', 200, -30)) AS d FROM gaiadr2.gaia_source AS g "
+        "WHERE 1 = CONTAINS(POINT('ICRS', g.ra, g.dec), CIRCLE('ICRS', 200, -30, 20)) "
+        "ORDER BY d"
+    )
+    d = healpix.separation(200, -30, archive["ra"], archive["dec"])
+    assert list(df["source_id"]) == list(archive["source_id"][np.argsort(d)][: len(df)])
+    assert len(df) == (d <= 20).sum()
+    # only partitions near the cone were fetched
+    assert 0 < len(store.partitions) < 40
+
+    # partitions pruned by joined source_ids
+    df = engine.query(
+        "SELECT t.target, g.pmra FROM targets AS t JOIN gaiadr2.gaia_source AS g "
+        "ON t.source_id = g.source_id ORDER BY t.target"
+    )
+    assert list(df["target"]) == list(range(20))
+    assert np.allclose(df["pmra"], archive["pmra"][::100])
+    expected = np.unique(healpix.source_id_to_pixel(targets["source_id"], 2))
+    assert set(expected) <= set(store.partitions)
+
+    with pytest.raises(UnsupportedQuery):
+        engine.query("SELECT * FROM gaiadr2.gaia_source WHERE source_id = 1")
+
+
+def test_remote_fallback():
+    tap = MagicMock()
+    engine = LocalEngine({"foo": pd.DataFrame({"a": [1, 2]})}, tap=tap)
+    assert list(engine.query("select a from foo where a = 2")["a"]) == [2]
+    assert not tap.query.called
+    engine.query("select count(*) from foo group by a")
+    engine.query("select b from bar")
+    assert tap.query.call_count == 2
+    assert tap.query.call_args[1]["async_"] == "auto"
+
+
+def test_nulls(archive):
+    engine = LocalEngine({"gaia": archive})
+    known = archive["parallax"].notnull()
+    df = engine.query("SELECT source_id FROM gaia WHERE NOT (parallax < 5)")
+    assert len(df) == (known & (archive["parallax"] >= 5)).sum()
+    df = engine.query("SELECT source_id FROM gaia WHERE parallax NOT BETWEEN 0 AND 5")
+    assert len(df) == (known & ~archive["parallax"].between(0, 5)).sum()
+
+    # NULLs last in ascending and first in descending order, as in PostgreSQL
+    df = engine.query("SELECT parallax FROM gaia ORDER BY parallax")
+    assert df["parallax"][known.sum() :].isnull().all()
+    df = engine.query("SELECT parallax FROM gaia ORDER BY parallax DESC")
+    assert df["parallax"][: (~known).sum()].isnull().all()
+    assert (np.diff(df["parallax"][(~known).sum() :]) <= 0).all()
+
+
+def test_output_names(archive):
+    engine = LocalEngine({"gaia": archive})
+    df = engine.query(
+        "SELECT 1 / parallax AS parallax FROM gaia WHERE parallax > 5 "
+        "ORDER BY parallax"
+    )
+    expected = 1 / archive["parallax"][archive["parallax"] > 5]
+    assert np.allclose(df["parallax"], np.sort(expected))
+
+
+def test_store_select_star_runs_remotely(archive, tmpdir):
+    tap = MagicMock()
+    store = LocalStore(str(tmpdir), tap=FakeTap(archive), level=2)
+    engine = LocalEngine({"gaiadr2.gaia_source": store}, tap=tap)
+    engine.query("SELECT * FROM gaiadr2.gaia_source WHERE source_id = 1")
+    assert tap.query.call_count == 1
+    assert not store.partitions
+
+
+def test_order_by_duplicate_index(archive):
+    df = pd.concat([archive.iloc[:5], archive.iloc[5:10]])
+    df.index = [0, 1, 2, 3, 4] * 2
+    engine = LocalEngine({"t": df})
+    result = engine.query("SELECT source_id, pmra FROM t ORDER BY pmra")
+    assert len(result) == 10
+    assert list(result["pmra"]) == sorted(df["pmra"])
+    assert sorted(result["source_id"]) == sorted(df["source_id"])
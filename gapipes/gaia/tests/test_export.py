@@ -0,0 +1,107 @@
+import os
+import sys
+import re
+import numpy as np
+import pandas as pd
+import pytest
+from astropy.table import Table
+
+from gapipes.gaia import adql
+from gapipes.gaia.export import TableExporter
+
+
+class FakeTap(object):
+    """Serves pages of a fake table with source_id from `TableExporter` queries"""
+
+    def __init__(self, data, fail_after=None):
+        self.data = data
+        self.fail_after = fail_after
+        self.queries = []
+
+    def query(self, query, **kwargs):
+        if self.fail_after is not None and len(self.queries) >= self.fail_after:
+            raise KeyboardInterrupt
+        self.queries.append(query)
+        top = adql.get_top(query)
+        lo, hi = map(
+            int,
+            re.search(r"source_id > (-?\d+) AND source_id <= (\d+)", query).groups(),
+        )
+        sid = self.data["source_id"]
+        return (
+            self.data.loc[(sid > lo) & (sid <= hi)].sort_values("source_id").head(top)
+        )
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(42)
+    sid_max = 12 * 4**12 * 2**35
+    # sources in a few pixels only
+    sid = np.unique(rng.randint(0, sid_max // 6, size=200, dtype=np.int64))
+    return pd.DataFrame({"source_id": sid, "ra": rng.uniform(size=len(sid))})
+
+
+def read_all(files):
+    return pd.concat([pd.read_csv(f) for f in files], ignore_index=True)
+
+
+def test_export(tmpdir, data):
+    tap = FakeTap(data)
+    exporter = TableExporter(
+        tap,
+        "foo",
+        str(tmpdir),
+        columns=["ra"],
+        level=1,
+        page_size=7,
+        max_workers=3,
+        format="csv",
+    )
+    files = exporter.run()
+    assert "source_id, ra" in tap.queries[0]
+    pd.testing.assert_frame_equal(read_all(files), data)
+    assert exporter.progress == (48, 48)
+
+
+def test_export_resume(tmpdir, data):
+    kwargs = dict(level=1, page_size=7, max_workers=1, format="csv")
+    with pytest.raises(KeyboardInterrupt):
+        TableExporter(FakeTap(data, fail_after=10), "foo", str(tmpdir), **kwargs).run()
+    assert os.path.exists(os.path.join(str(tmpdir), "checkpoint.json"))
+
+    tap = FakeTap(data)
+    files = TableExporter(tap, "foo", str(tmpdir), **kwargs).run()
+    pd.testing.assert_frame_equal(read_all(files), data)
+    # finished pages are not downloaded again
+    full = FakeTap(data)
+    TableExporter(full, "foo", str(tmpdir.join("full")), **kwargs).run()
+    assert len(tap.queries) == len(full.queries) - 10
+
+    # resuming with different parameters is refused
+    with pytest.raises(ValueError):
+        TableExporter(tap, "foo", str(tmpdir), where="ra > 0.5", **kwargs).run()
+
+
+def test_export_formats(tmpdir, data, monkeypatch):
+    files = TableExporter(FakeTap(data), "foo", str(tmpdir), level=0).run()
+    assert all(f.endswith(".fits") for f in files)
+    assert len(pd.concat([Table.read(f).to_pandas() for f in files])) == len(data)
+
+    # parquet writers are optional; fail before anything is downloaded
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    monkeypatch.setitem(sys.modules, "fastparquet", None)
+    with pytest.raises(ImportError):
+        TableExporter(FakeTap(data), "foo", str(tmpdir), format="parquet")
+
+
+def test_export_columns_string(tmpdir, data):
+    tap = FakeTap(data)
+    exporter = TableExporter(
+        tap, "foo", str(tmpdir), columns="ra ,dec", level=0, format="csv"
+    )
+    assert exporter.columns == "source_id, ra, dec"
+    assert exporter.page_query(-1, 10).startswith(
+        "SELECT TOP 100000 source_id, ra, dec"
+    )
+    assert TableExporter(tap, "foo", str(tmpdir), columns=" * ").columns == "*"
@@ -0,0 +1,83 @@
+import re
+from unittest.mock import MagicMock
+import numpy as np
+import pandas as pd
+import pytest
+import astropy.coordinates as coord
+
+from gapipes.gaia.lazy import LazyGaiaFrame
+
+
+@pytest.fixture
+def archive():
+    rng = np.random.RandomState(1)
+    n = 20
+    return pd.DataFrame(
+        {
+            "source_id": np.arange(n, dtype=np.int64) * 1000,
+            "ra": rng.uniform(0, 360, n),
+            "dec": rng.uniform(-90, 90, n),
+            "parallax": rng.uniform(1, 10, n),
+            "phot_g_mean_mag": rng.uniform(5, 20, n),
+        }
+    )
+
+
+@pytest.fixture
+def tap(archive):
+    tap = MagicMock()
+
+    def fake_query(query, upload_resource=None, **kwargs):
+        columns = re.findall(r"g\.(\w+)", query.split("FROM")[0])
+        ids = upload_resource["source_id"]
+        # the archive returns rows in arbitrary order
+        result = archive.loc[archive["source_id"].isin(ids), columns][::-1]
+        if kwargs["async_"]:
+            return MagicMock(**{"get_result.return_value": result})
+        return result
+
+    tap.query.side_effect = fake_query
+    return tap
+
+
+def test_lazy_frame(tap, archive):
+    ids = archive["source_id"].values[[3, 1, 3, 7]]
+    lf = LazyGaiaFrame(tap, ids, columns=list(archive.columns), batch_size=2)
+    assert len(lf) == 4
+    assert lf.cached_columns == ["source_id"]
+    assert tap.query.call_count == 0
+
+    assert np.allclose(lf["ra"], archive["ra"].values[[3, 1, 3, 7]])
+    # 3 unique ids in batches of 2
+    assert tap.query.call_count == 2
+    lf["ra"]
+    assert tap.query.call_count == 2
+
+    lf.fetch(["dec", "parallax", "ra"])
+    assert tap.query.call_count == 4
+    assert "g.ra" not in tap.query.call_args[0][0]
+    assert lf.cached_columns == ["source_id", "ra", "dec", "parallax"]
+
+    with pytest.raises(KeyError):
+        lf["foo"]
+    # batches are small enough for synchronous queries without a count
+    assert {c[1]["async_"] for c in tap.query.call_args_list} == {False}
+
+
+def test_lazy_frame_async(tap, archive):
+    ids = archive["source_id"].values
+    lf = LazyGaiaFrame(
+        tap, ids, columns=list(archive.columns), batch_size=8, sync_max_rows=5
+    )
+    assert np.allclose(lf["ra"], archive["ra"])
+    # batches of 8, 8 and 4 source_ids
+    assert [c[1]["async_"] for c in tap.query.call_args_list] == [True, True, False]
+
+
+def test_lazy_frame_accessor(tap, archive):
+    lf = LazyGaiaFrame(tap, archive["source_id"], columns=list(archive.columns))
+    icrs = lf.g.icrs
+    assert isinstance(icrs, coord.ICRS)
+    assert np.allclose(icrs.ra.deg, archive["ra"])
+    assert np.allclose(lf.g.distmod, 5 * np.log10(archive["parallax"]) - 10)
+    assert "phot_g_mean_mag" not in lf.cached_columns
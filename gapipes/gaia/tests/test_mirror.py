@@ -0,0 +1,123 @@
+from unittest.mock import patch, MagicMock
+import pandas as pd
+import pytest
+from requests.exceptions import ConnectionError, HTTPError, ReadTimeout
+
+from gapipes.gaia import Tap, MirroredTap
+from gapipes.gaia.utils import QueryError, QueryTimeout, JobError
+
+
+@pytest.fixture
+def mirrors():
+    return MirroredTap(
+        ["http://a.org/tap", "http://b.org/tap"], max_failures=2, cooldown=60
+    )
+
+
+def test_latency_routing(mirrors):
+    a, b = mirrors.endpoints
+    assert isinstance(a, Tap)
+    with patch.object(a, "query", return_value="a"), patch.object(
+        b, "query", return_value="b"
+    ):
+        # untried endpoints first
+        assert mirrors.query("select 1") == "a"
+        assert mirrors.query("select 1") == "b"
+        mirrors._stats[0].latency = 2.0
+        mirrors._stats[1].latency = 1.0
+        assert mirrors.query("select 1") == "b"
+    stats = mirrors.stats
+    assert list(stats["endpoint"]) == ["http://a.org/tap", "http://b.org/tap"]
+    assert list(stats["requests"]) == [1, 2]
+    assert stats["healthy"].all()
+
+
+def test_failover(mirrors):
+    a, b = mirrors.endpoints
+    with patch.object(a, "query", side_effect=ConnectionError("down")), patch.object(
+        b, "query", return_value="b"
+    ):
+        assert mirrors.query("select 1") == "b"
+        assert mirrors.query("select 1") == "b"
+        assert mirrors._ranked() == [1, 0]
+    stats = mirrors.stats
+    assert list(stats["failures"]) == [1, 0]
+
+    # unhealthy endpoints are tried when nothing else works
+    with patch.object(a, "query", side_effect=ConnectionError("down")), patch.object(
+        b, "query", side_effect=ConnectionError("down too")
+    ):
+        with pytest.raises(ConnectionError):
+            mirrors.query("select 1")
+    assert list(mirrors.stats["healthy"]) == [False, True]
+
+    # cooldown over
+    mirrors._stats[0].last_failure -= 61
+    assert mirrors.stats["healthy"].all()
+
+
+def test_client_error_not_retried(mirrors):
+    a, b = mirrors.endpoints
+    response = MagicMock(status_code=400)
+    error = HTTPError("bad query")
+    error.__cause__ = HTTPError(response=response)
+    with patch.object(a, "query", side_effect=error), patch.object(
+        b, "query", return_value=pd.DataFrame()
+    ) as bquery:
+        with pytest.raises(HTTPError):
+            mirrors.query("select foo")
+        assert not bquery.called
+    assert mirrors.stats["failures"].sum() == 0
+
+
+@pytest.mark.parametrize("error", [QueryTimeout("deadline"), JobError("bad ADQL")])
+def test_final_errors_not_retried(mirrors, error):
+    a, b = mirrors.endpoints
+    with patch.object(a, "query", side_effect=error), patch.object(
+        b, "query", return_value=pd.DataFrame()
+    ) as bquery:
+        with pytest.raises(type(error)):
+            mirrors.query("select foo", timeout=10)
+        assert not bquery.called
+    assert mirrors.stats["failures"].sum() == 0
+
+
+def test_shared_deadline(mirrors):
+    a, b = mirrors.endpoints
+    clock = [0.0]
+
+    def slow_failure(query, **kwargs):
+        clock[0] += 4
+        raise QueryError("empty")
+
+    with patch.object(a, "query", side_effect=slow_failure) as aquery, patch.object(
+        b, "query", return_value="b"
+    ) as bquery, patch("time.monotonic", lambda: clock[0]):
+        assert mirrors.query("select 1", timeout=10) == "b"
+    assert aquery.call_args[1]["timeout"] == 10
+    assert bquery.call_args[1]["timeout"] == 6
+
+
+def test_http_timeout_fails_over(mirrors):
+    a, b = mirrors.endpoints
+    with patch.object(a.session, "post", side_effect=ReadTimeout("slow")), patch.object(
+        b, "query", return_value="b"
+    ) as bquery:
+        assert mirrors.query("select 1", timeout=10) == "b"
+        assert bquery.call_args[1]["timeout"] <= 10
+    assert list(mirrors.stats["failures"]) == [1, 0]
+
+    # no time left for another endpoint
+    clock = [0.0]
+
+    def slow(query, **kwargs):
+        clock[0] += 10
+        raise QueryTimeout("slow") from ReadTimeout("slow")
+
+    with patch.object(a, "query", side_effect=slow), patch.object(
+        b, "query", side_effect=slow
+    ), patch("time.monotonic", lambda: clock[0]):
+        mirrors._stats[1].latency = 100.0
+        with pytest.raises(QueryTimeout):
+            mirrors.query("select 1", timeout=10)
+        assert a.query.call_count + b.query.call_count == 1
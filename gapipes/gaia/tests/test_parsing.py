@@ -0,0 +1,72 @@
+import os
+import pickle
+from unittest.mock import patch
+import numpy as np
+import pandas as pd
+import pytest
+from astropy.table import Table
+
+from gapipes.gaia import utils
+from gapipes.gaia.core import Tap
+from gapipes.gaia.parsing import ProcessPoolParser
+from gapipes import sharedmem
+
+
+@pytest.fixture
+def stored_responses():
+    fn = os.path.join(os.path.dirname(__file__), "data", "responses.pkl")
+    with open(fn, "rb") as f:
+        d = pickle.load(f)
+    return d
+
+
+def test_pack_arrays():
+    arrays = {
+        "a": np.arange(5, dtype="i2"),
+        "b": np.linspace(0, 1, 7),
+        "c": np.array(["x", "yy"]),
+        "d": np.zeros((0,)),
+    }
+    out = sharedmem.unpack_arrays(*sharedmem.pack_arrays(arrays))
+    assert list(out) == list(arrays)
+    for k in arrays:
+        assert out[k].dtype == arrays[k].dtype
+        assert np.array_equal(out[k], arrays[k])
+
+
+def test_process_pool_parser(stored_responses):
+    with ProcessPoolParser(max_workers=2) as parser:
+        content = stored_responses["sync_query"].content
+        expected = utils.parse_result_table(content, "csv")
+        df = parser.parse(content, "csv")
+        assert isinstance(df, pd.DataFrame)
+        pd.testing.assert_frame_equal(df, expected)
+
+        content = stored_responses["sync_query_votable"].content
+        expected = utils.parse_result_table(content, "votable")
+        t = parser.parse(content, "votable")
+        assert isinstance(t, Table)
+        assert t.colnames == expected.colnames
+        for name in t.colnames:
+            assert t[name].unit == expected[name].unit
+            np.testing.assert_array_equal(
+                np.ma.getdata(t[name]), np.ma.getdata(expected[name])
+            )
+            assert np.all(
+                np.ma.getmaskarray(t[name]) == np.ma.getmaskarray(expected[name])
+            )
+
+        with pytest.raises(ValueError):
+            parser.parse(content, "json")
+
+
+def test_tap_uses_parser(stored_responses):
+    tap = Tap("foo.bar", "foo")
+    with ProcessPoolParser(max_workers=1) as parser:
+        tap.parser = parser
+        with patch(
+            "gapipes.Tap._post_query", return_value=stored_responses["sync_query"]
+        ):
+            r = tap.query("sync_query")
+    assert isinstance(r, pd.DataFrame)
+    assert len(r) == 5
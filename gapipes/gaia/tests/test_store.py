@@ -0,0 +1,101 @@
+import re
+from unittest.mock import MagicMock
+import numpy as np
+import pandas as pd
+import pytest
+
+from gapipes.gaia import healpix
+from gapipes.gaia.store import LocalStore
+
+
+def test_pix2ang():
+    ra, dec = healpix.pix2ang(0, np.arange(12))
+    assert np.allclose(ra, [45, 135, 225, 315, 0, 90, 180, 270, 45, 135, 225, 315])
+    z = 2.0 / 3
+    d = np.rad2deg(np.arcsin(z))
+    assert np.allclose(dec, [d] * 4 + [0] * 4 + [-d] * 4)
+    # pixels are nested
+    ra1, dec1 = healpix.pix2ang(1, np.arange(48))
+    assert (
+        healpix.separation(ra1, dec1, ra[np.arange(48) // 4], dec[np.arange(48) // 4])
+        < healpix.pixel_radius(0)
+    ).all()
+
+
+class FakeTap(object):
+    def __init__(self, archive):
+        self.archive = archive
+        self.queries = []
+
+    def query(self, q, async_=False):
+        # partitions are fetched as async jobs without counting rows first
+        assert async_ is True
+        self.queries.append(q)
+        columns = [c.strip() for c in q[len("SELECT ") : q.index(" FROM")].split(",")]
+        lo, hi = map(int, re.search(r"BETWEEN (\d+) AND (\d+)", q).groups())
+        sid = self.archive["source_id"]
+        result = self.archive.loc[(sid >= lo) & (sid <= hi), columns]
+        return MagicMock(**{"get_result.return_value": result})
+
+
+@pytest.fixture
+def archive():
+    rng = np.random.RandomState(42)
+    pixel12 = np.sort(rng.randint(0, 12 * 4**12, size=3000))
+    ra, dec = healpix.pix2ang(12, pixel12)
+    return pd.DataFrame(
+        {
+            "source_id": pixel12 * 2**35 + np.arange(3000),
+            "ra": ra,
+            "dec": dec,
+            "parallax": rng.uniform(0, 10, 3000),
+            "pmra": rng.normal(0, 10, 3000),
+        }
+    )
+
+
+def test_local_store(archive, tmpdir):
+    tap = FakeTap(archive)
+    store = LocalStore(str(tmpdir), tap=tap, level=2)
+    df = store.cone(60.0, 20.0, 15.0, columns=["parallax"])
+    d = healpix.separation(60.0, 20.0, archive["ra"], archive["dec"])
+    expected = archive.loc[d <= 15.0]
+    assert list(df.columns) == ["source_id", "parallax"]
+    assert sorted(df["source_id"]) == sorted(expected["source_id"])
+    n = len(tap.queries)
+    assert 0 < n < 12 * 4**2
+    assert all("SELECT source_id, parallax, ra, dec FROM" in q for q in tap.queries)
+
+    # served from disk
+    df = store.cone(60.0, 20.0, 10.0, columns=["ra", "parallax"])
+    assert len(tap.queries) == n
+    assert len(df) == (d <= 10.0).sum()
+
+    # only missing column is fetched
+    df = store.cone(60.0, 20.0, 15.0, columns=["pmra", "parallax"])
+    assert len(tap.queries) == 2 * n
+    assert all(q.startswith("SELECT source_id, pmra FROM") for q in tap.queries[n:])
+    merged = df.merge(archive, on="source_id", suffixes=("", "_a"))
+    assert np.allclose(merged["pmra"], merged["pmra_a"])
+    assert np.allclose(merged["parallax"], merged["parallax_a"])
+
+    # reopen offline
+    offline = LocalStore(str(tmpdir), level=2)
+    assert offline.partitions == store.partitions
+    assert isinstance(offline.column(list(offline.partitions)[0], "ra"), np.memmap)
+    df = offline.cone(60.0, 20.0, 15.0, columns=["pmra"])
+    assert len(df) == len(expected)
+    with pytest.raises(KeyError):
+        offline.cone(240.0, -20.0, 5.0, columns=["pmra"])
+    with pytest.raises(ValueError):
+        LocalStore(str(tmpdir), level=3)
+
+
+def test_missing_strings(archive, tmpdir):
+    archive["flag"] = np.where(np.arange(len(archive)) % 3 == 0, None, "VARIABLE")
+    store = LocalStore(str(tmpdir), tap=FakeTap(archive), level=1)
+    df = store.load(range(48), ["flag"]).merge(archive, on="source_id")
+    assert len(df) == len(archive)
+    assert df["flag_x"].isnull().sum() == archive["flag"].isnull().sum()
+    assert (df["flag_x"].isnull() == df["flag_y"].isnull()).all()
+    assert (df["flag_x"].dropna() == "VARIABLE").all()
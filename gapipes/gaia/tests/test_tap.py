@@ -3,9 +3,13 @@ import pytest
 from unittest.mock import patch, MagicMock, create_autospec
 import pickle
 import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from astropy.table import Table
-from gapipes.gaia.core import Tap
+from gapipes.gaia.core import Tap, GaiaTapPlus
 from gapipes.gaia.utils import Job
 
 
@@ -99,3 +103,196 @@ def test_query_async(tap, mock_post_query):
 
     # test job attributes
     pass
+
+
+@pytest.fixture
+def stored_responses():
+    fn = os.path.join(os.path.dirname(__file__), "data", "responses.pkl")
+    with open(fn, "rb") as f:
+        d = pickle.load(f)
+    return d
+
+
+def test_threadsafe_sessions():
+    tap = Tap("foo.bar", "foo", threadsafe=True)
+    sessions = {}
+    barrier = threading.Barrier(8)
+
+    def get_session(i):
+        barrier.wait()
+        sessions[i] = tap.session
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(get_session, range(8)))
+    # each worker thread gets its own session sharing one cookie jar
+    assert len(set(map(id, sessions.values()))) > 1
+    assert all(s.cookies is tap._session.cookies for s in sessions.values())
+
+    tap = Tap("foo.bar", "foo")
+    assert tap.session is tap.session
+
+
+def test_tables_fetched_once_under_concurrency(stored_responses):
+    tap = Tap("foo.bar", "foo", threadsafe=True)
+    calls = []
+
+    def slow_get(url, *args, **kwargs):
+        calls.append(url)
+        time.sleep(0.05)
+        return stored_responses["tables"]
+
+    def get_metadata(i):
+        return tap.columns if i % 2 else tap.tables
+
+    with patch.object(requests.Session, "get", side_effect=slow_get):
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            results = list(pool.map(get_metadata, range(64)))
+
+    assert len(calls) == 1, "table metadata was fetched more than once"
+    assert all(r is not None for r in results)
+    assert tap.tables is results[0]
+
+
+def make_response(content, status_code=200):
+    r = requests.Response()
+    r.status_code = status_code
+    r._content = content
+    return r
+
+
+def test_query_auto(tap, stored_responses):
+    calls = []
+
+    def fake_post_query(query, async_=False, **kwargs):
+        calls.append((query, async_))
+        if query.startswith("SELECT COUNT(*)"):
+            assert kwargs["timeout"] == tap.auto_count_timeout
+            return make_response(b"n\n" + str(nrows).encode() + b"\n")
+        if not async_:
+            # the archive returns an empty body when sync queries time out
+            return make_response(b"")
+        return stored_responses["async_query"]
+
+    result = pd.DataFrame({"a": [1, 2]})
+    with patch("gapipes.Tap._post_query", side_effect=fake_post_query), patch(
+        "gapipes.gaia.utils.Job.get_result", return_value=result
+    ):
+        # small result: sync first, then escalate to async on time out
+        nrows = 10
+        r = tap.query("select * from foo order by a;", async_="auto")
+        assert r is result
+        assert calls[0] == (
+            "SELECT COUNT(*) AS n FROM (select * from foo) AS subquery",
+            False,
+        )
+        assert [c[1] for c in calls[1:]] == [False, True]
+
+        # large result: straight to async
+        calls.clear()
+        nrows = 10**7
+        r = tap.query("select * from foo", async_="auto")
+        assert r is result
+        assert [c[1] for c in calls] == [False, True]
+
+        # TOP n is used without counting
+        calls.clear()
+        r = tap.query("select top 5 * from foo", async_="auto")
+        assert calls == [
+            ("select top 5 * from foo", False),
+            ("select top 5 * from foo", True),
+        ]
+
+        # the upload is not sent again to count rows
+        calls.clear()
+        upload = pd.DataFrame({"source_id": [1, 2]})
+        r = tap.query(
+            "select * from tap_upload.t",
+            upload_resource=upload,
+            upload_table_name="t",
+            async_="auto",
+        )
+        assert r is result
+        assert calls == [("select * from tap_upload.t", True)]
+
+
+def test_query_sample(tap):
+    calls = []
+
+    def fake_post_query(query, async_=False, **kwargs):
+        calls.append(query)
+        return make_response(b"a\n1\n2\n")
+
+    with patch("gapipes.Tap._post_query", side_effect=fake_post_query):
+        r = tap.query("select a from foo", sample=0.5)
+        assert len(r) == 2
+        assert calls == ["select a from foo WHERE MOD(random_index, 1000000) < 500000"]
+
+        calls.clear()
+        r = tap.query("select a from foo", sample=2, stratify=0)
+        assert len(r) == 24
+        assert len(calls) == 12
+        assert all(
+            q.startswith("select TOP 2 a from foo WHERE source_id") for q in calls
+        )
+
+
+def test_query_timeout(tap):
+    with patch.object(
+        tap.session, "post", side_effect=requests.exceptions.ReadTimeout
+    ) as post:
+        with pytest.raises(TimeoutError):
+            tap.query("select top 5 * from foo", timeout=3)
+        assert post.call_args[1]["timeout"] == 3
+
+
+def test_iter_query():
+    tap = Tap("foo.bar", "foo", threadsafe=True)
+
+    def fake_query(query, **kwargs):
+        assert kwargs["async_"] == "auto"
+        time.sleep(0.01)
+        return pd.DataFrame({"q": [query]})
+
+    queries = ["select {:d}".format(i) for i in range(10)]
+    with patch.object(tap, "query", side_effect=fake_query):
+        results = list(tap.iter_query(queries, max_workers=3, read_ahead=2))
+    assert [r["q"][0] for r in results] == queries
+
+
+def test_cone_search():
+    gaia = GaiaTapPlus("foo.bar", "foo", server_context="foo", upload_context="Upload")
+    uploads = []
+
+    def fake_query(query, upload_resource=None, **kwargs):
+        assert kwargs["async_"] is True
+        assert "CIRCLE('ICRS', t.ra, t.dec, t.radius)" in query
+        uploads.append(upload_resource.copy())
+        job = MagicMock()
+        # one match per target
+        job.get_result.return_value = pd.DataFrame(
+            {
+                "target_idx": upload_resource["target_idx"].values,
+                "separation": 0.0,
+                "source_id": upload_resource["target_idx"].values * 10,
+            }
+        )
+        return job
+
+    with patch.object(gaia, "query", side_effect=fake_query):
+        r = gaia.cone_search(
+            np.arange(5.0),
+            np.zeros(5),
+            np.full(5, 0.1),
+            columns="source_id",
+            batch_size=2,
+        )
+    assert [len(u) for u in uploads] == [2, 2, 1]
+    assert set(uploads[0].columns) == {"target_idx", "ra", "dec", "radius"}
+    assert r["target_idx"].tolist() == [0, 1, 2, 3, 4]
+    assert r["source_id"].tolist() == [0, 10, 20, 30, 40]
+
+    with patch.object(gaia, "query") as query:
+        r = gaia.cone_search([], [], 0.1)
+    assert not query.called
+    assert len(r) == 0
+    assert list(r.columns) == ["target_idx", "separation"]
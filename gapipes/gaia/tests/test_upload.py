@@ -0,0 +1,69 @@
+import gzip
+import tracemalloc
+import requests
+from astropy.table import Table
+
+from gapipes.gaia.upload import MultipartStream, votable_tempfile
+
+
+def encode_with_requests(fields, files, boundary):
+    """Reference multipart body encoded by requests"""
+    body, content_type = requests.models.RequestEncodingMixin._encode_files(
+        files, fields
+    )
+    old_boundary = content_type.split("boundary=")[1]
+    return body.replace(old_boundary.encode(), boundary.encode())
+
+
+def test_multipart_matches_requests(tmpdir):
+    fields = {"REQUEST": "doQuery", "QUERY": "select * from tap_upload.t"}
+    content = bytes(range(256)) * 100
+    body = MultipartStream(fields=fields, files={"t": content}, chunk_size=1000)
+    expected = encode_with_requests(fields, {"t": content}, body.boundary)
+    assert body.len == len(expected)
+    assert b"".join(body) == expected
+
+    # binary file on disk, read in small pieces
+    path = tmpdir.join("t.bin")
+    path.write_binary(content)
+    body = MultipartStream(fields=fields, files={"t": str(path)}, chunk_size=1000)
+    expected = encode_with_requests(fields, {"t": ("t.bin", content)}, body.boundary)
+    assert body.len == len(expected)
+    out = b""
+    while True:
+        chunk = body.read(777)
+        if not chunk:
+            break
+        out += chunk
+    assert out == expected
+
+
+def test_multipart_generator_and_gzip():
+    chunks = [b"a" * 1000, b"b" * 1000]
+    body = MultipartStream(files={"t": iter(chunks)}, compress=True)
+    assert body.len is None  # sent with chunked transfer encoding
+    data = b"".join(body)
+    assert b'filename="t.gz"' in data
+    start = data.index(b"\r\n\r\n") + 4
+    end = data.rindex(b"\r\n--")
+    assert gzip.decompress(data[start:end]) == b"".join(chunks)
+
+
+def test_multipart_streams_large_file(tmpdir):
+    path = tmpdir.join("big.bin")
+    with open(str(path), "wb") as f:
+        for i in range(64):
+            f.write(b"x" * 2**20)
+    body = MultipartStream(files={"t": str(path)}, chunk_size=2**16)
+    tracemalloc.start()
+    size = sum(len(chunk) for chunk in body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert size == body.len
+    assert peak < 2**20
+
+
+def test_votable_tempfile():
+    t = Table({"a": [1, 2, 3]})
+    with votable_tempfile(t.to_pandas()) as f:
+        assert Table.read(f, format="votable")["a"].tolist() == [1, 2, 3]
@@ -1,6 +1,10 @@
 import os
 import pickle
+import threading
+import time
+from unittest.mock import MagicMock
 import pytest
+import requests
 
 from gapipes.gaia import utils
 
@@ -57,3 +61,93 @@ def test_job_error_message(stored_responses):
         " '1550663798739O': 1 unresolved identifiers: gaia_source "
         "[l.1 c.21 - l.1 c.35] !"
     )
+
+
+def test_prefetch_map():
+    lock = threading.Lock()
+    started = []
+    consumed = []
+
+    def work(i):
+        with lock:
+            started.append(i)
+        time.sleep(0.01)
+        return i * 2
+
+    results = []
+    for r in utils.prefetch_map(work, range(20), max_workers=4, read_ahead=3):
+        consumed.append(r // 2)
+        time.sleep(0.02)
+        with lock:
+            # never more than `read_ahead` items beyond the one being consumed
+            assert len(started) - len(consumed) <= 3
+        results.append(r)
+    assert results == [i * 2 for i in range(20)]
+
+    # stopping early does not evaluate the rest
+    started.clear()
+    for r in utils.prefetch_map(work, range(100), max_workers=2, read_ahead=2):
+        break
+    assert len(started) <= 3
+
+
+def test_deadline():
+    assert utils.Deadline().remaining() is None
+    deadline = utils.Deadline(10)
+    assert 9 < deadline.remaining() <= 10
+    deadline = utils.Deadline(0.01)
+    time.sleep(0.02)
+    assert deadline.left < 0
+    with pytest.raises(TimeoutError):
+        deadline.remaining()
+
+
+@pytest.fixture
+def executing_job(stored_responses):
+    text = stored_responses["async_query"].text.replace(
+        "<uws:phase>COMPLETED", "<uws:phase>EXECUTING"
+    )
+    session = MagicMock()
+    session.get.return_value = MagicMock(text=text)
+    return utils.Job(url="http://foo/async/1", phase="EXECUTING", session=session)
+
+
+def test_job_timeout_aborts(executing_job):
+    session = executing_job.session
+    with pytest.raises(utils.QueryTimeout):
+        executing_job.get_result(sleep=0.01, timeout=0.05)
+    assert session.get.call_args[1]["timeout"] <= 0.05
+    session.post.assert_called_once_with(
+        "http://foo/async/1/phase", data={"PHASE": "ABORT"}, timeout=10
+    )
+    assert executing_job.phase == "ABORTED"
+
+
+def test_job_interrupt_aborts(executing_job):
+    session = executing_job.session
+    session.get.side_effect = [session.get.return_value, KeyboardInterrupt]
+    with pytest.raises(KeyboardInterrupt):
+        executing_job.get_result(sleep=0.01)
+    assert session.post.call_args[1]["data"] == {"PHASE": "ABORT"}
+
+    # http timeout while polling
+    executing_job._phase = "EXECUTING"
+    session.get.side_effect = requests.exceptions.ReadTimeout
+    with pytest.raises(utils.QueryTimeout):
+        executing_job.get_result(sleep=0.01, timeout=1)
+    assert session.post.call_count == 2
+
+
+def test_job_requests_have_timeouts(executing_job):
+    session = executing_job.session
+    assert executing_job.get_result(wait=False, timeout=5) is None
+    executing_job._phase = "EXECUTING"
+    session.get.return_value = MagicMock(
+        text=session.get.return_value.text.replace(
+            "<uws:phase>EXECUTING", "<uws:phase>ERROR"
+        )
+    )
+    with pytest.raises(utils.JobError):
+        executing_job.get_result(sleep=0.01, timeout=5)
+    assert session.get.call_count == 2
+    assert all(0 < c[1]["timeout"] <= 5 for c in session.get.call_args_list)
@@ -0,0 +1,178 @@
+"""
+Streamed multipart/form-data request bodies for uploading tables
+
+Uploads are read from disk (or a generator) in small chunks while the
+request is sent, so memory use does not grow with the size of the table.
+"""
+import os
+import io
+import uuid
+import zlib
+import tempfile
+import pandas as pd
+from astropy.table import Table
+
+__all__ = ["MultipartStream", "votable_tempfile"]
+
+
+def votable_tempfile(table):
+    """Write a table to a temporary VOTable file
+
+    Parameters
+    ----------
+    table : pandas.DataFrame or astropy.table.Table
+        table to write
+
+    Returns
+    -------
+    file object
+        temporary file opened in binary mode and positioned at the start;
+        the file is deleted when closed
+    """
+    if isinstance(table, pd.DataFrame):
+        table = Table.from_pandas(table)
+    f = tempfile.TemporaryFile()
+    table.write(f, format="votable")
+    f.seek(0)
+    return f
+
+
+def _file_size(f):
+    """Size of the remaining content of a file object or None if unknown"""
+    try:
+        return os.fstat(f.fileno()).st_size - f.tell()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+    try:
+        pos = f.tell()
+        end = f.seek(0, io.SEEK_END)
+        f.seek(pos)
+        return end - pos
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+class MultipartStream(object):
+    """multipart/form-data body that is generated while it is sent
+
+    Pass an instance as `data` to `requests` together with its
+    `content_type` header. When the size of all parts is known in advance,
+    the request is sent with Content-Length; otherwise (generators or
+    compressed parts) it is sent with chunked transfer encoding.
+
+    Parameters
+    ----------
+    fields : dict, optional
+        form fields, name -> str
+    files : dict, optional
+        file parts, name -> source, where source is a path, bytes, a binary
+        file object or an iterable of bytes
+    compress : bool, optional
+        True to gzip the content of file parts while sending
+    chunk_size : int, optional
+        number of bytes read from files at a time
+
+    Examples
+    --------
+    >>> body = MultipartStream(fields={"TABLE_NAME": "t"}, files={"FILE": "t.vot"})
+    >>> requests.post(url, data=body, headers={"Content-Type": body.content_type})
+    """
+
+    def __init__(self, fields=None, files=None, compress=False, chunk_size=2**16):
+        self.boundary = uuid.uuid4().hex
+        self.fields = dict(fields or {})
+        self.files = dict(files or {})
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self._iterator = None
+        self._buffer = b""
+
+    @property
+    def content_type(self):
+        return "multipart/form-data; boundary={:s}".format(self.boundary)
+
+    def _field_header(self, name, filename=None):
+        disposition = 'Content-Disposition: form-data; name="{:s}"'.format(name)
+        if filename is not None:
+            disposition += '; filename="{:s}"'.format(filename)
+        header = "--{:s}\r\n{:s}\r\n".format(self.boundary, disposition)
+        if filename is not None and self.compress:
+            header += "Content-Type: application/gzip\r\n"
+        return (header + "\r\n").encode("utf-8")
+
+    def _filename(self, name, source):
+        if isinstance(source, str):
+            filename = os.path.basename(source)
+        else:
+            filename = name
+        return filename + ".gz" if self.compress else filename
+
+    def _source_size(self, source):
+        if isinstance(source, str):
+            return os.path.getsize(source)
+        if isinstance(source, bytes):
+            return len(source)
+        if hasattr(source, "read"):
+            return _file_size(source)
+        return None
+
+    def _iter_source(self, source):
+        if isinstance(source, bytes):
+            yield source
+        elif isinstance(source, str):
+            with open(source, "rb") as f:
+                yield from iter(lambda: f.read(self.chunk_size), b"")
+        elif hasattr(source, "read"):
+            yield from iter(lambda: source.read(self.chunk_size), b"")
+        else:
+            yield from source
+
+    def _iter_compressed(self, source):
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        for chunk in self._iter_source(source):
+            out = compressor.compress(chunk)
+            if out:
+                yield out
+        yield compressor.flush()
+
+    @property
+    def len(self):
+        """Total size in bytes, or None if it is not known in advance"""
+        size = 0
+        for name, value in self.fields.items():
+            size += len(self._field_header(name)) + len(str(value).encode("utf-8")) + 2
+        for name, source in self.files.items():
+            source_size = self._source_size(source)
+            if source_size is None or self.compress:
+                return None
+            header = self._field_header(name, self._filename(name, source))
+            size += len(header) + source_size + 2
+        return size + len("--{:s}--\r\n".format(self.boundary))
+
+    def __iter__(self):
+        for name, value in self.fields.items():
+            yield self._field_header(name)
+            yield str(value).encode("utf-8") + b"\r\n"
+        for name, source in self.files.items():
+            yield self._field_header(name, self._filename(name, source))
+            if self.compress:
+                yield from self._iter_compressed(source)
+            else:
+                yield from self._iter_source(source)
+            yield b"\r\n"
+        yield "--{:s}--\r\n".format(self.boundary).encode("utf-8")
+
+    def read(self, size=-1):
+        """Read up to `size` bytes of the body (all remaining if negative)"""
+        if self._iterator is None:
+            self._iterator = iter(self)
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._iterator, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            out, self._buffer = self._buffer, b""
+        else:
+            out, self._buffer = self._buffer[:size], self._buffer[size:]
+        return out
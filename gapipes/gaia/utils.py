@@ -2,11 +2,13 @@
 Utilities for parsing Tap and Gaia TapPlus HTML and XML responses
 """
 import io
+import itertools
 import logging
 import re
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from requests.exceptions import HTTPError
 from bs4 import BeautifulSoup
 import xml.etree.ElementTree as ET
 from astropy.table import Table
@@ -21,7 +23,13 @@ __all__ = [
     "parse_html_error_response",
     "parse_votable_error_response",
     "parse_tableset",
+    "parse_result_table",
     "Job",
+    "QueryError",
+    "QueryTimeout",
+    "JobError",
+    "Deadline",
+    "prefetch_map",
 ]
 
 # NOTE: Unique name spaces in all xml files in tests/data
@@ -43,10 +51,93 @@ ns = {
 }
 
 
+class QueryError(Exception):
+    pass
+
+
+class QueryTimeout(QueryError, TimeoutError):
+    """Query did not finish before its deadline"""
+
+
+class JobError(QueryError):
+    """Asynchronous job ended in ERROR phase, e.g., because of invalid ADQL"""
+
+
+class Deadline(object):
+    """Time limit shared by a sequence of blocking calls
+
+    Parameters
+    ----------
+    timeout : float or None
+        seconds from now; None for no limit
+    """
+
+    def __init__(self, timeout=None):
+        self.end = None if timeout is None else time.monotonic() + timeout
+
+    @property
+    def left(self):
+        """Seconds left (negative once passed), None if there is no limit"""
+        return None if self.end is None else self.end - time.monotonic()
+
+    def remaining(self):
+        """Seconds left, None if there is no limit
+
+        Raises
+        ------
+        QueryTimeout
+            if the deadline has passed
+        """
+        left = self.left
+        if left is not None and left <= 0:
+            raise QueryTimeout("Deadline exceeded")
+        return left
+
+
 def xstr(s):
     return "" if s is None else str(s)
 
 
+def prefetch_map(func, iterable, max_workers=2, read_ahead=2):
+    """Lazily map `func` over `iterable` while evaluating upcoming items in background
+
+    Results are yielded in order. While the caller works on one result,
+    up to `read_ahead` following items are evaluated in a thread pool, so at
+    most `read_ahead` + 1 results are held in memory at a time.
+
+    Parameters
+    ----------
+    func : callable
+        function to apply to each item
+    iterable : iterable
+        items
+    max_workers : int, optional
+        number of worker threads
+    read_ahead : int, optional
+        maximum number of results evaluated ahead of the one being consumed
+
+    Yields
+    ------
+    func(item) for each item in iterable
+    """
+    if read_ahead < 1:
+        raise ValueError("`read_ahead` must be at least 1")
+    items = iter(iterable)
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    futures = deque(pool.submit(func, x) for x in itertools.islice(items, read_ahead))
+    try:
+        while futures:
+            future = futures.popleft()
+            # top up the queue before blocking on the current result
+            for x in itertools.islice(items, 1):
+                futures.append(pool.submit(func, x))
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
 def parse_html_error_response(html):
     """Return a useful message from failed TAP request"""
     soup = BeautifulSoup(html, "html.parser")
@@ -126,6 +217,35 @@ def parse_tableset(xml):
     )
 
 
+def parse_result_table(content, format):
+    """Parse a result table according to its format
+
+    Parameters
+    ----------
+    content : bytes
+        body of the response with the result table
+    format : str
+        the table format, one of 'votable', 'csv' or 'fits'
+
+    Returns
+    -------
+    table : pd.DataFrame or astropy.table.Table
+        pandas.DataFrame for 'csv', astropy.table.Table otherwise
+    """
+    if format not in ["votable", "csv", "fits"]:
+        raise ValueError("format is not recognized")
+    if format == "csv":
+        return pd.read_csv(io.BytesIO(content))
+    elif format == "votable":
+        # suppress warnings by default
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return Table.read(io.BytesIO(content), format="votable")
+    elif format == "fits":
+        # TODO: this is broken but I don't know why.
+        return Table.read(io.BytesIO(content), format="fits")
+
+
 class Job(object):
     """Job on a TAP server
 
@@ -149,6 +269,9 @@ class Job(object):
         "name": "uws:name",
     }
 
+    # phases after which the job will not change anymore
+    _final_phases = ("COMPLETED", "ERROR", "ABORTED")
+
     def __init__(self, *args, **kwargs):
 
         self.jobid = kwargs.pop("jobid", None)
@@ -162,6 +285,8 @@ class Job(object):
             self.session = requests.session()
         else:
             self.session = session
+        # object with parse(content, format) method; see gapipes.gaia.parsing
+        self.parser = kwargs.pop("parser", None)
 
         # NOTE: possible phases are EXECUTING, PENDING, COMPLETED, ABORTED, ERROR
         self._phase = kwargs.pop("phase", None)
@@ -176,7 +301,7 @@ class Job(object):
         return s
 
     @classmethod
-    def from_response(cls, response, session=None):
+    def from_response(cls, response, session=None, parser=None):
         """
         Create Job from response from a TAP server
 
@@ -186,6 +311,8 @@ class Job(object):
             response from POST to /async
         session : requests.Session
             session object
+        parser : object, optional
+            parser used to decode the result, e.g., `ProcessPoolParser`
 
         Returns Job instance
         """
@@ -197,7 +324,7 @@ class Job(object):
         # assert response.headers['Content-Type'] == 'text/xml;charset=UTF-8'
 
         parsed = Job.parse_xml(response.text)
-        return cls(url=url, session=session, **parsed)
+        return cls(url=url, session=session, parser=parser, **parsed)
 
     @staticmethod
     def parse_xml(xml):
@@ -233,68 +360,121 @@ class Job(object):
     @property
     def phase(self):
         """Current status of the job"""
+        return self.update()
+
+    def update(self, timeout=None):
+        """Fetch the status of the job from the server unless it has ended
+
+        Parameters
+        ----------
+        timeout : float, optional
+            HTTP timeout [s]
+
+        Returns
+        -------
+        str
+            current phase
+        """
         if self.url is None:
             raise TypeError("Job url is not found")
-        else:
-            if self._phase is None or self._phase == "EXECUTING":
-                r = self.session.get(self.url)
-                try:
-                    r.raise_for_status()
-                    parsed = Job.parse_xml(r.text)
-                    self._phase = parsed["phase"]
-                    if parsed["phase"] == "COMPLETED":
-                        self.result_url = parsed["result_url"]
-                    return self._phase
-                except requests.exceptions.HTTPError as e:
-                    # TODO: some useful message
-                    raise e
-            else:
-                return self._phase
+        if self._phase not in Job._final_phases:
+            r = self.session.get(self.url, timeout=timeout)
+            # TODO: some useful message
+            r.raise_for_status()
+            parsed = Job.parse_xml(r.text)
+            self._phase = parsed["phase"]
+            self.message = parsed["message"]
+            if parsed["phase"] == "COMPLETED":
+                self.result_url = parsed["result_url"]
+        return self._phase
+
+    def abort(self, timeout=10):
+        """Ask the server to abort the job (UWS ``PHASE=ABORT``)
+
+        Parameters
+        ----------
+        timeout : float, optional
+            HTTP timeout [s]
+        """
+        if self.url is None:
+            raise TypeError("Job url is not found")
+        if self._phase in Job._final_phases:
+            return
+        logger.info("Aborting job {}".format(self.jobid))
+        r = self.session.post(
+            self.url.rstrip("/") + "/phase", data={"PHASE": "ABORT"}, timeout=timeout
+        )
+        r.raise_for_status()
+        self._phase = "ABORTED"
 
     @property
     def finished(self):
         return self.phase == "COMPLETED"
 
     # TODO: this should be cached
-    def get_result(self, sleep=0.5, wait=True):
+    def get_result(self, sleep=0.5, wait=True, timeout=None):
         """
         Get the result or wait until ready
 
+        When the timeout expires or the wait is interrupted (KeyboardInterrupt),
+        the job is aborted on the server before the exception is raised.
+
         Parameters
         ----------
         sleep: float
             Delay between status update for a given number of seconds
         wait: bool
             set to wait until result is ready
+        timeout: float, optional
+            maximum number of seconds to wait for and download the result
+
+        Raises
+        ------
+        JobError
+            if the job ended in ERROR phase
+        QueryError
+            if the job was aborted
+        QueryTimeout
+            if the result was not received within `timeout`
 
         Returns
         -------
         table: Astropy.Table
             votable result
         """
-        while (not self.finished) & wait:
-            time.sleep(sleep)
-        if not self.finished:
-            return
-        # Get results
+        deadline = Deadline(timeout)
         try:
-            r = self.session.get(self.result_url)
-            r.raise_for_status()
+            # poll only through update() so that every request has a timeout
+            phase = self.update(timeout=deadline.remaining())
+            while wait and phase not in Job._final_phases:
+                remaining = deadline.remaining()
+                time.sleep(sleep if remaining is None else min(sleep, remaining))
+                phase = self.update(timeout=deadline.remaining())
+            if phase == "COMPLETED":
+                r = self.session.get(self.result_url, timeout=deadline.remaining())
+                r.raise_for_status()
+        except requests.exceptions.Timeout as e:
+            self._abort_quietly()
+            raise QueryTimeout("Job {} timed out".format(self.jobid)) from e
+        except (QueryTimeout, KeyboardInterrupt):
+            self._abort_quietly()
+            raise
+        if phase in ("ERROR", "ABORTED"):
+            raise (JobError if phase == "ERROR" else QueryError)(
+                "Job {} ended in {} phase: {}".format(self.jobid, phase, self.message)
+            )
+        if phase != "COMPLETED":
+            return
+        if self.parser is not None:
+            return self.parser.parse(r.content, self.output_format)
+        return parse_result_table(r.content, self.output_format)
 
-            format_ = self.output_format
-            if format_ not in ["votable", "csv", "fits"]:
-                raise ValueError("format is not recognized")
-            if format_ == "csv":
-                return pd.read_csv(io.StringIO(r.text))
-            elif format_ == "votable":
-                # suppress warnings by default
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    return Table.read(io.BytesIO(r.content), format="votable")
-            elif format_ == "fits":
-                return Table.read(io.BytesIO(r.content), format="fits")
-        except HTTPError as e:
-            raise e
+    def _abort_quietly(self):
+        """Abort job without raising; used while another exception propagates"""
+        try:
+            self.abort()
+        except Exception as e:
+            logger.warning("Could not abort job {}: {}".format(self.jobid, e))
 
 
 class TapPlusJob(Job):
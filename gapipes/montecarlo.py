@@ -0,0 +1,166 @@
+"""
+Monte Carlo propagation of Gaia uncertainties to derived quantities
+
+Correlated realisations of the astrometric parameters of each source are
+drawn from the covariance matrices given by `gapipes.pipes.make_cov`,
+derived quantities are computed for all realisations at once, and their
+percentiles are returned. Sources are processed in chunks, so memory use
+is bounded by ``chunk_size * size``.
+
+>>> from gapipes import montecarlo as mc
+>>> result = mc.propagate(
+...     df, [mc.distance, mc.vtan, mc.xv(coord.Galactic())], size=1000)
+>>> result[["distance_p16", "distance_p50", "distance_p84"]]
+"""
+import warnings
+import numpy as np
+import pandas as pd
+import astropy.units as u
+
+from . import covariance
+from .pipes import make_cov, _tokms
+
+__all__ = ["propagate", "distance", "vtan", "xv"]
+
+
+class _Draws(object):
+    """Dict-like flattened draws of sampled columns and repeated other columns
+
+    Values are arrays of length (number of sources) * (draws per source).
+    """
+
+    def __init__(self, df, draws, columns):
+        self.df = df
+        self.size = draws.shape[1]
+        self.draws = {c: draws[:, :, i].ravel() for i, c in enumerate(columns)}
+
+    def keys(self):
+        return list(self.df.keys())
+
+    def __contains__(self, key):
+        return key in self.df
+
+    def __getitem__(self, key):
+        if key not in self.draws:
+            self.draws[key] = np.repeat(np.asarray(self.df[key]), self.size)
+        return self.draws[key]
+
+
+def distance(d):
+    """Distance [pc]"""
+    return {"distance": 1e3 / d["parallax"]}
+
+
+def vtan(d):
+    """Tangential velocities 'vra', 'vdec' [km/s] (see `gapipes.pipes.add_vtan`)"""
+    return {
+        "vra": d["pmra"] / d["parallax"] * _tokms,
+        "vdec": d["pmdec"] / d["parallax"] * _tokms,
+    }
+
+
+def xv(frame, unit=u.pc):
+    """Quantity function for x, y, z, vx, vy, vz in `frame`
+
+    The frame must have an affine transformation from ICRS, e.g., Galactic
+    or Galactocentric (see `gapipes.affine`).
+    """
+    from . import affine
+
+    f = affine.AffineFrame(frame)
+
+    def func(d):
+        x, v = f.xv(d, unit=unit)
+        return dict(zip(["x", "y", "z", "vx", "vy", "vz"], list(x) + list(v)))
+
+    return func
+
+
+def _to_degrees(chunk, columns):
+    """(N, n) factors converting errors of `columns` to their value units
+
+    Values of ra and dec are in degrees while their errors are in mas, and
+    ra_error is the error of ra * cos(dec).
+    """
+    scale = np.ones((len(chunk), len(columns)))
+    for i, c in enumerate(columns):
+        if c == "dec":
+            scale[:, i] = 1 / 3.6e6
+        elif c == "ra":
+            scale[:, i] = 1 / (3.6e6 * np.cos(np.deg2rad(np.asarray(chunk["dec"]))))
+    return scale
+
+
+def propagate(
+    df,
+    quantities,
+    size=100,
+    columns=["parallax", "pmra", "pmdec"],
+    percentiles=(16, 50, 84),
+    chunk_size=10000,
+    random_state=None,
+):
+    """Percentiles of derived quantities under Gaia uncertainties
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Gaia data with values, `_error` and `_corr` columns of `columns`
+    quantities : list of callable
+        functions of a dict-like of flattened draws returning a dict of
+        derived arrays, e.g., `distance`, `vtan` or ``xv(frame)``. Columns not
+        in `columns` are repeated for every draw.
+    size : int, optional
+        number of draws per source
+    columns : list of str, optional
+        parameters to draw (see `gapipes.pipes.make_cov`); other columns
+        are taken as exact. Parameters with NaN value or error in a row are
+        NaN in all draws of that row. Errors of ra and dec [mas] are
+        converted to degrees, the unit of their values.
+    percentiles : sequence of float, optional
+        percentiles to compute
+    chunk_size : int, optional
+        number of sources processed at a time
+    random_state : int or numpy.random.RandomState, optional
+        seed or random number generator
+
+    Returns
+    -------
+    pandas.DataFrame
+        '{quantity}_p{percentile}' columns with the index of `df`
+    """
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+    columns = list(columns)
+    results = {}
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start : start + chunk_size]
+        mean = np.stack([np.asarray(chunk[c], dtype=float) for c in columns], -1)
+        cov = make_cov(chunk, columns=columns, packed=True)
+        scale = _to_degrees(chunk, columns)
+        for k, (i, j) in enumerate(zip(*np.triu_indices(len(columns)))):
+            cov.data[:, k] *= scale[:, i] * scale[:, j]
+        # a column whose value or error is NaN, e.g., radial_velocity of most
+        # sources, is drawn as NaN without spoiling the other columns
+        missing = np.isnan(mean) | np.isnan(cov.diagonal())
+        for k, (i, j) in enumerate(zip(*np.triu_indices(len(columns)))):
+            rows = missing[:, i] | missing[:, j]
+            cov.data[rows, k] = 1.0 if i == j else 0.0
+        draws = covariance.sample(
+            np.where(missing, 0.0, mean), cov, size, random_state=random_state
+        )
+        draws[np.broadcast_to(missing[:, None, :], draws.shape)] = np.nan
+        d = _Draws(chunk, draws, columns)
+        for func in quantities:
+            for name, values in func(d).items():
+                with warnings.catch_warnings():
+                    # sources with invalid covariances have only NaN draws
+                    warnings.simplefilter("ignore", RuntimeWarning)
+                    p = np.nanpercentile(
+                        np.reshape(values, (len(chunk), size)), percentiles, axis=1
+                    )
+                for q, v in zip(percentiles, p):
+                    results.setdefault("{:s}_p{:g}".format(name, q), []).append(v)
+    return pd.DataFrame(
+        {k: np.concatenate(v) for k, v in results.items()}, index=df.index
+    )
@@ -0,0 +1,172 @@
+"""
+Coordinate transformations of large tables on many cores
+
+The input columns are copied once into shared memory. Worker processes
+transform blocks of rows with astropy and write cartesian coordinates into a
+shared output block, so no DataFrame or coordinate object is pickled.
+
+>>> from gapipes import parallel
+>>> df = parallel.add_xv(df, coord.Galactic(), max_workers=8)
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import astropy.coordinates as coord
+import astropy.units as u
+
+from . import pipes
+from . import sharedmem
+
+__all__ = ["transform_xyz", "transform", "add_x", "add_xv"]
+
+_x_names = ["x", "y", "z"]
+_v_names = ["vx", "vy", "vz"]
+
+
+def _transform_block(frame, unit, velocities, inputs, outputs, start, stop):
+    """Transform rows start:stop in a worker process"""
+    with sharedmem.attach_arrays(*inputs) as arrays:
+        data = {name: arrays[name][start:stop].copy() for name in arrays}
+    c = pipes.make_icrs(data, include_pm_rv=velocities).transform_to(frame)
+    values = list(c.cartesian.xyz.to(unit).value)
+    if velocities:
+        values += list(c.velocity.d_xyz.to(u.km / u.s).value)
+    with sharedmem.attach_arrays(*outputs) as arrays:
+        for name, v in zip(_x_names + _v_names, values):
+            arrays[name][start:stop] = v
+
+
+def _blocks(N, max_workers, block_size):
+    """Row ranges of blocks; a few per worker to balance the load"""
+    if block_size is None:
+        block_size = max(1, -(-N // (4 * max_workers)))
+    return [(start, min(start + block_size, N)) for start in range(0, N, block_size)]
+
+
+def transform_xyz(
+    df, frame, unit=u.pc, velocities=True, max_workers=None, block_size=None
+):
+    """Cartesian coordinates (and velocities) in `frame` computed in parallel
+
+    Parameters
+    ----------
+    df : pandas.DataFrame, dict-like
+        Gaia data with ra, dec, parallax and, for velocities, pmra, pmdec and
+        optionally radial_velocity
+    frame : astropy coordinate frame
+        frame to transform to
+    unit : astropy.units.Unit, optional
+        unit of positions; velocities are in km/s
+    velocities : bool, optional
+        False to transform positions only
+    max_workers : int, optional
+        number of worker processes; the default is the number of CPUs
+    block_size : int, optional
+        number of rows per task; by default each worker gets about four tasks
+
+    Returns
+    -------
+    dict
+        'x', 'y', 'z' and, with `velocities`, 'vx', 'vy', 'vz' arrays
+    """
+    columns = ["ra", "dec", "parallax"]
+    if velocities:
+        columns += [
+            c for c in ("pmra", "pmdec", "radial_velocity") if c in set(df.keys())
+        ]
+    if not set(["ra", "dec", "parallax"]) <= set(df.keys()):
+        raise AttributeError("Must have 'ra', 'dec', 'parallax'.")
+    N = len(df["ra"])
+    names = _x_names + (_v_names if velocities else [])
+    max_workers = max_workers or os.cpu_count() or 1
+    with sharedmem.SharedArrays(
+        {c: (float, (N,)) for c in columns}
+    ) as inputs, sharedmem.SharedArrays({c: (float, (N,)) for c in names}) as outputs:
+        for c in columns:
+            inputs.arrays[c][:] = np.asarray(df[c], dtype=float)
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(
+                    _transform_block,
+                    frame,
+                    unit,
+                    velocities,
+                    (inputs.name, inputs.layout),
+                    (outputs.name, outputs.layout),
+                    start,
+                    stop,
+                )
+                for start, stop in _blocks(N, max_workers, block_size)
+            ]
+            for f in futures:
+                f.result()
+        return {c: outputs.arrays[c].copy() for c in names}
+
+
+def transform(df, frame, max_workers=None, block_size=None):
+    """Coordinates of Gaia data in `frame`, transformed in parallel
+
+    The parallel equivalent of ``make_icrs(df).transform_to(frame)``.
+
+    Returns
+    -------
+    astropy coordinate frame
+        an instance of the class of `frame` with the same frame attributes
+    """
+    if isinstance(frame, type):
+        frame = frame()
+    velocities = {"pmra", "pmdec"} <= set(df.keys())
+    xyz = transform_xyz(
+        df,
+        frame,
+        velocities=velocities,
+        max_workers=max_workers,
+        block_size=block_size,
+    )
+    rep = coord.CartesianRepresentation(xyz["x"], xyz["y"], xyz["z"], unit=u.pc)
+    if velocities:
+        rep = rep.with_differentials(
+            coord.CartesianDifferential(
+                xyz["vx"], xyz["vy"], xyz["vz"], unit=u.km / u.s
+            )
+        )
+    c = frame.realize_frame(rep)
+    c.representation_type = frame.representation_type
+    c.differential_type = frame.differential_type
+    return c
+
+
+def add_x(df, frame, unit=u.pc, max_workers=None, block_size=None):
+    """Add cartesian coordinates `x`, `y`, `z` of a given `frame` in parallel
+
+    See `gapipes.pipes.add_x` and `transform_xyz`.
+    """
+    xyz = transform_xyz(
+        df,
+        frame,
+        unit=unit,
+        velocities=False,
+        max_workers=max_workers,
+        block_size=block_size,
+    )
+    df = df.copy()
+    for c in _x_names:
+        df[c] = xyz[c]
+    return df
+
+
+def add_xv(df, frame, unit=u.pc, max_workers=None, block_size=None):
+    """Add x, y, z, vx, vy, vz for a given `frame` in parallel
+
+    See `gapipes.pipes.add_xv` and `transform_xyz`.
+    """
+    if not isinstance(df, pd.DataFrame):
+        raise ValueError("df should be a pandas.DataFrame")
+    xyz = transform_xyz(
+        df, frame, unit=unit, max_workers=max_workers, block_size=block_size
+    )
+    df = df.copy()
+    for c in _x_names + _v_names:
+        df[c] = xyz[c]
+    return df
@@ -0,0 +1,259 @@
+"""
+Fused computation of derived columns
+
+Each function in `gapipes.pipes` copies its input, so chaining several of
+them copies a wide table several times. A `Pipeline` runs the same
+calculations together: it checks up front that the columns it needs are
+present, computes intermediate values such as 1/parallax once for all steps,
+and adds all new columns to a single copy of the table (or to the table
+itself with ``inplace=True``).
+
+>>> p = Pipeline("vtan", "vtan_errors", "gMag", "good_phot", "ruwe")
+>>> df = df.pipe(p)
+"""
+import numpy as np
+import astropy.units as u
+
+from . import cuts
+from . import pipes
+
+__all__ = ["Pipeline", "Step"]
+
+
+class Step(object):
+    """Calculation of derived columns
+
+    Parameters
+    ----------
+    func : callable
+        function of a dict-like namespace of columns and shared intermediate
+        values, returning one array per produced column
+    requires : list of str
+        columns needed from the input table or earlier steps
+    produces : list of str
+        names of columns produced
+    name : str, optional
+        name of the step
+    """
+
+    def __init__(self, func, requires, produces, name=None):
+        self.func = func
+        self.requires = list(requires)
+        self.produces = list(produces)
+        self.name = name or getattr(func, "__name__", "step")
+
+    def __repr__(self):
+        return "Step({!r}: {} -> {})".format(self.name, self.requires, self.produces)
+
+
+# intermediate values shared by steps, computed at most once per run
+_shared = {
+    "_inv_parallax": lambda ns: 1.0 / ns["parallax"],
+    "_distmod": lambda ns: 5 * np.log10(ns["parallax"]) - 10,
+    "_uwe": lambda ns: np.sqrt(
+        ns["astrometric_chi2_al"] / (ns["astrometric_n_good_obs_al"] - 5)
+    ),
+}
+
+
+class _Namespace(object):
+    """Columns of a table, new columns and shared intermediate values"""
+
+    def __init__(self, df):
+        self.df = df
+        self.outputs = {}
+        self._cache = {}
+
+    def keys(self):
+        return list(self.df.keys()) + list(self.outputs)
+
+    def __contains__(self, key):
+        return key in self.outputs or key in self.df
+
+    def __getitem__(self, key):
+        if key in self.outputs:
+            return self.outputs[key]
+        if key not in self._cache:
+            if key in _shared:
+                self._cache[key] = _shared[key](self)
+            else:
+                self._cache[key] = np.asarray(self.df[key])
+        return self._cache[key]
+
+
+def _vtan(ns):
+    inv_parallax = ns["_inv_parallax"]
+    return (
+        ns["pmra"] * inv_parallax * pipes._tokms,
+        ns["pmdec"] * inv_parallax * pipes._tokms,
+    )
+
+
+def _vtan_errors(ns):
+    inv_parallax = ns["_inv_parallax"]
+    # parallax_error / parallax**2
+    dplx = ns["parallax_error"] * inv_parallax**2
+    return (
+        np.hypot(ns["pmra_error"] * inv_parallax, dplx * ns["pmra"]) * pipes._tokms,
+        np.hypot(ns["pmdec_error"] * inv_parallax, dplx * ns["pmdec"]) * pipes._tokms,
+    )
+
+
+def _ruwe(ns):
+    return ns["_uwe"] / pipes.calculate_uwe0(ns["bp_rp"], ns["phot_g_mean_mag"])
+
+
+def _a_g_error(ns):
+    return (
+        ns["a_g_val"] - ns["a_g_percentile_lower"],
+        ns["a_g_percentile_upper"] - ns["a_g_val"],
+    )
+
+
+#: steps by name; named after the `gapipes.pipes` functions they replace
+steps = {
+    "vtan": Step(_vtan, ["pmra", "pmdec", "parallax"], ["vra", "vdec"], "vtan"),
+    "vtan_errors": Step(
+        _vtan_errors,
+        ["pmra", "pmdec", "parallax", "pmra_error", "pmdec_error", "parallax_error"],
+        ["vra_error", "vdec_error"],
+        "vtan_errors",
+    ),
+    "distmod": Step(lambda ns: ns["_distmod"], ["parallax"], ["distmod"], "distmod"),
+    "gMag": Step(
+        lambda ns: ns["phot_g_mean_mag"] + ns["_distmod"],
+        ["phot_g_mean_mag", "parallax"],
+        ["gMag"],
+        "gMag",
+    ),
+    "good_phot": Step(
+        lambda ns: np.asarray(cuts.good_phot.mask(ns)),
+        ["phot_bp_rp_excess_factor", "bp_rp"],
+        ["good_phot"],
+        "good_phot",
+    ),
+    "uwe": Step(
+        lambda ns: ns["_uwe"],
+        ["astrometric_chi2_al", "astrometric_n_good_obs_al"],
+        ["uwe"],
+        "uwe",
+    ),
+    "ruwe": Step(
+        _ruwe,
+        [
+            "astrometric_chi2_al",
+            "astrometric_n_good_obs_al",
+            "bp_rp",
+            "phot_g_mean_mag",
+        ],
+        ["ruwe"],
+        "ruwe",
+    ),
+    "a_g_error": Step(
+        _a_g_error,
+        ["a_g_val", "a_g_percentile_lower", "a_g_percentile_upper"],
+        ["a_g_lerr", "a_g_uerr"],
+        "a_g_error",
+    ),
+}
+
+
+def x(frame, unit=u.pc):
+    """Step adding cartesian coordinates x, y, z in `frame` (see `pipes.add_x`)"""
+
+    def func(ns):
+        c = pipes.make_icrs(ns, include_pm_rv=False).transform_to(frame)
+        return tuple(c.cartesian.xyz.to(unit).value)
+
+    return Step(func, ["ra", "dec", "parallax"], ["x", "y", "z"], "x")
+
+
+def xv(frame, unit=u.pc):
+    """Step adding x, y, z, vx, vy, vz in `frame` (see `pipes.add_xv`)"""
+
+    def func(ns):
+        c = pipes.make_icrs(ns).transform_to(frame)
+        return tuple(c.cartesian.xyz.to(unit).value) + tuple(c.velocity.d_xyz.value)
+
+    return Step(
+        func,
+        ["ra", "dec", "parallax", "pmra", "pmdec"],
+        ["x", "y", "z", "vx", "vy", "vz"],
+        "xv",
+    )
+
+
+class Pipeline(object):
+    """Sequence of steps adding derived columns in one pass
+
+    Parameters
+    ----------
+    *steps : str or Step
+        names of steps in `gapipes.pipeline.steps` or `Step` instances,
+        e.g., made by `gapipes.pipeline.xv`
+
+    Examples
+    --------
+    >>> from gapipes import pipeline
+    >>> p = Pipeline("vtan", "gMag", pipeline.xv(coord.Galactic()))
+    >>> p.requires
+    >>> df = p(df)             # one copy of df
+    >>> p(df, inplace=True)    # no copy
+    """
+
+    def __init__(self, *steps_):
+        self.steps = [steps[s] if isinstance(s, str) else s for s in steps_]
+
+    @property
+    def requires(self):
+        """Columns the input table must have"""
+        required, produced = [], set()
+        for step in self.steps:
+            required += [
+                c for c in step.requires if c not in produced and c not in required
+            ]
+            produced.update(step.produces)
+        return required
+
+    @property
+    def produces(self):
+        """Columns added to the table"""
+        return [c for step in self.steps for c in step.produces]
+
+    def __call__(self, df, inplace=False):
+        """Add derived columns to `df`
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            Gaia data
+        inplace : bool, optional
+            True to add columns to `df` itself instead of a copy
+
+        Raises
+        ------
+        KeyError
+            if `df` lacks columns required by the steps
+
+        Returns
+        -------
+        pandas.DataFrame
+            table with new columns; `df` itself if `inplace`
+        """
+        missing = [c for c in self.requires if c not in df]
+        if missing:
+            raise KeyError("Pipeline requires missing columns {}".format(missing))
+        ns = _Namespace(df)
+        for step in self.steps:
+            values = step.func(ns)
+            if len(step.produces) == 1:
+                values = (values,)
+            for name, value in zip(step.produces, values):
+                ns.outputs[name] = value
+        out = df if inplace else df.copy()
+        for name, value in ns.outputs.items():
+            out[name] = value
+        return out
+
+    def __repr__(self):
+        return "Pipeline({:s})".format(", ".join(repr(s.name) for s in self.steps))
@@ -7,6 +7,9 @@ import pandas as pd
 import astropy.coordinates as coord
 import astropy.units as u
 
+from . import cuts
+from . import covariance
+
 __all__ = [
     "calculate_vtan_error",
     "add_vtan_errors",
@@ -102,28 +105,42 @@ def make_icrs(df, include_pm_rv=True):
     return c
 
 
-def make_cov(df, columns=["parallax", "pmra", "pmdec"]):
+def make_cov(df, columns=["parallax", "pmra", "pmdec"], packed=False, dtype=float):
     """Generate covariance matrix from Gaia data
 
     columns : list
         list of columns to calculate covariance.
-        Must be a subset of 'ra', 'dec' 'parallax', 'pmra', 'pmdec'.
+        Must be a subset of 'ra', 'dec' 'parallax', 'pmra', 'pmdec',
+        'radial_velocity'. Gaia does not publish correlations of
+        radial_velocity with astrometry; they are taken to be zero.
+    packed : bool, optional
+        True to return `gapipes.covariance.PackedCov` holding only the upper
+        triangles, without making the dense array
+    dtype : numpy dtype, optional
+        dtype of the packed matrices, e.g., np.float32 to halve memory
 
     Returns
     -------
-    numpy.array
+    numpy.array or PackedCov
         (N, number of columns) array of covariance matrices
+
+    See Also
+    --------
+    gapipes.covariance : batched inverses, Cholesky factors, etc.
     """
-    gaia_order = ["ra", "dec", "parallax", "pmra", "pmdec"]
+    gaia_order = ["ra", "dec", "parallax", "pmra", "pmdec", "radial_velocity"]
     N = len(np.atleast_1d(df[columns[0] + "_error"]))  # N could be 1
     n = len(columns)
-    C = np.zeros([N, n, n])
+    iu = np.triu_indices(n)
+    P = np.zeros([N, len(iu[0])], dtype=dtype if packed else float)
 
-    for i, j in zip(*np.triu_indices(n)):
+    for k, (i, j) in enumerate(zip(*iu)):
         if i == j:
-            C[:, [i], [j]] = np.atleast_1d(
+            P[:, k] = np.atleast_1d(
                 df[f"{columns[i]}_error"] * df[f"{columns[j]}_error"]
-            )[:, None]
+            )
+        elif "radial_velocity" in (columns[i], columns[j]):
+            continue
         else:
             corr_name = (
                 "_".join(
@@ -131,32 +148,50 @@ def make_cov(df, columns=["parallax", "pmra", "pmdec"]):
                 )
                 + "_corr"
             )
-            C[:, [i, j], [j, i]] = np.atleast_1d(
+            P[:, k] = np.atleast_1d(
                 df[f"{columns[i]}_error"] * df[f"{columns[j]}_error"] * df[corr_name]
-            )[:, None]
-    return C.squeeze()
+            )
+    P = covariance.PackedCov(P, n)
+    if packed:
+        return P
+    return P.dense().squeeze()
 
 
-def add_x(df, frame, unit=u.pc):
-    """Add cartesian coordinates `x`, `y`, `z` of a given `frame`"""
+def add_x(df, frame, unit=u.pc, max_workers=None):
+    """Add cartesian coordinates `x`, `y`, `z` of a given `frame`
+
+    With `max_workers`, the transformation runs in that many processes
+    (see `gapipes.parallel`).
+    """
+    if max_workers is not None:
+        from . import parallel
+
+        return parallel.add_x(df, frame, unit=unit, max_workers=max_workers)
     df = df.copy()
     c = make_icrs(df, include_pm_rv=False).transform_to(frame)
     df["x"], df["y"], df["z"] = c.cartesian.xyz.to(unit).value
     return df
 
 
-def add_xv(df, frame, unit=u.pc):
+def add_xv(df, frame, unit=u.pc, max_workers=None):
     """Add cartesian coordinates x, y, z, vx, vy, vz for a given `frame`
 
     df : pd.DataFrame
         Gaia DR2 data
     frame : astropy coordinate frame
         Frame to calculate coordinates in
+    max_workers : int, optional
+        number of processes to transform blocks of rows in
+        (see `gapipes.parallel`); by default, transform in this process
 
     Returns df with x, y, z, vx, vy, vz columns added.
     """
     if not isinstance(df, pd.DataFrame):
         raise ValueError("df should be a pandas.DataFrame")
+    if max_workers is not None:
+        from . import parallel
+
+        return parallel.add_xv(df, frame, unit=unit, max_workers=max_workers)
     df = df.copy()
     c = make_icrs(df).transform_to(frame)
     df["x"], df["y"], df["z"] = c.cartesian.xyz.to(unit).value
@@ -199,39 +234,96 @@ def add_gMag(df):
 def flag_good_phot(df):
     """Add 'good_phot' boolean column to the dataframe
 
-    TODO: explain
+    The cut on BP/RP flux excess factor is `gapipes.cuts.good_phot`, which
+    can also be applied on the server in queries.
     """
     df = df.copy()
-    good_phot = (df["phot_bp_rp_excess_factor"] > 1 + 0.015 * df["bp_rp"] ** 2) & (
-        df["phot_bp_rp_excess_factor"] < 1.3 + 0.06 * df["bp_rp"] ** 2
-    )
-    df["good_phot"] = good_phot
+    df["good_phot"] = cuts.good_phot.mask(df)
     return df
 
 
+_ruwe_data_dir = os.path.join(os.path.dirname(__file__), "data", "DR2_RUWE_V1")
+
+
+def _read_u0_table():
+    """u0(G) and u0(G, C) columns of table_u0_2D.txt as one array
+
+    This is used to make table_u0_2D.npy:
+
+    >>> np.save("table_u0_2D.npy", _read_u0_table())
+    """
+    table = pd.read_csv(
+        os.path.join(_ruwe_data_dir, "table_u0_2D.txt"), skipinitialspace=True
+    )
+    return np.ascontiguousarray(table.iloc[:, 1:].values, dtype=float)
+
+
 class UWE0Calculator(object):
-    """Calculate unit weight error normalization for Gaia DR2 sources"""
+    """Calculate unit weight error normalization for Gaia DR2 sources
 
-    def __init__(self):
-        from scipy.interpolate import NearestNDInterpolator
+    u0(G, C) is tabulated on a regular grid of G = 3.60(0.01)21.00 and
+    C = BP-RP = -1.0(0.1)10.0 (Lindegren 2018, GAIA-C3-TN-LU-LL-124-01),
+    so values are looked up by index arithmetic. Sources without a colour
+    use u0(G). G and C outside the grid are clipped to its edges.
 
-        fn = os.path.join(
-            os.path.dirname(__file__), "data/DR2_RUWE_V1", "table_u0_g_col.txt"
-        )
-        self.data = pd.read_csv(fn, skipinitialspace=True)
-        self.interp = NearestNDInterpolator(
-            self.data[["bp_rp", "g_mag"]].values, self.data["u0"].values
-        )
+    The table is read on first use from a precompiled binary file,
+    memory-mapped so that forked worker processes share its pages.
 
-    def __call__(self, bp_rp, g_mag):
+    Parameters
+    ----------
+    method : str, optional
+        'nearest' to take the value of the nearest grid point or
+        'linear' for bilinear interpolation
+    """
+
+    g_start, g_step = 3.6, 0.01
+    c_start, c_step = -1.0, 0.1
+
+    def __init__(self, method="nearest"):
+        if method not in ("nearest", "linear"):
+            raise ValueError("`method` must be 'nearest' or 'linear'")
+        self.method = method
+        self._table = None
+
+    @property
+    def table(self):
+        """u0 grid; column 0 is u0(G) and columns 1: are u0(G, C)"""
+        if self._table is None:
+            fn = os.path.join(_ruwe_data_dir, "table_u0_2D.npy")
+            if os.path.exists(fn):
+                self._table = np.load(fn, mmap_mode="r")
+            else:
+                self._table = _read_u0_table()
+        return self._table
+
+    @property
+    def u0g(self):
+        return self.table[:, 0]
+
+    @property
+    def u0gc(self):
+        return self.table[:, 1:]
+
+    @staticmethod
+    def _index(x, start, step, n, method):
+        """Grid indices and weights of the upper index for values x"""
+        t = np.clip((x - start) / step, 0, n - 1)
+        if method == "nearest":
+            return np.rint(t).astype(np.intp), None
+        i = np.minimum(np.floor(t).astype(np.intp), n - 2)
+        return i, t - i
+
+    def __call__(self, bp_rp, g_mag, method=None):
         """Calculate unit weight error normalization factor
 
         Parameters
         ----------
         bp_rp : array-like
-            BP-RP colors of sources
+            BP-RP colors of sources; NaN for sources without a colour
         g_mag : array-like
             Gaia G magnitudes of sources
+        method : str, optional
+            'nearest' or 'linear'; the default is the method of the calculator
 
         Raises
         ------
@@ -243,12 +335,31 @@ class UWE0Calculator(object):
         array-like
             normalization factor
         """
-        bp_rp, g_mag = np.atleast_1d(bp_rp), np.atleast_1d(g_mag)
+        method = self.method if method is None else method
+        bp_rp = np.atleast_1d(np.asarray(bp_rp, dtype=float))
+        g_mag = np.atleast_1d(np.asarray(g_mag, dtype=float))
         if np.isnan(g_mag).any():
             raise ValueError("g_mag should not contain NaNs")
-        bp_rp_inan = np.isnan(bp_rp)
-        bp_rp[bp_rp_inan] = 0.9
-        return self.interp(np.vstack([bp_rp, g_mag]).T)
+        bp_rp, g_mag = np.broadcast_arrays(bp_rp, g_mag)
+        ng, nc = self.u0gc.shape
+        has_color = ~np.isnan(bp_rp)
+        i, wi = self._index(g_mag, self.g_start, self.g_step, ng, method)
+        # NaN colours are replaced by a valid index and overwritten with u0(G)
+        j, wj = self._index(
+            np.where(has_color, bp_rp, 0.0), self.c_start, self.c_step, nc, method
+        )
+        if method == "nearest":
+            u0 = self.u0gc[i, j]
+            u0g = self.u0g[i]
+        else:
+            u0 = (
+                self.u0gc[i, j] * (1 - wi) * (1 - wj)
+                + self.u0gc[i + 1, j] * wi * (1 - wj)
+                + self.u0gc[i, j + 1] * (1 - wi) * wj
+                + self.u0gc[i + 1, j + 1] * wi * wj
+            )
+            u0g = self.u0g[i] * (1 - wi) + self.u0g[i + 1] * wi
+        return np.where(has_color, u0, u0g)
 
 
 calculate_uwe0 = UWE0Calculator()
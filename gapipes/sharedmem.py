@@ -0,0 +1,185 @@
+"""
+Pass numpy arrays between processes through one shared memory block
+
+Used to move decoded columns out of worker processes without pickling them,
+and to let workers read and write columns of a table in place.
+"""
+import os
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+import numpy as np
+
+__all__ = [
+    "is_shareable",
+    "pack_arrays",
+    "unpack_arrays",
+    "SharedArrays",
+    "attach_arrays",
+]
+
+
+def is_shareable(a):
+    """True if array `a` can be placed in shared memory as raw bytes"""
+    return isinstance(a, np.ndarray) and a.dtype.kind in "biufcmMSU"
+
+
+def _layout(specs):
+    """Layout of arrays given as name -> (dtype, shape) and its total size"""
+    layout, offset = [], 0
+    for name, (dtype, shape) in specs.items():
+        # keep every array aligned to 8 bytes
+        offset = (offset + 7) // 8 * 8
+        dtype = np.dtype(dtype)
+        layout.append((name, dtype.str, tuple(shape), offset))
+        offset += dtype.itemsize * int(np.prod(shape))
+    return layout, offset
+
+
+def pack_arrays(arrays):
+    """Copy arrays into a new shared memory block
+
+    The block is left alive when the calling process exits; the receiving
+    process is responsible for unlinking it with `unpack_arrays`.
+
+    Parameters
+    ----------
+    arrays : dict
+        name -> numpy.ndarray; all arrays must satisfy `is_shareable`
+
+    Returns
+    -------
+    (str, list)
+        name of the shared memory block and the layout of arrays in it,
+        a list of (name, dtype, shape, offset). The name is None if there are
+        no arrays to share.
+    """
+    layout, offset = _layout({name: (a.dtype, a.shape) for name, a in arrays.items()})
+    if offset == 0:
+        return None, layout
+    shm = shared_memory.SharedMemory(create=True, size=offset)
+    try:
+        for (name, dtype, shape, start), a in zip(layout, arrays.values()):
+            out = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+            out[...] = a
+            del out
+    finally:
+        shm.close()
+    # ownership moves to the receiver; do not let this process' tracker unlink it
+    _untrack(shm)
+    return shm.name, layout
+
+
+def _untrack(shm):
+    """Stop the resource tracker of this process from unlinking `shm` at exit"""
+    if os.name == "posix":
+        # blocks are tracked by their POSIX name, which has a leading slash
+        resource_tracker.unregister("/" + shm.name.lstrip("/"), "shared_memory")
+
+
+def unpack_arrays(shm_name, layout):
+    """Copy arrays out of a shared memory block made by `pack_arrays` and free it
+
+    Parameters
+    ----------
+    shm_name : str or None
+        name of the shared memory block
+    layout : list
+        layout returned by `pack_arrays`
+
+    Returns
+    -------
+    dict
+        name -> numpy.ndarray
+    """
+    if shm_name is None:
+        return {name: np.empty(shape, dtype) for name, dtype, shape, _ in layout}
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        arrays = {}
+        for name, dtype, shape, start in layout:
+            view = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+            arrays[name] = view.copy()
+            del view
+    finally:
+        shm.close()
+        shm.unlink()
+    return arrays
+
+
+class SharedArrays(object):
+    """Arrays in a shared memory block owned by this process
+
+    Worker processes attach to the block with `attach_arrays`, using `name`
+    and `layout`, to read or write the arrays in place. The block is freed by
+    `close`, or on leaving the ``with`` block.
+
+    Parameters
+    ----------
+    specs : dict
+        name -> (dtype, shape) of arrays
+
+    Examples
+    --------
+    >>> with SharedArrays({"x": (float, (n,))}) as shared:
+    ...     pool.submit(work, shared.name, shared.layout).result()
+    ...     x = shared.arrays["x"].copy()
+    """
+
+    def __init__(self, specs):
+        self.layout, size = _layout(specs)
+        # a block cannot be empty
+        self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.arrays = _views(self._shm, self.layout)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def close(self):
+        """Free the shared memory block; `arrays` become unusable"""
+        if self._shm is not None:
+            self.arrays = {}
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _views(shm, layout):
+    return {
+        name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+        for name, dtype, shape, start in layout
+    }
+
+
+@contextmanager
+def attach_arrays(shm_name, layout):
+    """Arrays of a `SharedArrays` block in another process
+
+    Views of the arrays must not be kept after leaving the ``with`` block.
+
+    Parameters
+    ----------
+    shm_name : str
+        `SharedArrays.name`
+    layout : list
+        `SharedArrays.layout`
+
+    Yields
+    ------
+    dict
+        name -> numpy.ndarray viewing the shared memory
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    arrays = _views(shm, layout)
+    try:
+        yield arrays
+    finally:
+        arrays.clear()
+        shm.close()
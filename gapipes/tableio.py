@@ -0,0 +1,50 @@
+"""
+Write DataFrames to files in a format chosen by name
+
+Used for the part files of `gapipes.chunked.run_chunked` and the pages of
+`gapipes.gaia.export.TableExporter`.
+"""
+from astropy.table import Table
+
+__all__ = ["extensions", "check_format", "write_table"]
+
+#: file extension of each supported format
+extensions = {"fits": "fits", "csv": "csv", "parquet": "parquet"}
+
+
+def check_format(format):
+    """Raise if tables cannot be written in `format`
+
+    Raises
+    ------
+    ValueError
+        if `format` is not one of `extensions`
+    ImportError
+        if `format` is 'parquet' and neither pyarrow nor fastparquet is
+        installed
+    """
+    if format not in extensions:
+        raise ValueError("`format` must be one of {}".format(list(extensions)))
+    if format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            try:
+                import fastparquet  # noqa: F401
+            except ImportError:
+                raise ImportError(
+                    "Writing parquet requires pyarrow or fastparquet; "
+                    "install one of them or use format='fits' or 'csv'"
+                ) from None
+
+
+def write_table(df, path, format):
+    """Write DataFrame `df` without its index to `path` in the given format"""
+    if format == "parquet":
+        df.to_parquet(path, index=False)
+    elif format == "fits":
+        Table.from_pandas(df).write(path, format="fits", overwrite=True)
+    elif format == "csv":
+        df.to_csv(path, index=False)
+    else:
+        raise ValueError("`format` must be one of {}".format(list(extensions)))
@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+import pytest
+import astropy.coordinates as coord
+import astropy.units as u
+
+import gapipes as gp
+from gapipes import affine
+
+
+@pytest.fixture
+def df():
+    rng = np.random.RandomState(0)
+    n = 100
+    return pd.DataFrame(
+        {
+            "ra": rng.uniform(0, 360, n),
+            "dec": rng.uniform(-89, 89, n),
+            "parallax": rng.uniform(0.05, 10, n),
+            "pmra": rng.normal(0, 10, n),
+            "pmdec": rng.normal(0, 10, n),
+            "radial_velocity": rng.normal(0, 50, n),
+            "ra_error": rng.uniform(0.01, 0.1, n),
+            "dec_error": rng.uniform(0.01, 0.1, n),
+            "parallax_error": rng.uniform(0.01, 0.1, n),
+            "pmra_error": rng.uniform(0.01, 0.1, n),
+            "pmdec_error": rng.uniform(0.01, 0.1, n),
+            "radial_velocity_error": rng.uniform(0.1, 1, n),
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    "frame", [coord.Galactic(), coord.Galactocentric(z_sun=10 * u.pc)]
+)
+def test_matches_astropy(df, frame):
+    expected = gp.add_xv(df, frame)
+    result = affine.add_xv(df, frame)
+    for c in ["x", "y", "z", "vx", "vy", "vz"]:
+        assert np.allclose(result[c], expected[c], rtol=1e-9, atol=1e-9)
+    result = affine.add_x(df, frame, unit=u.kpc)
+    assert np.allclose(result["x"], expected["x"] / 1e3, rtol=1e-9, atol=1e-12)
+
+
+def test_not_affine():
+    with pytest.raises(ValueError):
+        affine.AffineFrame(coord.GCRS())
+
+
+def test_jacobian(df):
+    f = affine.AffineFrame(coord.Galactocentric())
+    d = df.iloc[:5]
+    J = f.jacobian(d)
+    base = np.vstack(f.xv(d))
+    # ra and dec steps are in mas
+    steps = [
+        ("ra", 1e-3 / 3.6e6 / np.cos(np.deg2rad(d["dec"]))),
+        ("dec", 1e-3 / 3.6e6),
+        ("parallax", 1e-6),
+        ("pmra", 1e-4),
+        ("pmdec", 1e-4),
+        ("radial_velocity", 1e-4),
+    ]
+    for j, (c, step) in enumerate(steps):
+        h = 1e-3 if c in ("ra", "dec") else step
+        numeric = (np.vstack(f.xv(d.assign(**{c: d[c] + step}))) - base) / h
+        assert np.allclose(numeric.T, J[:, :, j], rtol=1e-3, atol=1e-6), c
+
+
+def test_errors(df):
+    result = affine.add_xv(df, coord.Galactic(), errors=True)
+    J = affine.AffineFrame(coord.Galactic()).jacobian(df)
+    # only the parallax error
+    d = df.assign(
+        ra_error=0.0,
+        dec_error=0.0,
+        pmra_error=0.0,
+        pmdec_error=0.0,
+        radial_velocity_error=0.0,
+    )
+    e = affine.AffineFrame(coord.Galactic()).xv_errors(d)
+    assert np.allclose(e, np.abs(J[:, :, 2]) * df["parallax_error"].values[:, None])
+    assert (result["vz_error"] > 0).all()
+    assert np.allclose(
+        result["x_error"], affine.AffineFrame(coord.Galactic()).xv_errors(df)[:, 0]
+    )
+
+
+def test_xv_cov(df):
+    frame = coord.Galactocentric()
+    f = affine.AffineFrame(frame)
+    # without correlations the diagonal gives xv_errors
+    names = ["ra", "dec", "parallax", "pmra", "pmdec"]
+    d = df.copy()
+    for i, j in zip(*np.triu_indices(5, 1)):
+        d[names[i] + "_" + names[j] + "_corr"] = 0.0
+    S = affine.xv_cov(d, frame, chunk_size=30)
+    assert S.shape == (100, 6, 6)
+    assert np.allclose(np.sqrt(np.diagonal(S, axis1=1, axis2=2)), f.xv_errors(d))
+    P = f.xv_cov(d, packed=True, dtype=np.float32, chunk_size=30)
+    assert P.dtype == np.float32
+    assert np.allclose(P.dense(), S, rtol=1e-5)
+
+    # with correlations, compare with the covariance of transformed draws
+    rng = np.random.RandomState(0)
+    for i, j in zip(*np.triu_indices(5, 1)):
+        d[names[i] + "_" + names[j] + "_corr"] = rng.uniform(-0.3, 0.3, len(d))
+    d = d.iloc[:3]
+    S = f.xv_cov(d)
+    columns = names + ["radial_velocity"]
+    cov = gp.make_cov(d, columns)
+    draws = gp.covariance.sample(d[columns].values, cov, 20000, random_state=1)
+    for k in range(3):
+        x = pd.DataFrame(draws[k], columns=columns)
+        # ra, dec offsets are in mas
+        x["dec"] = d["dec"].iloc[k] + (x["dec"] - d["dec"].iloc[k]) / 3.6e6
+        x["ra"] = d["ra"].iloc[k] + (x["ra"] - d["ra"].iloc[k]) / 3.6e6 / np.cos(
+            np.deg2rad(d["dec"].iloc[k])
+        )
+        xv = np.vstack(f.xv(x))
+        expected = np.cov(xv)
+        scale = np.sqrt(np.outer(np.diag(expected), np.diag(expected)))
+        assert np.allclose(S[k] / scale, expected / scale, atol=0.05)
+
+    # radial_velocity without errors is exact
+    S = f.xv_cov(
+        df.drop(columns=["radial_velocity_error"]).assign(
+            **{
+                names[i] + "_" + names[j] + "_corr": 0.0
+                for i, j in zip(*np.triu_indices(5, 1))
+            }
+        )
+    )
+    assert np.all(np.isfinite(S))
+
+
+def test_errors_without_rv(df):
+    d = df.copy()
+    d.loc[[1, 2], "radial_velocity"] = np.nan
+    d.loc[3, "radial_velocity_error"] = np.nan
+    f = affine.AffineFrame(coord.Galactocentric())
+    e = f.xv_errors(d)
+    assert np.isnan(e[1:4, 3:]).all()
+    assert np.isfinite(e[1:4, :3]).all()
+    assert np.isfinite(e[[0, 4]]).all()
+    # positions do not depend on radial velocity
+    assert np.allclose(e[1:4, :3], f.xv_errors(df)[1:4, :3])
+
+
+def test_xv_cov_without_rv(df):
+    d = df.copy()
+    names = ["ra", "dec", "parallax", "pmra", "pmdec"]
+    for i, j in zip(*np.triu_indices(5, 1)):
+        d[names[i] + "_" + names[j] + "_corr"] = 0.0
+    d.loc[[1, 2], "radial_velocity"] = np.nan
+    d.loc[3, "radial_velocity_error"] = np.nan
+    f = affine.AffineFrame(coord.Galactic())
+    S = f.xv_cov(d, chunk_size=30)
+    assert np.isnan(S[1:4, 3:]).all() and np.isnan(S[1:4, :, 3:]).all()
+    assert np.allclose(
+        S[1:4, :3, :3],
+        f.xv_cov(df.assign(**{c: d[c] for c in d.columns if c.endswith("_corr")}))[
+            1:4, :3, :3
+        ],
+    )
+    assert np.isfinite(S[[0, 4]]).all()
+    P = f.xv_cov(d, packed=True)
+    assert np.isfinite(P[1][:3, :3]).all()
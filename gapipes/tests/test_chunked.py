@@ -0,0 +1,100 @@
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pytest
+from astropy.table import Table, MaskedColumn
+import astropy.coordinates as coord
+
+import gapipes as gp
+from gapipes.chunked import iter_chunks, count_rows, run_chunked
+
+
+@pytest.fixture
+def catalogue():
+    rng = np.random.RandomState(0)
+    n = 25
+    return pd.DataFrame(
+        {
+            "source_id": np.arange(n, dtype=np.int64),
+            "ra": rng.uniform(0, 360, n),
+            "dec": rng.uniform(-90, 90, n),
+            "parallax": rng.uniform(0.5, 10, n),
+            "pmra": rng.normal(0, 10, n),
+            "pmdec": rng.normal(0, 10, n),
+            "radial_velocity": rng.normal(0, 20, n),
+            "phot_g_mean_mag": rng.uniform(5, 20, n),
+            "bp_rp": rng.uniform(0, 3, n),
+            "astrometric_chi2_al": rng.uniform(50, 500, n),
+            "astrometric_n_good_obs_al": rng.randint(50, 300, n),
+        }
+    )
+
+
+@pytest.mark.parametrize("ext", ["fits", "csv"])
+def test_iter_chunks(catalogue, tmpdir, ext):
+    fn = str(tmpdir.join("cat." + ext))
+    if ext == "fits":
+        Table.from_pandas(catalogue).write(fn)
+        assert count_rows(fn) == 25
+    else:
+        catalogue.to_csv(fn, index=False)
+        assert count_rows(fn) is None
+    chunks = list(iter_chunks(fn, chunk_size=10, columns=["ra", "dec"]))
+    assert [len(df) for df in chunks] == [10, 10, 5]
+    assert list(chunks[0].columns) == ["ra", "dec"]
+    pd.testing.assert_frame_equal(
+        pd.concat(chunks), catalogue[["ra", "dec"]], check_dtype=False
+    )
+
+    with pytest.raises(ValueError):
+        next(iter_chunks(str(tmpdir.join("cat.txt"))))
+
+
+def test_run_chunked(catalogue, tmpdir):
+    fn = str(tmpdir.join("cat.fits"))
+    Table.from_pandas(catalogue).write(fn)
+    frame = coord.Galactic()
+    pipes = [gp.add_ruwe, partial(gp.add_xv, frame=frame)]
+    progress = []
+    files = run_chunked(
+        fn,
+        pipes,
+        str(tmpdir.join("out")),
+        chunk_size=10,
+        format="csv",
+        progress=lambda *args: progress.append(args),
+    )
+    assert len(files) == 3
+    assert progress == [(10, 25), (20, 25), (25, 25)]
+    result = pd.concat([pd.read_csv(f) for f in files], ignore_index=True)
+    expected = gp.add_xv(gp.add_ruwe(catalogue), frame)
+    for c in ["ruwe", "x", "y", "z", "vx", "vy", "vz"]:
+        assert np.allclose(result[c], expected[c])
+
+
+def test_run_chunked_default_format(catalogue, tmpdir):
+    fn = str(tmpdir.join("cat.csv"))
+    catalogue.to_csv(fn, index=False)
+    files = run_chunked(fn, [gp.add_ruwe], str(tmpdir.join("out")), chunk_size=10)
+    assert [f.endswith(".fits") for f in files] == [True] * 3
+    result = pd.concat([Table.read(f).to_pandas() for f in files], ignore_index=True)
+    assert np.allclose(result["ruwe"], gp.add_ruwe(catalogue)["ruwe"])
+
+
+def test_iter_chunks_fits_nulls(tmpdir):
+    fn = str(tmpdir.join("nulls.fits"))
+    t = Table(
+        {
+            "source_id": np.arange(5),
+            "n_obs": MaskedColumn([3, 4, 5, 6, 7], mask=[0, 1, 0, 0, 1], dtype="i8"),
+            "g": [1.0, np.nan, 3.0, 4.0, 5.0],
+        }
+    )
+    t.write(fn)
+    df = pd.concat(iter_chunks(fn, chunk_size=2))
+    assert list(df.index) == list(range(5))
+    assert list(df["n_obs"].isnull()) == [False, True, False, False, True]
+    assert list(df["n_obs"].dropna()) == [3, 5, 6]
+    assert list(df["g"].isnull()) == [False, True, False, False, False]
+    assert list(next(iter_chunks(fn, columns=["n_obs"])).columns) == ["n_obs"]
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import gapipes as gp
+from gapipes import covariance
+
+
+def random_cov(N, n, seed=0):
+    rng = np.random.RandomState(seed)
+    a = rng.normal(size=(N, n, n))
+    return np.einsum("nij,nkj->nik", a, a) + 0.1 * np.eye(n)
+
+
+def test_batched_operations():
+    cov = random_cov(50, 5)
+    cov[3] = np.nan
+    cov[7] = np.ones((5, 5))  # singular
+    good = np.ones(50, bool)
+    good[[3, 7]] = False
+
+    L = covariance.cholesky(cov, chunk_size=16)
+    assert np.allclose(np.einsum("nij,nkj->nik", L[good], L[good]), cov[good])
+    assert np.isnan(L[~good]).all()
+
+    icov = covariance.inv(cov, chunk_size=16)
+    assert np.allclose(icov[good], np.linalg.inv(cov[good]))
+    assert np.isnan(icov[~good]).all()
+
+    ld = covariance.logdet(cov, chunk_size=16)
+    assert np.allclose(ld[good], np.linalg.slogdet(cov[good])[1])
+    assert np.isnan(ld[~good]).all()
+
+    x = np.random.RandomState(1).normal(size=(50, 5))
+    d = covariance.mahalanobis(x, 0.0, cov, chunk_size=16)
+    expected = np.sqrt(np.einsum("ni,nij,nj->n", x[good], icov[good], x[good]))
+    assert np.allclose(d[good], expected)
+    assert np.isnan(d[~good]).all()
+
+    with pytest.raises(ValueError):
+        covariance.inv(np.ones((3, 2)))
+
+
+def test_sample():
+    cov = random_cov(3, 2)
+    mean = np.array([[0.0, 1.0], [2.0, 3.0], [4.0, 5.0]])
+    x = covariance.sample(mean, cov, 20000, random_state=0, chunk_size=2)
+    assert x.shape == (3, 20000, 2)
+    assert np.allclose(x.mean(axis=1), mean, atol=0.1)
+    for i in range(3):
+        assert np.allclose(np.cov(x[i].T), cov[i], rtol=0.05, atol=0.05)
+    # same seed, same draws regardless of chunking
+    assert np.allclose(covariance.sample(mean, cov, 20000, random_state=0), x)
+
+
+def test_make_cov_radial_velocity():
+    df = pd.DataFrame(
+        dict(
+            pmra_error=[1.0, 2.0],
+            pmdec_error=[1.0, 1.0],
+            pmra_pmdec_corr=[0.5, 0.0],
+            radial_velocity_error=[3.0, np.nan],
+        )
+    )
+    cov = gp.make_cov(df, columns=["pmra", "pmdec", "radial_velocity"])
+    assert np.allclose(cov[0], [[1, 0.5, 0], [0.5, 1, 0], [0, 0, 9]])
+    assert np.isnan(covariance.logdet(cov)[1])
+
+
+def test_packed_cov():
+    cov = random_cov(20, 5)
+    p = covariance.PackedCov.from_dense(cov)
+    assert p.data.shape == (20, 15)
+    assert p.shape == cov.shape
+    assert np.allclose(p.dense(), cov)
+    assert np.allclose(p[3], cov[3])
+    assert np.allclose(p[-1], cov[-1])
+    assert np.allclose(p[2:5].dense(), cov[2:5])
+    assert np.allclose(np.concatenate(list(p.iter_dense(chunk_size=6))), cov)
+    assert np.allclose(p.diagonal(), np.diagonal(cov, axis1=1, axis2=2))
+    assert np.allclose(p.sub([3, 1]).dense(), cov[:, [3, 1]][:, :, [3, 1]])
+
+    x = np.random.RandomState(1).normal(size=(20, 5))
+    assert np.allclose(p.dot(x), np.einsum("nij,nj->ni", cov, x))
+    assert np.allclose(p.quad(x), np.einsum("ni,nij,nj->n", x, cov, x))
+
+    # batched operations take packed matrices
+    assert np.allclose(covariance.inv(p, chunk_size=7), np.linalg.inv(cov))
+    assert np.allclose(covariance.logdet(p), np.linalg.slogdet(cov)[1])
+
+    p32 = p.astype(np.float32)
+    assert p32.nbytes == 20 * 15 * 4
+    assert np.allclose(covariance.logdet(p32), np.linalg.slogdet(cov)[1], rtol=1e-4)
+
+    with pytest.raises(ValueError):
+        covariance.PackedCov(np.zeros((3, 4)))
+
+
+def test_make_cov_packed():
+    rng = np.random.RandomState(0)
+    columns = ["ra", "dec", "parallax", "pmra", "pmdec"]
+    df = pd.DataFrame({c + "_error": rng.uniform(0.1, 1, 10) for c in columns})
+    for i, j in zip(*np.triu_indices(5, 1)):
+        df[columns[i] + "_" + columns[j] + "_corr"] = rng.uniform(-0.3, 0.3, 10)
+    p = df.g.make_cov(columns, packed=True, dtype=np.float32)
+    assert isinstance(p, covariance.PackedCov)
+    assert p.dtype == np.float32
+    assert np.allclose(p.dense(), gp.make_cov(df, columns), rtol=1e-6)
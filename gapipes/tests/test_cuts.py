@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import gapipes as gp
+from gapipes import cuts
+from gapipes.cuts import col
+from gapipes.gaia import adql
+
+
+@pytest.fixture
+def df():
+    rng = np.random.RandomState(0)
+    n = 1000
+    return pd.DataFrame(
+        {
+            "parallax": rng.normal(1, 1, n),
+            "parallax_error": rng.uniform(0.01, 0.5, n),
+            "bp_rp": np.where(rng.uniform(size=n) < 0.1, np.nan, rng.uniform(0, 3, n)),
+            "phot_bp_rp_excess_factor": rng.uniform(1, 1.5, n),
+            "astrometric_chi2_al": rng.uniform(100, 1000, n),
+            "astrometric_n_good_obs_al": rng.randint(100, 300, n),
+        }
+    )
+
+
+def test_to_adql():
+    cut = (col("parallax") / col("parallax_error") > 10) & ~(col("bp_rp") < 0.5)
+    assert cut.to_adql() == "((parallax / parallax_error) > 10) AND (NOT (bp_rp < 0.5))"
+    assert cuts.good_phot.to_adql("g") == (
+        "(g.phot_bp_rp_excess_factor > (1 + (0.015 * POWER(g.bp_rp, 2)))) AND "
+        "(g.phot_bp_rp_excess_factor < (1.3 + (0.06 * POWER(g.bp_rp, 2))))"
+    )
+    q = adql.add_where("select * from gaiadr2.gaia_source", cuts.ruwe_below(1.4))
+    assert q == "select * from gaiadr2.gaia_source WHERE ruwe < 1.4"
+    with pytest.raises(TypeError):
+        bool(cut)
+
+
+def test_mask(df):
+    expected = (df["phot_bp_rp_excess_factor"] > 1 + 0.015 * df["bp_rp"] ** 2) & (
+        df["phot_bp_rp_excess_factor"] < 1.3 + 0.06 * df["bp_rp"] ** 2
+    )
+    assert np.array_equal(cuts.good_phot.mask(df), expected)
+    assert np.array_equal(gp.flag_good_phot(df)["good_phot"], expected)
+
+    cut = cuts.parallax_over_error_above(5) | cuts.uwe_below(1.2)
+    uwe = np.sqrt(df["astrometric_chi2_al"] / (df["astrometric_n_good_obs_al"] - 5))
+    expected = (df["parallax"] / df["parallax_error"] > 5) | (uwe < 1.2)
+    assert np.array_equal(cut.mask(df), expected)
+    assert len(cut.filter(df)) == expected.sum()
+
+
+def test_missing_values(df):
+    known = df["bp_rp"].notnull()
+    cut = col("bp_rp") < 0.5
+    assert np.array_equal((~cut).mask(df), known & (df["bp_rp"] >= 0.5))
+    assert not (cut | ~cut).mask(df)[~known].any()
+    assert (cut | ~cut).mask(df)[known].all()
+    # unknown AND false is false, so its negation is true
+    either = ~(cut & (col("parallax_error") < 0))
+    assert np.array_equal(either.mask(df), np.ones(len(df), dtype=bool))
+
+
+def test_equality(df):
+    cut = col("astrometric_n_good_obs_al") == 200
+    assert cut.to_adql() == "astrometric_n_good_obs_al = 200"
+    assert np.array_equal(cut.mask(df), df["astrometric_n_good_obs_al"] == 200)
+    assert (col("bp_rp") != 1).to_adql() == "bp_rp <> 1"
+    assert not (col("bp_rp") != 1).mask(df)[df["bp_rp"].isnull()].any()
+    assert len({col("a"), col("a")}) == 2
+
+
+def test_numpy_constants():
+    cut = (col("parallax") > np.float64(5.0)) & (col("n") < np.int64(3))
+    assert cut.to_adql() == "(parallax > 5.0) AND (n < 3)"
+
+
+def test_string_constants():
+    assert (col("name") == "O'Neil").to_adql() == "name = 'O''Neil'"
+    assert (col("flag") != "VARIABLE").to_adql() == "flag <> 'VARIABLE'"
+    with pytest.raises(TypeError):
+        (col("x") == None).to_adql()  # noqa: E711
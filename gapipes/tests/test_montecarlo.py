@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import astropy.coordinates as coord
+
+import gapipes as gp
+from gapipes import montecarlo as mc
+from gapipes import affine
+
+
+def make_df(n=7):
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame(
+        {
+            "ra": rng.uniform(0, 360, n),
+            "dec": rng.uniform(-80, 80, n),
+            "parallax": rng.uniform(2, 10, n),
+            "pmra": rng.normal(0, 10, n),
+            "pmdec": rng.normal(0, 10, n),
+            "radial_velocity": rng.normal(0, 20, n),
+            "parallax_error": rng.uniform(0.05, 0.2, n),
+            "pmra_error": rng.uniform(0.05, 0.2, n),
+            "pmdec_error": rng.uniform(0.05, 0.2, n),
+            "parallax_pmra_corr": rng.uniform(-0.5, 0.5, n),
+            "parallax_pmdec_corr": rng.uniform(-0.5, 0.5, n),
+            "pmra_pmdec_corr": rng.uniform(-0.5, 0.5, n),
+        },
+        index=np.arange(n) + 100,
+    )
+    return df
+
+
+def test_propagate():
+    df = make_df()
+    df.loc[105, "parallax_error"] = np.nan
+    result = mc.propagate(
+        df,
+        [mc.distance, mc.vtan, mc.xv(coord.Galactic())],
+        size=20000,
+        chunk_size=3,
+        random_state=0,
+    )
+    assert list(result.index) == list(df.index)
+    assert {"distance_p16", "vra_p50", "vz_p84"} <= set(result.columns)
+    # percentiles of a monotonic function of parallax alone
+    good = df.index != 105
+    plx, err = df["parallax"][good], df["parallax_error"][good]
+    assert np.allclose(result["distance_p50"][good], 1e3 / plx, rtol=2e-3)
+    assert np.allclose(result["distance_p16"][good], 1e3 / (plx + err), rtol=5e-3)
+    assert np.allclose(result["distance_p84"][good], 1e3 / (plx - err), rtol=5e-3)
+    assert result.loc[105].isnull().all()
+
+    vtan = gp.add_vtan(df)
+    assert np.allclose(result["vra_p50"][good], vtan["vra"][good], rtol=0.02, atol=0.1)
+    x = affine.add_xv(df, coord.Galactic())
+    assert np.allclose(result["x_p50"][good], x["x"][good], rtol=0.01)
+
+
+def test_propagate_reproducible():
+    df = make_df()
+    a = mc.propagate(df, [mc.vtan], size=50, random_state=1)
+    b = mc.propagate(df, [mc.vtan], size=50, random_state=1, chunk_size=2)
+    pd.testing.assert_frame_equal(a, b)
+
+
+def test_propagate_without_rv():
+    df = make_df()
+    df["radial_velocity_error"] = 1.0
+    df.loc[[101, 102], "radial_velocity"] = np.nan
+    df.loc[103, "radial_velocity_error"] = np.nan
+    result = mc.propagate(
+        df,
+        [mc.distance, mc.xv(coord.Galactocentric())],
+        size=500,
+        columns=["parallax", "pmra", "pmdec", "radial_velocity"],
+        random_state=0,
+    )
+    no_rv = df.index.isin([101, 102, 103])
+    assert result.loc[~no_rv].notnull().all().all()
+    assert result.loc[no_rv, ["distance_p50", "x_p50", "z_p84"]].notnull().all().all()
+    assert result.loc[no_rv, ["vx_p50", "vz_p16"]].isnull().all().all()
+
+
+def test_propagate_positions():
+    df = make_df(5)
+    df["ra_error"] = [0.02, 0.05, 0.1, 0.2, 0.5]
+    df["dec_error"] = df["ra_error"][::-1].values
+    df["ra_dec_corr"] = 0.0
+
+    def position(d):
+        return {"ra": d["ra"], "dec": d["dec"]}
+
+    result = mc.propagate(
+        df,
+        [position, mc.xv(coord.Galactic())],
+        size=20000,
+        columns=["ra", "dec"],
+        random_state=0,
+    )
+    # errors are in mas and ra_error is the error of ra * cos(dec)
+    sigma_dec = (result["dec_p84"] - result["dec_p16"]) / 2 * 3.6e6
+    sigma_ra = (result["ra_p84"] - result["ra_p16"]) / 2 * 3.6e6
+    assert np.allclose(sigma_dec, df["dec_error"], rtol=0.05)
+    cosd = np.cos(np.deg2rad(df["dec"]))
+    assert np.allclose(sigma_ra * cosd, df["ra_error"], rtol=0.05)
+
+    # the spread of x is of the order distance * angular error, ~1e-7 pc
+    distance = 1e3 / df["parallax"]
+    sigma_x = (result["x_p84"] - result["x_p16"]) / 2
+    bound = distance * np.hypot(df["ra_error"], df["dec_error"]) / 3.6e6
+    assert (sigma_x <= 1.1 * np.deg2rad(bound)).all()
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+import astropy.coordinates as coord
+import astropy.units as u
+
+import gapipes as gp
+from gapipes import parallel, sharedmem
+
+
+@pytest.fixture
+def df():
+    rng = np.random.RandomState(0)
+    n = 103
+    return pd.DataFrame(
+        {
+            "ra": rng.uniform(0, 360, n),
+            "dec": rng.uniform(-90, 90, n),
+            "parallax": rng.uniform(0.5, 10, n),
+            "pmra": rng.normal(0, 10, n),
+            "pmdec": rng.normal(0, 10, n),
+            "radial_velocity": rng.normal(0, 20, n),
+        }
+    )
+
+
+def test_shared_arrays():
+    with sharedmem.SharedArrays({"a": ("i4", (3,)), "b": (float, (2, 2))}) as s:
+        s.arrays["a"][:] = [1, 2, 3]
+        with sharedmem.attach_arrays(s.name, s.layout) as arrays:
+            assert list(arrays["a"]) == [1, 2, 3]
+            arrays["b"][:] = 1.5
+        assert np.all(s.arrays["b"] == 1.5)
+
+
+@pytest.mark.parametrize(
+    "frame", [coord.Galactic(), coord.Galactocentric(z_sun=10 * u.pc)]
+)
+def test_add_xv(df, frame):
+    expected = gp.add_xv(df, frame)
+    result = gp.add_xv(df, frame, max_workers=2)
+    assert list(result.columns) == list(expected.columns)
+    for c in ["x", "y", "z", "vx", "vy", "vz"]:
+        assert np.allclose(result[c], expected[c], rtol=1e-12)
+
+    result = parallel.add_x(df, frame, unit=u.kpc, max_workers=2, block_size=10)
+    assert np.allclose(result["x"], expected["x"] / 1e3, rtol=1e-12)
+    assert "vx" not in result
+
+
+def test_transform(df):
+    c = parallel.transform(df, coord.Galactic, max_workers=2)
+    expected = df.g.galactic
+    assert isinstance(c, coord.Galactic)
+    assert np.allclose(
+        df.g.transform_to(coord.Galactic(), max_workers=2).l.deg, c.l.deg
+    )
+    assert np.allclose(c.l.deg, expected.l.deg)
+    assert np.allclose(c.b.deg, expected.b.deg)
+    assert np.allclose(c.pm_l_cosb, expected.pm_l_cosb)
+    assert np.allclose(c.radial_velocity, expected.radial_velocity)
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+import astropy.coordinates as coord
+
+import gapipes as gp
+from gapipes import pipeline
+
+
+@pytest.fixture
+def df():
+    rng = np.random.RandomState(0)
+    n = 100
+    bp_rp = rng.uniform(0, 3, n)
+    bp_rp[::10] = np.nan
+    return pd.DataFrame(
+        {
+            "ra": rng.uniform(0, 360, n),
+            "dec": rng.uniform(-90, 90, n),
+            "parallax": rng.uniform(0.5, 10, n),
+            "pmra": rng.normal(0, 10, n),
+            "pmdec": rng.normal(0, 10, n),
+            "radial_velocity": rng.normal(0, 20, n),
+            "parallax_error": rng.uniform(0.01, 0.1, n),
+            "pmra_error": rng.uniform(0.01, 0.1, n),
+            "pmdec_error": rng.uniform(0.01, 0.1, n),
+            "phot_g_mean_mag": rng.uniform(5, 20, n),
+            "bp_rp": bp_rp,
+            "phot_bp_rp_excess_factor": rng.uniform(1, 1.5, n),
+            "astrometric_chi2_al": rng.uniform(50, 500, n),
+            "astrometric_n_good_obs_al": rng.randint(50, 300, n),
+            "a_g_val": rng.uniform(0, 1, n),
+            "a_g_percentile_lower": rng.uniform(0, 0.5, n),
+            "a_g_percentile_upper": rng.uniform(1, 1.5, n),
+        }
+    )
+
+
+def test_pipeline_matches_pipes(df):
+    frame = coord.Galactic()
+    p = gp.Pipeline(
+        "vtan",
+        "vtan_errors",
+        "distmod",
+        "gMag",
+        "good_phot",
+        "uwe",
+        "ruwe",
+        "a_g_error",
+        pipeline.xv(frame),
+    )
+    out = p(df)
+    expected = df
+    for f in [
+        gp.add_vtan,
+        gp.add_vtan_errors,
+        gp.pipes.add_distmod,
+        gp.add_gMag,
+        gp.flag_good_phot,
+        gp.add_uwe,
+        gp.add_ruwe,
+        gp.add_a_g_error,
+        lambda df: gp.add_xv(df, frame),
+    ]:
+        expected = f(expected)
+    assert set(out.columns) == set(expected.columns)
+    assert set(p.produces) == set(out.columns) - set(df.columns)
+    for c in p.produces:
+        assert np.allclose(out[c], expected[c], equal_nan=True), c
+    # input is not modified
+    assert "vra" not in df
+
+
+def test_pipeline_inplace_and_shared(df, monkeypatch):
+    calls = []
+    inv = pipeline._shared["_inv_parallax"]
+
+    def counted(ns):
+        calls.append(1)
+        return inv(ns)
+
+    monkeypatch.setitem(pipeline._shared, "_inv_parallax", counted)
+    out = gp.Pipeline("vtan", "vtan_errors")(df, inplace=True)
+    assert out is df
+    assert {"vra", "vdec", "vra_error", "vdec_error"} <= set(df.columns)
+    assert len(calls) == 1
+    assert "vra" in df.pipe(gp.Pipeline("vtan"))
+
+
+def test_pipeline_requires(df):
+    p = gp.Pipeline(
+        "uwe",
+        gp.Step(lambda ns: ns["uwe"] * 2, ["uwe"], ["uwe2"], "double"),
+    )
+    assert p.requires == ["astrometric_chi2_al", "astrometric_n_good_obs_al"]
+    assert np.allclose(p(df)["uwe2"], 2 * gp.add_uwe(df)["uwe"])
+    with pytest.raises(KeyError, match="astrometric_chi2_al"):
+        p(df.drop(columns=["astrometric_chi2_al"]))
@@ -0,0 +1,74 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+import gapipes as gp
+
+
+@pytest.fixture(scope="module")
+def u0_table():
+    fn = os.path.join(
+        os.path.dirname(gp.pipes.__file__), "data/DR2_RUWE_V1", "table_u0_2D.txt"
+    )
+    return pd.read_csv(fn, skipinitialspace=True)
+
+
+def test_uwe0_grid(u0_table):
+    calc = gp.UWE0Calculator()
+    row = u0_table.iloc[1000]
+    g = np.full(3, row["g_mag"])
+    bp_rp = np.array([-1.0, 0.9, 10.0])
+    expected = row[["u0m010", "u0p009", "u0p100"]].values.astype(float)
+    assert np.allclose(calc(bp_rp, g), expected)
+    assert np.allclose(calc(bp_rp, g, method="linear"), expected)
+    # nearest grid point
+    assert np.allclose(calc(bp_rp + 0.04, g + 0.004), expected)
+    # outside the grid
+    assert np.allclose(calc([20.0], [2.0]), u0_table["u0p100"].values[0])
+
+
+def test_uwe0_linear(u0_table):
+    calc = gp.UWE0Calculator(method="linear")
+    r0, r1 = u0_table.iloc[500], u0_table.iloc[501]
+    g = 0.5 * (r0["g_mag"] + r1["g_mag"])
+    expected = 0.25 * (r0["u0p010"] + r0["u0p011"] + r1["u0p010"] + r1["u0p011"])
+    assert np.isclose(calc(1.05, g)[0], expected)
+    with pytest.raises(ValueError):
+        gp.UWE0Calculator(method="cubic")
+
+
+def test_uwe0_no_color(u0_table):
+    calc = gp.UWE0Calculator()
+    bp_rp = np.array([np.nan, 0.5])
+    g = u0_table["g_mag"].values[[10, 20]]
+    u0 = calc(bp_rp, g)
+    assert np.isclose(u0[0], u0_table["u0g"].values[10])
+    assert np.isclose(u0[1], u0_table["u0p005"].values[20])
+    # input is not modified
+    assert np.isnan(bp_rp[0])
+    with pytest.raises(ValueError):
+        calc([0.5], [np.nan])
+
+
+def test_add_ruwe():
+    df = pd.DataFrame(
+        {
+            "bp_rp": [np.nan, 1.0],
+            "phot_g_mean_mag": [15.0, 15.0],
+            "astrometric_chi2_al": [100.0, 100.0],
+            "astrometric_n_good_obs_al": [105, 105],
+        }
+    )
+    out = gp.add_ruwe(df)
+    assert np.isnan(df["bp_rp"][0])
+    assert "ruwe" not in df
+    assert np.allclose(out["ruwe"], 1.0 / gp.calculate_uwe0(df["bp_rp"], [15.0, 15.0]))
+
+
+def test_uwe0_table_loaded_lazily():
+    calc = gp.UWE0Calculator()
+    assert calc._table is None
+    calc([1.0], [15.0])
+    assert isinstance(calc.table, np.memmap)
+    assert np.array_equal(calc.table, gp.pipes._read_u0_table())
@@ -0,0 +1,33 @@
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from astropy.table import Table
+
+from gapipes import tableio
+
+
+@pytest.mark.parametrize("format", ["fits", "csv"])
+def test_write_table(tmpdir, format):
+    df = pd.DataFrame(
+        {"source_id": np.arange(3), "ra": [1.0, 2.0, 3.0]}, index=[5, 6, 7]
+    )
+    path = str(tmpdir.join("t." + tableio.extensions[format]))
+    tableio.check_format(format)
+    tableio.write_table(df, path, format)
+    if format == "fits":
+        result = Table.read(path).to_pandas()
+    else:
+        result = pd.read_csv(path)
+    assert list(result.columns) == ["source_id", "ra"]
+    assert np.array_equal(result["ra"], df["ra"])
+
+
+def test_check_format(monkeypatch):
+    with pytest.raises(ValueError):
+        tableio.check_format("hdf5")
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    monkeypatch.setitem(sys.modules, "fastparquet", None)
+    with pytest.raises(ImportError):
+        tableio.check_format("parquet")
@@ -7,8 +7,8 @@ from setuptools import find_packages
 from setuptools import setup
 
 
-if sys.version_info < (3, 6):
-    sys.exit("Sorry, python < 3.6 is not supported")
+if sys.version_info < (3, 8):
+    sys.exit("Sorry, python < 3.8 is not supported")
 
 
 def read(filename):
@@ -29,6 +29,7 @@ setup(
     long_description=read("README.md"),
     packages=find_packages(exclude=("tests",)),
     include_package_data=True,
+    python_requires=">=3.8",
     install_requires=[
         "pandas>=0.23",
         "requests",
@@ -36,14 +37,15 @@ setup(
         "beautifulsoup4>=4.6",
         "scipy",
     ],
+    extras_require={"parquet": ["pyarrow"]},
     classifiers=[
         "Development Status :: 2 - Pre-Alpha",
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
-        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
     ],
 )